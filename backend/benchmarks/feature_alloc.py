@@ -0,0 +1,121 @@
+"""
+Compare the allocations and the time of the feature pipeline for a beatmap,
+between the preallocated float32 arrays of Beatmap.get_data and the lists it
+used to build, converted and widened afterwards (the baseline).
+
+usage: python -m benchmarks.feature_alloc path/to/beatmap.osu [--repeat N]
+
+Measured on a generated beatmap of 2000 hit objects, half of them sliders
+with 3 control points (python 3.11, numpy 2.4, --repeat 200, 3 runs):
+    baseline:     peak 740.5 KiB, 114 blocks alive, 4.3-5.6 ms
+    preallocated: peak 142.8 KiB,  13 blocks alive, 4.6-6.0 ms
+The peak is 5x lower, the time is unchanged within the noise: filling the
+rows one at a time costs about what the list building and conversions did.
+"""
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from utils import data
+from utils.beatmap import Beatmap, HitObjects
+
+
+def baseline_get_data(bm: Beatmap):
+    """
+    Beatmap.get_data and the conversions of predict_map_type before the arrays
+    were preallocated: nested lists, np.asarray, then np.insert for the delta.
+    """
+    map_info = [
+        bm.sections["Difficulty"]["HPDrainRate"],
+        bm.sections["Difficulty"]["CircleSize"],
+        bm.sections["Difficulty"]["OverallDifficulty"],
+        bm.sections["Difficulty"]["ApproachRate"],
+        bm.sections["Difficulty"]["SliderMultiplier"],
+        bm.sections["Difficulty"]["SliderTickRate"],
+        bm.sections["HitObjects"][-1].time,
+    ]
+    hit_objects = []
+    slider_points = []
+    for hit_object in bm.sections["HitObjects"]:
+        row = [
+            hit_object.x,
+            hit_object.y,
+            hit_object.time,
+            hit_object.type.value,
+            int(hit_object.new_combo),
+        ]
+        if hit_object.type == HitObjects._Type.SLIDER:
+            for x, y in hit_object.object_params.points:
+                slider_points.append(
+                    [
+                        x,
+                        y,
+                        hit_object.time,
+                        hit_object.object_params.type.value,
+                        hit_object.object_params.slides,
+                        hit_object.object_params.length,
+                    ]
+                )
+        else:
+            slider_points.append([0, 0, 0, 0, 0, 0])
+        hit_objects.append(row)
+
+    map_info = np.asarray([map_info], dtype=np.float32)
+    # Lists are never HIT_OBJECTS_FEATURES wide, so the time column is inserted
+    hit_objects = data.add_diff_dim(np.asarray(hit_objects, dtype=np.float32))
+    slider_points = np.asarray(slider_points, dtype=np.float32)
+    return map_info, hit_objects, slider_points
+
+
+async def preallocated_get_data(bm: Beatmap):
+    map_info, hit_objects, slider_points = await bm.get_data()
+    return map_info, data.add_diff_dim(hit_objects), slider_points
+
+
+async def measure(name: str, get_data, bm: Beatmap, repeat: int):
+    async def run():
+        result = get_data(bm)
+        return await result if asyncio.iscoroutine(result) else result
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    features = await run()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "lineno")
+    count = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await run()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(
+        f"{name}: peak {peak / 1024:.1f} KiB, {count} blocks alive, "
+        f"{elapsed * 1000:.2f} ms"
+    )
+    return features
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.path, encoding="utf-8") as f:
+        bm = Beatmap.from_content(f.read().replace("\r", ""))
+    print(f"hit objects: {len(bm.sections['HitObjects'])}")
+
+    expected = await measure("baseline", baseline_get_data, bm, args.repeat)
+    features = await measure("preallocated", preallocated_get_data, bm, args.repeat)
+    # Same model inputs either way
+    for old, new in zip(expected, features):
+        np.testing.assert_array_equal(old.reshape(new.shape), new)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
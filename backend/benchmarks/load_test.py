@@ -0,0 +1,86 @@
+"""
+Simple load test for the API.
+Sends the same beatmap to /predict, or the same GET request, from several
+concurrent clients and reports throughput and latency.
+
+usage:
+    python -m benchmarks.load_test --beatmap path/to/beatmap.osu [--url URL] [--clients N] [--requests N]
+    python -m benchmarks.load_test --get "/beatmaps/search?q=camellia" [--url URL] [--clients N] [--requests N]
+
+To check the CPU pinning, run the /predict test against the server started
+with CPU_PINNING=0 and then CPU_PINNING=1 (WEB_WORKERS > 1), with as many
+clients as workers, and compare the throughput and the p95 latency.
+"""
+import time
+import uuid
+import argparse
+import http.client
+from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+def build_multipart(path: Path):
+    boundary = uuid.uuid4().hex
+    body = (
+        (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{path.name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        + path.read_bytes()
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def send(url, method, path, body=None, headers=None):
+    """Send one request, returns (status, latency in seconds)"""
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=120)
+    start = time.perf_counter()
+    conn.request(method, path, body=body, headers=headers or {})
+    res = conn.getresponse()
+    res.read()
+    conn.close()
+    return res.status, time.perf_counter() - start
+
+
+def run(fn, clients: int, n_requests: int):
+    """Run fn n_requests times from `clients` threads and print a summary"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(lambda _: fn(), range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    errors = sum(1 for status, _ in results if status != 200)
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+    print(f"requests: {n_requests}, clients: {clients}, errors: {errors}")
+    print(f"throughput: {n_requests / elapsed:.2f} req/s")
+    print(
+        f"latency p50: {pct(0.5) * 1000:.0f} ms, "
+        f"p95: {pct(0.95) * 1000:.0f} ms, p99: {pct(0.99) * 1000:.0f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--beatmap", type=Path, help="Beatmap to send to /predict")
+    target.add_argument("--get", help="Path and query string to GET")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    if args.get:
+        fn = lambda: send(url, "GET", args.get)
+    else:
+        body, content_type = build_multipart(args.beatmap)
+        fn = lambda: send(url, "POST", "/predict", body, {"Content-Type": content_type})
+    run(fn, args.clients, args.requests)
+
+
+if __name__ == "__main__":
+    main()
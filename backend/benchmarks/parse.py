@@ -0,0 +1,35 @@
+"""
+Compare the parse time of a beatmap with and without skipping the unused sections.
+
+usage: python -m benchmarks.parse path/to/beatmap.osu [--repeat N]
+"""
+import argparse
+import time
+
+from utils.beatmap import Beatmap
+
+
+def measure(content: str, lazy: bool, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        Beatmap.from_content(content, lazy=lazy)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.path, encoding="utf-8") as f:
+        content = f.read().replace("\r", "")
+
+    full = measure(content, False, args.repeat)
+    lazy = measure(content, True, args.repeat)
+    print(f"full parse: {full * 1000:.2f} ms")
+    print(f"lazy parse: {lazy * 1000:.2f} ms ({lazy / full:.0%} of full)")
+
+
+if __name__ == "__main__":
+    main()
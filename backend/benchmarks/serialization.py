@@ -0,0 +1,71 @@
+"""
+Compare the response serialization paths on a 25 beatmaps listing page.
+
+old: DefaultResponse validation (Union trial) + jsonable_encoder + json.dumps
+new: dict rows encoded directly by orjson
+
+usage: python -m benchmarks.serialization [--iterations N]
+"""
+import json
+import timeit
+import argparse
+from datetime import datetime, timezone
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from model.api import DefaultResponse
+
+
+def make_rows(n: int = 25):
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "beatmap_id": 1000 + i,
+            "beatmapset_id": 100 + i,
+            "artist": "Camellia",
+            "title": f"Ghost Rule {i}",
+            "creator": "Mapper",
+            "version": "Extra",
+            "alternate_p": 0.1,
+            "fingercontrol_p": 0.2,
+            "jump_p": 0.3,
+            "speed_p": 0.4,
+            "stamina_p": 0.5,
+            "stream_p": 0.6,
+            "tech_p": 0.7,
+            "created_at": now,
+            "updated_at": now,
+        }
+        for i in range(n)
+    ]
+
+
+def old_path(rows):
+    response = DefaultResponse(code=0, message="ok", data={"beatmaps": rows})
+    return json.dumps(jsonable_encoder(response)).encode()
+
+
+def new_path(rows):
+    return orjson.dumps({"code": 0, "message": "ok", "data": {"beatmaps": rows}})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    full = make_rows()
+    simple = [
+        {k: v for k, v in row.items() if not k.endswith(("_p", "_at"))}
+        for row in full
+    ]
+    for name, rows in (("simple", simple), ("full", full)):
+        for path in (old_path, new_path):
+            elapsed = timeit.timeit(lambda: path(rows), number=args.iterations)
+            per_page = elapsed / args.iterations * 1e6
+            print(f"{name:>6} {path.__name__}: {per_page:.1f} us/page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compare the latency and the predictions of the /predict tiers on a set of beatmaps.
+The full model is the reference for the agreement of the other tiers.
+
+usage: python -m benchmarks.tiers path/to/*.osu [--margin M] [--repeat N]
+"""
+import time
+import asyncio
+import argparse
+
+import numpy as np
+
+from const import *
+from config.runtime import configure_torch
+from model.loader import load_model, load_student, warm_up
+from utils.beatmap import Beatmap
+from utils.predict import extract_features, is_uncertain, predict_features
+
+
+def timed(model, features, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        map_type, _ = predict_features(model, *features)
+    return map_type, (time.perf_counter() - start) / repeat
+
+
+def agreement(name: str, preds, reference) -> None:
+    preds = np.asarray([[p[label] for label in LABELS] for p in preds])
+    reference = np.asarray([[p[label] for label in LABELS] for p in reference])
+    mae = np.abs(preds - reference).mean()
+    top_class = (preds.argmax(1) == reference.argmax(1)).mean()
+    labels = ((preds > 0.5) == (reference > 0.5)).all(1).mean()
+    print(
+        f"{name}: mae {mae:.4f}, top class agreement {top_class:.1%}, "
+        f"label agreement {labels:.1%}"
+    )
+
+
+def latency(name: str, times) -> None:
+    times = np.asarray(times) * 1000
+    print(
+        f"{name}: mean {times.mean():.2f} ms, p50 {np.percentile(times, 50):.2f} ms, "
+        f"p95 {np.percentile(times, 95):.2f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--teacher", default=MODEL_WEIGHTS_PATH)
+    parser.add_argument("--student", default=STUDENT_WEIGHTS_PATH)
+    parser.add_argument("--margin", type=float, default=CASCADE_MARGIN)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    configure_torch()
+    teacher = load_model(args.teacher)
+    _, student = load_student(args.student)
+    warm_up(teacher)
+    warm_up(student)
+
+    full, fast, cascade = [], [], []
+    full_times, fast_times, cascade_times = [], [], []
+    escalated = 0
+    for path in args.paths:
+        with open(path, encoding="utf-8") as f:
+            bm = Beatmap.from_content(f.read().replace("\r", ""))
+        features = await extract_features(bm)
+
+        full_type, full_time = timed(teacher, features, args.repeat)
+        fast_type, fast_time = timed(student, features, args.repeat)
+        full.append(full_type)
+        fast.append(fast_type)
+        full_times.append(full_time)
+        fast_times.append(fast_time)
+        # The cascade pays for the distilled model, and for the full one when uncertain
+        if is_uncertain(fast_type, args.margin):
+            escalated += 1
+            cascade.append(full_type)
+            cascade_times.append(fast_time + full_time)
+        else:
+            cascade.append(fast_type)
+            cascade_times.append(fast_time)
+
+    print(f"beatmaps: {len(args.paths)}")
+    latency("full latency", full_times)
+    latency("fast latency", fast_times)
+    latency("cascade latency", cascade_times)
+    agreement("fast", fast, full)
+    agreement("cascade", cascade, full)
+    print(
+        f"cascade escalated {escalated / len(args.paths):.1%} "
+        f"of the beatmaps (margin {args.margin})"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,4 +1,8 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import asyncio
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from const import *
@@ -7,3 +11,79 @@ from const import *
 engine = create_async_engine(DATABASE_URL, future=True, echo=True)
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 Base = declarative_base()
+
+
+class ReplicaSet:
+    """
+    Read replicas of the primary database.
+    Reads are spread over the healthy replicas in turn, a replica is healthy
+    when it answers and is at most `max_lag` seconds behind the primary.
+    Reads go to the primary when no replica is healthy.
+    """
+
+    # Seconds since the last replayed transaction, 0 when fully caught up
+    # or when the database is not a replica
+    _LAG = text(
+        """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+        """
+    )
+
+    def __init__(
+        self, primary: AsyncEngine, replicas: List[AsyncEngine], max_lag: float
+    ) -> None:
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self._healthy = list(replicas)
+        self._next = 0
+
+    def engine(self) -> AsyncEngine:
+        """
+        Engine for the next read.
+        """
+        if not self._healthy:
+            return self.primary
+        self._next = (self._next + 1) % len(self._healthy)
+        return self._healthy[self._next]
+
+    async def _lag(self, replica: AsyncEngine) -> float:
+        async with replica.connect() as conn:
+            lag = await conn.scalar(self._LAG)
+        return float(lag or 0)
+
+    async def check(self, timeout: float = 2) -> None:
+        """
+        Check every replica and only keep the healthy ones for reads.
+        """
+        healthy = []
+        for replica in self.replicas:
+            try:
+                lag = await asyncio.wait_for(self._lag(replica), timeout)
+            except Exception as e:
+                print(f"Replica {replica.url.host} is unavailable: {e!r}")
+                continue
+            if lag > self.max_lag:
+                print(f"Replica {replica.url.host} is {lag:.1f}s behind, skipping it")
+                continue
+            healthy.append(replica)
+        self._healthy = healthy
+
+
+replica_set = ReplicaSet(
+    engine,
+    [create_async_engine(url, future=True, echo=True) for url in REPLICA_URLS],
+    REPLICA_MAX_LAG,
+)
+
+
+def read_session() -> AsyncSession:
+    """
+    Session on a read replica, for reads that don't need the latest writes.
+    Writes, and reads that must see them, use async_session on the primary.
+    """
+    return AsyncSession(replica_set.engine(), expire_on_commit=False)
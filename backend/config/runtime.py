@@ -0,0 +1,66 @@
+import os
+
+
+def cpu_quota() -> int:
+    """
+    Number of CPUs this container is allowed to use.
+    Reads the cgroup CPU quota (v2, then v1) and falls back to the CPU affinity mask.
+    """
+    quota_files = [
+        ("/sys/fs/cgroup/cpu.max", None),
+        (
+            "/sys/fs/cgroup/cpu/cpu.cfs_quota_us",
+            "/sys/fs/cgroup/cpu/cpu.cfs_period_us",
+        ),
+    ]
+    for quota_file, period_file in quota_files:
+        try:
+            with open(quota_file) as f:
+                values = f.read().split()
+            if period_file is not None:
+                with open(period_file) as f:
+                    values.append(f.read().strip())
+            quota, period = values[0], values[1]
+            if quota in ("max", "-1"):
+                break
+            return max(1, int(quota) // int(period))
+        except (OSError, ValueError, IndexError):
+            continue
+    return len(os.sched_getaffinity(0))
+
+
+# Runtime topology, every value can be overridden through the environment
+CPU_COUNT = cpu_quota()
+# Number of server worker processes
+WORKERS = int(os.environ.get("WEB_WORKERS", 0)) or max(1, CPU_COUNT // 2)
+# Torch intra-op threads per worker, defaults to an even share of the CPUs
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0)) or max(1, CPU_COUNT // WORKERS)
+# Torch inter-op threads per worker, the model has no parallel branches to run
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 1))
+# Pin each worker to its own set of CPUs
+CPU_PINNING = os.environ.get("CPU_PINNING", "0") == "1"
+# Load the model weights once in the master process and share them with the workers
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "1") == "1"
+# Restart a worker after it served this many requests, 0 never restarts it.
+# The jitter spreads the restarts of the workers over that many more requests.
+WORKER_MAX_REQUESTS = int(os.environ.get("WORKER_MAX_REQUESTS", 0))
+WORKER_MAX_REQUESTS_JITTER = int(
+    os.environ.get("WORKER_MAX_REQUESTS_JITTER", WORKER_MAX_REQUESTS // 10)
+)
+# Seconds a restarting worker has to finish the requests in flight
+WORKER_GRACEFUL_TIMEOUT = int(os.environ.get("WORKER_GRACEFUL_TIMEOUT", 30))
+
+
+def worker_cpus(index: int) -> set:
+    """CPUs assigned to the worker with the given index when pinning is enabled"""
+    cpus = sorted(os.sched_getaffinity(0))
+    start = (index % WORKERS) * TORCH_THREADS % len(cpus)
+    return {cpus[(start + i) % len(cpus)] for i in range(TORCH_THREADS)}
+
+
+def configure_torch() -> None:
+    """Apply the thread settings to torch, must run before the model is used"""
+    import torch
+
+    torch.set_num_threads(TORCH_THREADS)
+    torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
@@ -73,10 +73,163 @@ ATTN_N_LAYERS = 2
 N_HEADS = 2
 BIDIRECTIONAL = False
 DROPOUT = 0.5
+# Number of query rows processed at once by the attention layers.
+# Keeps the attention matrix at (ATTN_CHUNK_SIZE x L) instead of (L x L).
+ATTN_CHUNK_SIZE = 512
+
+# Pretrained weights
+MODEL_WEIGHTS_PATH = os.environ.get(
+    "MODEL_WEIGHTS_PATH", "model/pretrained_weights/osuclasification_best.pt"
+)
+
+# Distilled classifier, see distill.py
+STUDENT_WEIGHTS_PATH = os.environ.get(
+    "STUDENT_WEIGHTS_PATH", "model/pretrained_weights/student.pt"
+)
+# Model used by /predict: "full", "fast" (the distilled classifier) or "cascade"
+# (the distilled classifier, then the full model when it is uncertain)
+PREDICT_TIER = os.environ.get("PREDICT_TIER", "full")
+PREDICT_TIERS = ["full", "fast", "cascade"]
+# The cascade is uncertain when a class probability is this close to 0.5
+CASCADE_MARGIN = float(os.environ.get("CASCADE_MARGIN", 0.2))
+
+# Seconds between checks for a newly activated model version
+MODEL_POLL_INTERVAL = float(os.environ.get("MODEL_POLL_INTERVAL", 30))
+# Beatmaps predicted by an older model version are re-scored by the idle
+# prediction workers, a batch at a time with a pause in between
+RESCORE_BATCH_SIZE = int(os.environ.get("RESCORE_BATCH_SIZE", 16))
+RESCORE_INTERVAL = float(os.environ.get("RESCORE_INTERVAL", 1))
+
+# Key required by the /admin routes, they are disabled when it is not set
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")
+
+# Similar beatmaps index
+EMBEDDING_INDEX_PATH = os.environ.get("EMBEDDING_INDEX_PATH", "data/embeddings")
+# Seconds between refreshes of the index from the database
+EMBEDDING_REFRESH_INTERVAL = 60
+# Partition the index (IVF) once it holds this many beatmaps
+EMBEDDING_IVF_MIN_SIZE = 50000
+EMBEDDING_IVF_LISTS = 256
+EMBEDDING_IVF_PROBE = 8
+
+# Model inputs of every predicted beatmap, used to re-score without parsing
+FEATURE_STORE_PATH = os.environ.get("FEATURE_STORE_PATH", "data/features")
+# Compressed entries are smaller, uncompressed ones are memory-mapped on read
+FEATURE_STORE_COMPRESS = os.environ.get("FEATURE_STORE_COMPRESS", "1") == "1"
+
+# Beatmap search
+SEARCH_MIN_LENGTH = 3
+SEARCH_SIMILARITY_THRESHOLD = 0.5
+
+# Prediction jobs
+# Seconds between polls of the queue when it is empty
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 0.5))
+# Number of jobs claimed at once by a worker
+JOB_BATCH_SIZE = int(os.environ.get("JOB_BATCH_SIZE", 8))
+# Seconds after which a running job is considered abandoned and claimed again
+JOB_TIMEOUT = 300
+JOB_MAX_ATTEMPTS = 3
+# Longest pause of a worker after consecutive errors, the pause doubles from
+# JOB_POLL_INTERVAL with each error
+JOB_ERROR_BACKOFF = float(os.environ.get("JOB_ERROR_BACKOFF", 60))
+
+# Admission control for /predict
+# Uploads per second allowed for each client, and how many can be sent at once
+PREDICT_RATE = float(os.environ.get("PREDICT_RATE", 0.2))
+PREDICT_BURST = int(os.environ.get("PREDICT_BURST", 5))
+# API keys with their own rate limit bucket, comma separated. Other keys are
+# ignored and the client is limited by its address.
+API_KEYS = {key for key in os.environ.get("API_KEYS", "").split(",") if key}
+# Proxies in front of the API appending to X-Forwarded-For (1 behind the ingress).
+# The client address is the one the outermost of them appended, 0 ignores the header.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+# "memory" limits each worker on its own, "postgres" shares the limits between replicas
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+# Predictions running at once per worker, and how long a request may wait for one
+PREDICT_MAX_INFLIGHT = int(os.environ.get("PREDICT_MAX_INFLIGHT", 2))
+PREDICT_QUEUE_DEADLINE = float(os.environ.get("PREDICT_QUEUE_DEADLINE", 10))
+
+# RNN states kept per worker to re-predict edited beatmaps incrementally,
+# 0 disables it, see utils.incremental. The cache is part of the worker RSS,
+# keep it a small share of WORKER_MAX_RSS_MB or the workers recycle early.
+INCREMENTAL_CACHE_BYTES = int(os.environ.get("INCREMENTAL_CACHE_BYTES", 64 << 20))
+# Rows between the saved hidden states
+INCREMENTAL_CHECKPOINT_INTERVAL = 256
+
+# Maximum number of beatmap or set IDs in one /beatmaps/batch request
+BATCH_MAX_IDS = 50
+
+# Seconds between writes of the buffered beatmap view counts
+VIEW_FLUSH_INTERVAL = 5
+
+# Live feed of the new predictions served by /beatmaps/feed
+# "memory" only reaches the clients of the same worker, "postgres" shares the
+# feed between the replicas and the prediction workers
+FEED_BACKEND = os.environ.get("FEED_BACKEND", "memory")
+# Events a client may fall behind before it loses the oldest ones
+FEED_QUEUE_SIZE = 64
+FEED_MAX_SUBSCRIBERS = int(os.environ.get("FEED_MAX_SUBSCRIBERS", 10000))
+# Seconds between comments sent to idle clients, so proxies keep the connection
+FEED_KEEPALIVE = 15
+
+# Catalog export served by /beatmaps/export
+# Rows fetched from the database cursor and sent at once
+EXPORT_BATCH_SIZE = 1000
+# Seconds an incremental export goes back before the previous one started, to
+# cover the replica lag and the transactions that were still running
+EXPORT_SYNC_OVERLAP = 60
+
+# Per-request profiling of /predict, see utils.profiling
+# Requests sending the header are profiled when it is enabled, within the limits
+PROFILING = os.environ.get("PROFILING", "0") == "1"
+PROFILE_HEADER = "X-Profile"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "data/profiles")
+# Minimum seconds between two profiles of a worker, and traces kept on disk
+PROFILE_MIN_INTERVAL = float(os.environ.get("PROFILE_MIN_INTERVAL", 60))
+PROFILE_MAX_KEPT = int(os.environ.get("PROFILE_MAX_KEPT", 20))
+
+# Memory instrumentation of the API workers, see utils.memory
+# Trace the Python allocations, slows the allocations down
+MEMORY_TRACING = os.environ.get("MEMORY_TRACING", "0") == "1"
+# Stack frames kept per traced allocation
+MEMORY_TRACE_FRAMES = int(os.environ.get("MEMORY_TRACE_FRAMES", 1))
+# Seconds between the allocation snapshots, and allocators kept from each
+MEMORY_SNAPSHOT_INTERVAL = float(os.environ.get("MEMORY_SNAPSHOT_INTERVAL", 300))
+MEMORY_TOP_ALLOCATORS = 20
+# Restart the worker when its RSS stays above this after trimming the heap,
+# 0 disables it
+WORKER_MAX_RSS = int(os.environ.get("WORKER_MAX_RSS_MB", 0)) << 20
+# Seconds between the RSS checks
+MEMORY_CHECK_INTERVAL = 10
+
+# Catalog statistics served by /stats
+STATS_HISTOGRAM_BUCKETS = 20
+# Maximum number of days of daily counts
+STATS_MAX_DAYS = 365
+
+# Maximum number of hit objects accepted by /predict
+MAX_HIT_OBJECTS = 10000
 
 
 # Database
 DATABASE_URL = f"postgresql+asyncpg://{os.environ['DB_USER']}:{os.environ['DB_PASS']}@{os.environ['DB_HOST']}/{os.environ['DB_NAME']}"
+# Same database for the drivers used directly, e.g. asyncpg for LISTEN
+DATABASE_DSN = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+# Read replicas, comma separated hosts with the same credentials as DB_HOST,
+# e.g. "localhost:5433" for a second local instance
+DB_REPLICA_HOSTS = [
+    host.strip()
+    for host in os.environ.get("DB_REPLICA_HOSTS", "").split(",")
+    if host.strip()
+]
+REPLICA_URLS = [
+    f"postgresql+asyncpg://{os.environ['DB_USER']}:{os.environ['DB_PASS']}@{host}/{os.environ['DB_NAME']}"
+    for host in DB_REPLICA_HOSTS
+]
+# Replicas further behind the primary are not read from, in seconds
+REPLICA_MAX_LAG = float(os.environ.get("REPLICA_MAX_LAG", 5))
+# Seconds between health checks of the replicas
+REPLICA_CHECK_INTERVAL = 5
 
 
 # API Status Code
@@ -86,3 +239,10 @@ class APIStatusCode:
     BEATMAP_TOO_LONG = 2
     BEATMAP_NOT_FOUND = 3
     BEATMAP_UNSUPPORTED = 4
+    MODEL_NOT_READY = 5
+    INVALID_QUERY = 6
+    JOB_NOT_FOUND = 7
+    PREDICTION_FAILED = 8
+    RATE_LIMITED = 9
+    OVERLOADED = 10
+    FORBIDDEN = 11
@@ -0,0 +1,195 @@
+"""
+Distill the classifier into the small model used by the fast /predict tier.
+
+The student learns the class probabilities of the teacher on every beatmap
+with stored features (see utils.features). The teacher probabilities are
+read from the database when the teacher version made them, and computed
+again from the stored features otherwise.
+
+usage: python distill.py [--teacher path/to/weights.pt] [--out path/to/student.pt]
+                         [--epochs N] [--batch-size N] [--val-fraction F]
+"""
+import os
+import asyncio
+import argparse
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import humanize
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from const import *
+from config.db import async_session
+from config.runtime import configure_torch
+from model.db import BeatmapDAL
+from model.loader import build_student, load_version, weights_version
+from utils.features import FeatureStore
+from utils.predict import predict_features
+
+
+async def load_dataset(
+    teacher, teacher_version: str, feature_store: FeatureStore
+) -> Tuple[List[str], np.ndarray]:
+    """
+    Collect the stored beatmaps and their teacher probabilities.
+    :return: (features hashes, (N, NUM_CLASSES) teacher probabilities)
+    """
+    hashes, targets = [], []
+    last_beatmap_id = 0
+    while True:
+        async with async_session() as session:
+            async with session.begin():
+                rows = await BeatmapDAL(session).get_stored_predictions(
+                    last_beatmap_id, 1000
+                )
+        if not rows:
+            break
+        last_beatmap_id = rows[-1]["beatmap_id"]
+
+        for row in rows:
+            if row["features_hash"] not in feature_store:
+                continue
+            if row["model_version"] == teacher_version:
+                probs = [row[f"{label}_p"] for label in LABELS]
+            else:
+                features = feature_store.get(row["features_hash"])
+                map_type, _ = predict_features(teacher, *features)
+                probs = [map_type[label] for label in LABELS]
+            hashes.append(row["features_hash"])
+            targets.append(probs)
+        print(f"Loaded {len(hashes)} beatmaps (last id={last_beatmap_id})")
+    return hashes, np.asarray(targets, dtype=np.float32).reshape(-1, NUM_CLASSES)
+
+
+def collate(feature_store: FeatureStore, hashes: List[str]):
+    """
+    Load the features of a batch, the sequences are padded with zeros.
+    :return: Model inputs (map_info, hit_objects, slider_points, seq_ho, seq_sp)
+    """
+    items = [feature_store.get(h) for h in hashes]
+    seq_ho = [len(hit_objects) for _, hit_objects, _ in items]
+    seq_sp = [len(slider_points) for _, _, slider_points in items]
+    map_info = np.stack([map_info for map_info, _, _ in items])
+    hit_objects = np.zeros(
+        (len(items), max(seq_ho), HIT_OBJECTS_FEATURES), dtype=np.float32
+    )
+    slider_points = np.zeros(
+        (len(items), max(seq_sp), SLIDER_POINTS_FEATURES), dtype=np.float32
+    )
+    for i, (_, ho, sp) in enumerate(items):
+        hit_objects[i, : len(ho)] = ho
+        slider_points[i, : len(sp)] = sp
+    return (
+        torch.from_numpy(map_info),
+        torch.from_numpy(hit_objects),
+        torch.from_numpy(slider_points),
+        seq_ho,
+        seq_sp,
+    )
+
+
+def run_epoch(
+    student,
+    feature_store: FeatureStore,
+    hashes: List[str],
+    targets: np.ndarray,
+    batch_size: int,
+    optimizer=None,
+) -> Dict[str, float]:
+    """
+    Train the student for one epoch, or evaluate it without an optimizer.
+    :return: Loss, mean absolute error and agreement with the teacher
+    """
+    training = optimizer is not None
+    student.train(training)
+    order = np.random.permutation(len(hashes)) if training else np.arange(len(hashes))
+    totals = {"loss": 0.0, "mae": 0.0, "top_class": 0.0, "labels": 0.0}
+    for start in range(0, len(order), batch_size):
+        batch = order[start : start + batch_size]
+        inputs = collate(feature_store, [hashes[i] for i in batch])
+        target = torch.from_numpy(targets[batch])
+        with torch.set_grad_enabled(training):
+            out = student(*inputs)
+            # Soft targets, the student matches the teacher probabilities
+            loss = F.binary_cross_entropy(out, target)
+        if training:
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        out = out.detach()
+        totals["loss"] += loss.item() * len(batch)
+        totals["mae"] += (out - target).abs().mean(dim=1).sum().item()
+        totals["top_class"] += (out.argmax(1) == target.argmax(1)).sum().item()
+        totals["labels"] += ((out > 0.5) == (target > 0.5)).all(1).sum().item()
+    return {name: total / max(len(order), 1) for name, total in totals.items()}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--teacher", default=MODEL_WEIGHTS_PATH)
+    parser.add_argument("--out", default=STUDENT_WEIGHTS_PATH)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--val-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    configure_torch()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    teacher_version, teacher = load_version(args.teacher)
+    feature_store = FeatureStore(FEATURE_STORE_PATH, FEATURE_STORE_COMPRESS)
+
+    start = datetime.now()
+    hashes, targets = await load_dataset(teacher, teacher_version, feature_store)
+    if not hashes:
+        print("No stored features to distill from!")
+        return
+    order = np.random.permutation(len(hashes))
+    n_val = max(1, int(len(order) * args.val_fraction))
+    val, train = order[:n_val], order[n_val:]
+    train_hashes, val_hashes = [hashes[i] for i in train], [hashes[i] for i in val]
+
+    student = build_student()
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr)
+    best_loss, best_state = float("inf"), None
+    for epoch in range(1, args.epochs + 1):
+        train_metrics = run_epoch(
+            student,
+            feature_store,
+            train_hashes,
+            targets[train],
+            args.batch_size,
+            optimizer,
+        )
+        val_metrics = run_epoch(
+            student, feature_store, val_hashes, targets[val], args.batch_size
+        )
+        print(
+            f"epoch {epoch}: train loss {train_metrics['loss']:.4f}, "
+            f"val loss {val_metrics['loss']:.4f}, "
+            f"val mae {val_metrics['mae']:.4f}, "
+            f"val top class agreement {val_metrics['top_class']:.1%}, "
+            f"val label agreement {val_metrics['labels']:.1%}"
+        )
+        if val_metrics["loss"] < best_loss:
+            best_loss = val_metrics["loss"]
+            best_state = {k: v.clone() for k, v in student.state_dict().items()}
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    tmp = f"{args.out}.tmp"
+    torch.save(best_state, tmp)
+    os.replace(tmp, args.out)
+    print(
+        f"Done! Saved student-{weights_version(args.out)} (val loss {best_loss:.4f}) "
+        f"distilled from {teacher_version} in "
+        f"{humanize.precisedelta(datetime.now() - start)}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
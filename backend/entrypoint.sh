@@ -1,4 +1,4 @@
 #!/bin/bash
 
-echo "Starting uvicorn server..."
-uvicorn main:app --host 0.0.0.0
\ No newline at end of file
+echo "Starting gunicorn server..."
+gunicorn main:app -c gunicorn.conf.py
@@ -0,0 +1,55 @@
+# Gunicorn configuration, see config/runtime.py for the environment variables
+import os
+import itertools
+
+from config.runtime import (
+    CPU_PINNING,
+    PRELOAD_MODEL,
+    WORKERS,
+    WORKER_GRACEFUL_TIMEOUT,
+    WORKER_MAX_REQUESTS,
+    WORKER_MAX_REQUESTS_JITTER,
+    worker_cpus,
+)
+
+bind = "0.0.0.0:8000"
+workers = WORKERS
+worker_class = "uvicorn.workers.UvicornWorker"
+# Recycled workers stop accepting connections and finish the requests in flight,
+# the workers also restart themselves above WORKER_MAX_RSS_MB (see main.watch_memory)
+max_requests = WORKER_MAX_REQUESTS
+max_requests_jitter = WORKER_MAX_REQUESTS_JITTER
+graceful_timeout = WORKER_GRACEFUL_TIMEOUT
+
+
+def on_starting(server):
+    # Slots of the live workers, a worker keeps its slot (and its CPUs) for its
+    # whole life and the slot is reused once it exits
+    server.worker_slots = set()
+    if PRELOAD_MODEL:
+        import torch
+
+        # Keep the master single threaded, thread pools don't survive a fork
+        torch.set_num_threads(1)
+
+        from model.loader import load_model
+
+        load_model()
+        server.log.info("Model weights loaded in shared memory")
+
+
+def pre_fork(server, worker):
+    # A replacement started while the previous worker drains gets another slot
+    worker.slot = next(i for i in itertools.count() if i not in server.worker_slots)
+    server.worker_slots.add(worker.slot)
+
+
+def post_fork(server, worker):
+    if CPU_PINNING:
+        cpus = worker_cpus(worker.slot)
+        os.sched_setaffinity(0, cpus)
+        server.log.info(f"Worker {worker.pid} pinned to CPUs {sorted(cpus)}")
+
+
+def child_exit(server, worker):
+    server.worker_slots.discard(worker.slot)
@@ -1,10 +1,17 @@
+import os
+import hmac
+import math
+import signal
+import asyncio
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 import sqlalchemy
-import torch
 import humanize
+from typing import Optional
 from pathlib import Path
-from aiofiles import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from starlette.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.middleware.cors import CORSMiddleware
@@ -14,18 +21,74 @@ from const import *
 from model.api import (
     DefaultResponse,
     ExceptionResponse,
+    Response,
+    BeatmapList,
+    BeatmapSetDetail,
+    BeatmapPreview,
+    BeatmapDetail,
+    BeatmapBatch,
+    BeatmapRanking,
+    BeatmapSearch,
+    BeatmapSimilarList,
+    Prediction,
+    PredictionJob,
+    ModelInfo,
+    CatalogStats,
+    MemoryReport,
 )
 from model.exceptions import (
     InvalidFileTypeException,
     InvalidFileException,
     BeatmapTooLongException,
     BeatmapUnsupportedException,
+    ModelNotReadyException,
+    InvalidQueryException,
+    RateLimitedException,
+    OverloadedException,
+    ForbiddenException,
+)
+from utils.beatmap import parse_beatmap
+from utils.query import parse_class_filters, parse_ids, encode_cursor, decode_cursor
+from utils.knn import (
+    EmbeddingIndex,
+    encode_embedding,
+    decode_embedding,
+    partition,
+    snapshot_path,
+)
+from utils.features import FeatureStore, content_hash
+from utils.singleflight import SingleFlight, ViewCounter
+from utils.export import EXPORT_FORMATS
+from utils.memory import MemoryTracker, rss_bytes, trim_heap
+from utils.profiling import (
+    RequestProfiler,
+    install_sql_timing,
+    profile_python,
+    profile_span,
+    profile_torch,
+)
+from utils.feed import (
+    Broadcaster,
+    InMemoryFeedBackend,
+    PostgresFeedBackend,
+    feed_event,
+)
+from utils.limiter import (
+    AdmissionController,
+    InMemoryRateLimitBackend,
+    PostgresRateLimitBackend,
+    RateLimiter,
+)
+from config.db import engine, async_session, read_session, replica_set
+from config.runtime import configure_torch
+from model.db import (
+    BeatmapDAL as BeatmapDBDAL,
+    ModelVersionDAL,
+    PredictionJobDAL,
+    StatsDAL,
+    JobStatus,
+    init_db,
 )
-from model.classifier import OsuClassifier
-from utils.beatmap import Beatmap
-from utils.predict import predict_map_type
-from config.db import engine, async_session
-from model.db import Beatmap as BeatmapDB, BeatmapDAL as BeatmapDBDAL
 
 
 # API init
@@ -41,6 +104,10 @@ tags_metadata = [
         "name": "beatmaps",
         "description": "Beatmap information, such as beatmap ID, title, creator, etc. Also includes the predictions!",
     },
+    {
+        "name": "stats",
+        "description": "Statistics of the predicted beatmaps.",
+    },
 ]
 app = FastAPI(
     title="OsuClassy",
@@ -59,6 +126,7 @@ app = FastAPI(
     root_path="/",
     docs_url=None,
     redoc_url=None,
+    default_response_class=ORJSONResponse,
 )
 app.add_middleware(
     CORSMiddleware,
@@ -77,36 +145,273 @@ async def custom_docs_html():
     )
 
 
-# Classification Model
-classification_model = OsuClassifier(
-    MAP_INFO_FEATURES,
-    HIT_OBJECTS_FEATURES,
-    SLIDER_POINTS_FEATURES,
-    NUM_CLASSES,
-    hidden_size=HIDDEN_SIZE,
-    key_size=KEY_SIZE,
-    value_size=VALUE_SIZE,
-    n_layers=N_LAYERS,
-    attn_n_layers=ATTN_N_LAYERS,
-    n_heads=N_HEADS,
-    bidirectional=BIDIRECTIONAL,
-    dropout=DROPOUT,
-)
-classification_model.eval()
-classification_model.load_state_dict(
-    torch.load(
-        "model/pretrained_weights/osuclasification_best.pt",
-        map_location=torch.device("cpu"),
+# Startup
+async def prepare():
+    """
+    Load and warm up the model, then make sure the database tables exist and
+    switch to the model version active in the database. Runs in the background
+    so the health endpoints and the database reads answer during startup, torch
+    is only imported here.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        loader = await loop.run_in_executor(
+            None, importlib.import_module, "model.loader"
+        )
+        # Inference runs on its own thread, so the threads are set from there
+        inference = app.state.inference_executor
+        await loop.run_in_executor(inference, configure_torch)
+        model_version, model = await loop.run_in_executor(
+            None, loader.load_version, MODEL_WEIGHTS_PATH
+        )
+        await loop.run_in_executor(inference, loader.warm_up, model)
+        if PREDICT_TIER != "full":
+            try:
+                _, student = await loop.run_in_executor(
+                    None, loader.load_student, STUDENT_WEIGHTS_PATH
+                )
+                await loop.run_in_executor(inference, loader.warm_up, student)
+            except Exception as e:
+                # The full model still answers every tier
+                print(f"Failed to load the distilled model: {e}")
+        if INCREMENTAL_CACHE_BYTES:
+            from utils.incremental import IncrementalPredictor
+
+            app.state.incremental = IncrementalPredictor(
+                INCREMENTAL_CACHE_BYTES, INCREMENTAL_CHECKPOINT_INTERVAL
+            )
+    except Exception as e:
+        print(f"Failed to load the model: {e}")
+        app.state.failed = True
+        return
+
+    while True:
+        try:
+            # create db tables
+            async with engine.begin() as conn:
+                await conn.run_sync(init_db)
+            async with async_session() as session:
+                async with session.begin():
+                    await ModelVersionDAL(session).register(
+                        model_version, MODEL_WEIGHTS_PATH
+                    )
+            break
+        except Exception as e:
+            print(f"Failed to create database tables, retrying: {e}")
+            await asyncio.sleep(5)
+    # Another version may be active already, the loaded weights only predict
+    # once they are known to be the active ones
+    try:
+        await sync_model_version(loader)
+    except Exception as e:
+        print(f"Failed to switch the model version: {e}")
+    app.state.model_ready = True
+    app.state.db_ready = True
+    await asyncio.gather(refresh_embedding_index(), watch_model_version(loader))
+
+
+async def watch_model_version(loader):
+    """
+    Switch to the model version activated in the database.
+    The new weights are loaded and warmed up next to the current model,
+    which keeps serving the predictions until the switch.
+    """
+    while True:
+        await asyncio.sleep(MODEL_POLL_INTERVAL)
+        try:
+            await sync_model_version(loader)
+        except Exception as e:
+            print(f"Failed to switch the model version: {e}")
+
+
+async def sync_model_version(loader) -> None:
+    """
+    Switch to the model version active in the database, if another one is loaded.
+    """
+    async with async_session() as session:
+        async with session.begin():
+            active = await ModelVersionDAL(session).get_active()
+    if active is None or active.version == loader.get_active_model()[0]:
+        return
+    switched = await asyncio.get_running_loop().run_in_executor(
+        None, loader.switch_model, active.version, active.weights_path
     )
-)
+    if switched:
+        print(f"Switched to model {active.version}")
+    else:
+        print(f"Weights {active.weights_path} don't match model {active.version}")
+
+
+async def refresh_embedding_index():
+    """
+    Keep the similar beatmaps index in sync with the database.
+    Starts from the snapshot if there is one, then periodically adds the
+    embeddings written by the other workers.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        index = await loop.run_in_executor(
+            None,
+            EmbeddingIndex.load,
+            EMBEDDING_INDEX_PATH,
+            HIDDEN_SIZE,
+            EMBEDDING_IVF_PROBE,
+        )
+        mtime = os.path.getmtime(snapshot_path(EMBEDDING_INDEX_PATH))
+        updated_since = datetime.fromtimestamp(mtime, timezone.utc)
+    except (OSError, ValueError):
+        index = EmbeddingIndex(HIDDEN_SIZE, n_probe=EMBEDDING_IVF_PROBE)
+        updated_since = None
+    app.state.embedding_index = index
+
+    while True:
+        refreshed_at = datetime.now(timezone.utc)
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    rows = await BeatmapDBDAL(session).get_embeddings(updated_since)
+            if rows:
+                index.add_many(
+                    [beatmap_id for beatmap_id, _ in rows],
+                    [decode_embedding(embedding) for _, embedding in rows],
+                )
+            updated_since = refreshed_at
+            if not index.trained and len(index) >= EMBEDDING_IVF_MIN_SIZE:
+                # k-means on a copy in a thread, the index is only changed here
+                vectors = index.copy_vectors()
+                partitions = await loop.run_in_executor(
+                    None, partition, vectors, EMBEDDING_IVF_LISTS
+                )
+                if partitions is not None:
+                    index.set_partitions(*partitions, vectors)
+        except Exception as e:
+            print(f"Failed to refresh the embedding index: {e}")
+        await asyncio.sleep(EMBEDDING_REFRESH_INTERVAL)
+
 
-# Startup
 @app.on_event("startup")
 async def startup():
-    # create db tables
-    async with engine.begin() as conn:
-        # await conn.run_sync(BeatmapDB.metadata.drop_all)
-        await conn.run_sync(BeatmapDB.metadata.create_all)
+    app.state.model_ready = False
+    app.state.db_ready = False
+    app.state.failed = False
+    app.state.embedding_index = EmbeddingIndex(
+        HIDDEN_SIZE, n_probe=EMBEDDING_IVF_PROBE
+    )
+    app.state.rate_limiter = RateLimiter(
+        PostgresRateLimitBackend(async_session)
+        if RATE_LIMIT_BACKEND == "postgres"
+        else InMemoryRateLimitBackend(),
+        PREDICT_RATE,
+        PREDICT_BURST,
+    )
+    app.state.admission = AdmissionController(
+        PREDICT_MAX_INFLIGHT, PREDICT_QUEUE_DEADLINE
+    )
+    app.state.feature_store = FeatureStore(FEATURE_STORE_PATH, FEATURE_STORE_COMPRESS)
+    # A single thread, inference already uses TORCH_THREADS and the RNN cache
+    # is only touched from there
+    app.state.inference_executor = ThreadPoolExecutor(1, "inference")
+    app.state.incremental = None
+    app.state.single_flight = SingleFlight()
+    app.state.view_counter = ViewCounter()
+    app.state.feed = Broadcaster(
+        PostgresFeedBackend(async_session, DATABASE_DSN)
+        if FEED_BACKEND == "postgres"
+        else InMemoryFeedBackend(),
+        FEED_QUEUE_SIZE,
+        FEED_MAX_SUBSCRIBERS,
+    )
+    app.state.prepare_task = asyncio.create_task(prepare())
+    app.state.view_flush_task = asyncio.create_task(flush_views())
+    app.state.replica_task = asyncio.create_task(check_replicas())
+    app.state.feed_task = asyncio.create_task(app.state.feed.run())
+    app.state.profiler = RequestProfiler(
+        PROFILE_DIR, PROFILING, PROFILE_MIN_INTERVAL, PROFILE_MAX_KEPT
+    )
+    if PROFILING:
+        install_sql_timing(engine.sync_engine)
+    app.state.memory = MemoryTracker(
+        MEMORY_TRACING, MEMORY_TRACE_FRAMES, MEMORY_TOP_ALLOCATORS
+    )
+    app.state.memory_task = asyncio.create_task(watch_memory())
+
+
+async def check_replicas():
+    """
+    Periodically check the read replicas, reads fail over to the healthy ones.
+    """
+    if not replica_set.replicas:
+        return
+    while True:
+        await replica_set.check()
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+
+async def watch_memory():
+    """
+    Periodically take the allocation snapshots, and restart the worker when its
+    memory stays above WORKER_MAX_RSS. Gunicorn replaces it, and the worker
+    stops accepting connections and finishes the requests in flight before exiting.
+    """
+    loop = asyncio.get_running_loop()
+    tracker = app.state.memory
+    next_snapshot = loop.time() + MEMORY_SNAPSHOT_INTERVAL
+    while True:
+        await asyncio.sleep(MEMORY_CHECK_INTERVAL)
+        if tracker.tracing and loop.time() >= next_snapshot:
+            next_snapshot = loop.time() + MEMORY_SNAPSHOT_INTERVAL
+            try:
+                await loop.run_in_executor(None, tracker.snapshot)
+            except Exception as e:
+                print(f"Failed to take the allocation snapshot: {e}")
+        if not WORKER_MAX_RSS or rss_bytes() <= WORKER_MAX_RSS:
+            continue
+        # Fragmentation alone may be what keeps the RSS up
+        trim_heap()
+        rss = rss_bytes()
+        if rss > WORKER_MAX_RSS:
+            print(
+                f"Worker RSS is {humanize.naturalsize(rss, binary=True)}, over "
+                f"{humanize.naturalsize(WORKER_MAX_RSS, binary=True)}, restarting it"
+            )
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+
+async def write_views(counts):
+    async with async_session() as session:
+        async with session.begin():
+            await BeatmapDBDAL(session).add_views(counts)
+
+
+async def flush_views():
+    """
+    Periodically write the view counts buffered by the beatmap route.
+    """
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_INTERVAL)
+        try:
+            await app.state.view_counter.flush(write_views)
+        except Exception as e:
+            print(f"Failed to write the view counts: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.prepare_task.cancel()
+    app.state.view_flush_task.cancel()
+    app.state.replica_task.cancel()
+    app.state.feed_task.cancel()
+    app.state.memory_task.cancel()
+    app.state.inference_executor.shutdown(wait=False)
+    try:
+        await app.state.view_counter.flush(write_views)
+    except Exception as e:
+        print(f"Failed to write the view counts: {e}")
+    index = app.state.embedding_index
+    if len(index):
+        os.makedirs(os.path.dirname(EMBEDDING_INDEX_PATH) or ".", exist_ok=True)
+        index.save(EMBEDDING_INDEX_PATH)
 
 
 # Exceptions Handler
@@ -145,7 +450,7 @@ async def beatmap_too_long_handler(
         content=jsonable_encoder(
             ExceptionResponse(
                 code=APIStatusCode.BEATMAP_TOO_LONG,
-                reason="Beatmap is too long. To reduce memory usage, beatmaps are limited to only under 3000 hit objects.",
+                reason=f"Beatmap is too long. To reduce memory usage, beatmaps are limited to only under {MAX_HIT_OBJECTS} hit objects.",
             )
         ),
     )
@@ -166,6 +471,142 @@ async def beatmap_unsupported_handler(
     )
 
 
+@app.exception_handler(ModelNotReadyException)
+async def model_not_ready_handler(
+    request: FastAPIRequest, exc: ModelNotReadyException
+):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": "5"},
+        content=jsonable_encoder(
+            ExceptionResponse(
+                code=APIStatusCode.MODEL_NOT_READY,
+                reason="Model is still loading. Please try again in a moment.",
+            )
+        ),
+    )
+
+
+@app.exception_handler(InvalidQueryException)
+async def invalid_query_handler(request: FastAPIRequest, exc: InvalidQueryException):
+    return JSONResponse(
+        status_code=400,
+        content=jsonable_encoder(
+            ExceptionResponse(
+                code=APIStatusCode.INVALID_QUERY,
+                reason=exc.reason
+                or "Invalid query. Filters look like 'stream>0.8,tech<0.2' and classes must be one of: "
+                + ", ".join(LABELS),
+            )
+        ),
+    )
+
+
+@app.exception_handler(RateLimitedException)
+async def rate_limited_handler(request: FastAPIRequest, exc: RateLimitedException):
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+        content=jsonable_encoder(
+            ExceptionResponse(
+                code=APIStatusCode.RATE_LIMITED,
+                reason="Too many beatmaps uploaded. Please slow down.",
+            )
+        ),
+    )
+
+
+@app.exception_handler(OverloadedException)
+async def overloaded_handler(request: FastAPIRequest, exc: OverloadedException):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+        content=jsonable_encoder(
+            ExceptionResponse(
+                code=APIStatusCode.OVERLOADED,
+                reason="Server is busy predicting other beatmaps. Please try again later.",
+            )
+        ),
+    )
+
+
+@app.exception_handler(ForbiddenException)
+async def forbidden_handler(request: FastAPIRequest, exc: ForbiddenException):
+    return JSONResponse(
+        status_code=403,
+        content=jsonable_encoder(
+            ExceptionResponse(
+                code=APIStatusCode.FORBIDDEN,
+                reason="Invalid admin key.",
+            )
+        ),
+    )
+
+
+def check_admin(request: FastAPIRequest) -> None:
+    """
+    Raise ForbiddenException unless the request has the admin key.
+    """
+    key = request.headers.get("X-Admin-Key", "")
+    if not ADMIN_API_KEY or not hmac.compare_digest(key, ADMIN_API_KEY):
+        raise ForbiddenException()
+
+
+def client_key(request: FastAPIRequest) -> str:
+    """
+    Key identifying a client for rate limiting, the API key if it is a known one,
+    else the IP address.
+    """
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in API_KEYS:
+        return f"key:{api_key}"
+    # The first hops are sent by the client, only the ones appended by our
+    # proxies can be trusted
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and TRUSTED_PROXIES:
+        hops = [hop.strip() for hop in forwarded.split(",")]
+        if len(hops) >= TRUSTED_PROXIES:
+            return f"ip:{hops[-TRUSTED_PROXIES]}"
+    return f"ip:{request.client.host}"
+
+
+def respond(code: int, message: str, data=None) -> ORJSONResponse:
+    """
+    Build the response body directly.
+    The data is already shaped like the route's response model, so returning a
+    response skips the model validation and the body is encoded by orjson.
+    """
+    return ORJSONResponse({"code": code, "message": message, "data": data})
+
+
+# Health checks
+@app.get("/health/live", include_in_schema=False)
+async def liveness():
+    """
+    The process is alive as long as the event loop answers and the model didn't fail to load.
+    """
+    if app.state.failed:
+        return JSONResponse(status_code=503, content={"status": "failed"})
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness():
+    """
+    Ready once the model is warmed up and the database is reachable.
+    """
+    if not (app.state.model_ready and app.state.db_ready):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(sqlalchemy.text("SELECT 1"))
+    except Exception:
+        return JSONResponse(
+            status_code=503, content={"status": "database unavailable"}
+        )
+    return {"status": "ready"}
+
+
 # API Routes
 @app.get("/", response_model=DefaultResponse, include_in_schema=False)
 async def root():
@@ -175,7 +616,7 @@ async def root():
     )
 
 
-@app.get("/beatmaps", tags=["beatmaps"], response_model=DefaultResponse)
+@app.get("/beatmaps", tags=["beatmaps"], response_model=Response[BeatmapList])
 async def get_beatmaps(limit: int = 10, page: int = 1):
     """
     Get recently updated beatmaps.
@@ -189,17 +630,17 @@ async def get_beatmaps(limit: int = 10, page: int = 1):
     offset = limit * (page - 1)
     offset = offset if offset >= 0 else 0
 
-    async with async_session() as session:
+    async with read_session() as session:
         async with session.begin():
             beatmaps = await BeatmapDBDAL(session).get_beatmaps(limit, offset)
-            return DefaultResponse(
+            return respond(
                 code=APIStatusCode.SUCCESS,
                 message="Successfully retrieved all beatmaps!",
                 data={"beatmaps": beatmaps},
             )
 
 
-@app.get("/beatmaps/recent", tags=["beatmaps"], response_model=DefaultResponse)
+@app.get("/beatmaps/recent", tags=["beatmaps"], response_model=Response[BeatmapList])
 async def get_beatmaps_recent(limit: int = 10, page: int = 1):
     """
     Get recently created beatmaps.
@@ -213,17 +654,17 @@ async def get_beatmaps_recent(limit: int = 10, page: int = 1):
     offset = limit * (page - 1)
     offset = offset if offset >= 0 else 0
 
-    async with async_session() as session:
+    async with read_session() as session:
         async with session.begin():
             beatmaps = await BeatmapDBDAL(session).get_beatmaps_recent(limit, offset)
-            return DefaultResponse(
+            return respond(
                 code=APIStatusCode.SUCCESS,
                 message="Successfully retrieved recently created beatmaps!",
                 data={"beatmaps": beatmaps},
             )
 
 
-@app.get("/beatmaps/popular", tags=["beatmaps"], response_model=DefaultResponse)
+@app.get("/beatmaps/popular", tags=["beatmaps"], response_model=Response[BeatmapList])
 async def get_beatmaps_popular(limit: int = 10, page: int = 1):
     """
     Get popular beatmaps.
@@ -237,58 +678,276 @@ async def get_beatmaps_popular(limit: int = 10, page: int = 1):
     offset = limit * (page - 1)
     offset = offset if offset >= 0 else 0
 
-    async with async_session() as session:
+    async with read_session() as session:
         async with session.begin():
             beatmaps = await BeatmapDBDAL(session).get_beatmaps_popular(limit, offset)
-            return DefaultResponse(
+            return respond(
                 code=APIStatusCode.SUCCESS,
                 message="Successfully retrieved popular beatmaps!",
                 data={"beatmaps": beatmaps},
             )
 
 
-@app.get("/beatmaps/preview", tags=["beatmaps"], response_model=DefaultResponse)
+@app.get(
+    "/beatmaps/preview",
+    tags=["beatmaps"],
+    response_model=Response[BeatmapPreview],
+)
 async def get_beatmaps_preview():
     """
     Get six beatmaps for each category (popular, recently uploaded, recently updated).
     """
-    async with async_session() as session:
+
+    async def fetch():
+        async with read_session() as session:
+            async with session.begin():
+                return await BeatmapDBDAL(session).get_beatmaps_preview()
+
+    beatmaps = await app.state.single_flight.do(("preview",), fetch)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved preview beatmaps!",
+        data=beatmaps,
+    )
+
+
+@app.get(
+    "/beatmaps/classes",
+    tags=["beatmaps"],
+    response_model=Response[BeatmapRanking],
+)
+async def get_beatmaps_by_class(
+    sort: str = "stream",
+    filters: Optional[str] = None,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+):
+    """
+    Get beatmaps ranked by a predicted class probability.
+
+    - **sort**: Class to rank by, highest probability first.
+    - **filters**: Comma separated class filters, e.g. `stream>0.8,tech<0.2`.
+    - **limit**: Number of beatmaps to return.
+    - **cursor**: `next_cursor` from the previous page.
+    """
+    if sort not in LABELS:
+        raise InvalidQueryException()
+    filters = parse_class_filters(filters)
+    # Clamp the value to be between 1 and 25
+    limit = min(max(limit, 1), 25)
+
+    async with read_session() as session:
         async with session.begin():
-            beatmaps = await BeatmapDBDAL(session).get_beatmaps_preview()
-            return DefaultResponse(
+            beatmaps = await BeatmapDBDAL(session).get_beatmaps_by_class(
+                sort, filters, limit, decode_cursor(cursor)
+            )
+            next_cursor = None
+            if len(beatmaps) == limit:
+                last = beatmaps[-1]
+                next_cursor = encode_cursor(last[f"{sort}_p"], last["beatmap_id"])
+            return respond(
                 code=APIStatusCode.SUCCESS,
-                message="Successfully retrieved preview beatmaps!",
-                data=beatmaps,
+                message="Successfully retrieved beatmaps!",
+                data={"beatmaps": beatmaps, "next_cursor": next_cursor},
             )
 
 
+@app.get("/beatmaps/search", tags=["beatmaps"], response_model=Response[BeatmapSearch])
+async def search_beatmaps(q: str, limit: int = 10, cursor: Optional[str] = None):
+    """
+    Search beatmaps by artist, title, creator and version.
+    Partially typed words and small typos still match.
+
+    - **q**: Search query.
+    - **limit**: Number of beatmaps to return.
+    - **cursor**: `next_cursor` from the previous page.
+    """
+    q = q.strip()
+    if len(q) < SEARCH_MIN_LENGTH:
+        raise InvalidQueryException(
+            f"Search query must be at least {SEARCH_MIN_LENGTH} characters long."
+        )
+    # Clamp the value to be between 1 and 25
+    limit = min(max(limit, 1), 25)
+
+    async with read_session() as session:
+        async with session.begin():
+            beatmaps = await BeatmapDBDAL(session).search_beatmaps(
+                q, limit, decode_cursor(cursor), SEARCH_SIMILARITY_THRESHOLD
+            )
+            next_cursor = None
+            if len(beatmaps) == limit:
+                last = beatmaps[-1]
+                next_cursor = encode_cursor(last["score"], last["beatmap_id"])
+            return respond(
+                code=APIStatusCode.SUCCESS,
+                message="Successfully searched beatmaps!",
+                data={"beatmaps": beatmaps, "next_cursor": next_cursor},
+            )
+
+
+@app.get("/beatmaps/batch", tags=["beatmaps"], response_model=Response[BeatmapBatch])
+async def get_beatmaps_batch(
+    ids: Optional[str] = None,
+    set_ids: Optional[str] = None,
+    count_views: bool = True,
+):
+    """
+    Get many beatmaps with their predictions in one request.
+
+    - **ids**: Comma separated beatmap IDs, e.g. `123,456`.
+    - **set_ids**: Comma separated beatmap set IDs, all their beatmaps are returned.
+    - **count_views**: Count a view of each returned beatmap.
+    """
+    beatmap_ids = parse_ids(ids, BATCH_MAX_IDS)
+    beatmapset_ids = parse_ids(set_ids, BATCH_MAX_IDS)
+    if not beatmap_ids and not beatmapset_ids:
+        raise InvalidQueryException("At least one beatmap or set ID is required.")
+
+    async def read(session_factory):
+        async with session_factory() as session:
+            async with session.begin():
+                return await BeatmapDBDAL(session).get_beatmaps_batch(
+                    beatmap_ids, beatmapset_ids
+                )
+
+    beatmaps = await read(read_session)
+    found = {beatmap["beatmap_id"] for beatmap in beatmaps}
+    if replica_set.replicas and any(i not in found for i in beatmap_ids):
+        # Read your writes, a beatmap just predicted may not be replicated yet
+        beatmaps = await read(async_session)
+        found = {beatmap["beatmap_id"] for beatmap in beatmaps}
+    if count_views:
+        # Buffered, written with the other views in one statement
+        for beatmap in beatmaps:
+            app.state.view_counter.add(beatmap["beatmap_id"])
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved beatmaps!",
+        data={
+            "beatmaps": beatmaps,
+            "missing": [i for i in beatmap_ids if i not in found],
+        },
+    )
+
+
+@app.get("/beatmaps/feed", tags=["beatmaps"])
+async def get_beatmap_feed():
+    """
+    Live feed of the predictions, as Server-Sent Events.
+    A `created` event is sent for each newly predicted beatmap, and an `updated`
+    event when a beatmap is predicted again. The data of both is the beatmap
+    with its predictions, as JSON.
+    """
+    feed = app.state.feed
+    if feed.full:
+        raise OverloadedException(FEED_KEEPALIVE)
+
+    async def stream():
+        async with feed.subscribe() as queue:
+            # Reconnect after 5s when the connection is lost
+            yield b"retry: 5000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # Sent as they come, not buffered by nginx
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/beatmaps/export", tags=["beatmaps"])
+async def export_beatmaps(
+    format: str = "ndjson", updated_since: Optional[datetime] = None
+):
+    """
+    Stream every beatmap with its predictions, in beatmap ID order.
+    The `X-Next-Updated-Since` response header is the `updated_since` of the
+    next incremental export, the rows near that time may be sent twice.
+
+    - **format**: `ndjson` or `csv`.
+    - **updated_since**: Only export beatmaps updated after this time (ISO 8601, UTC if no timezone).
+    """
+    if format not in EXPORT_FORMATS:
+        raise InvalidQueryException(
+            f"Format must be one of {', '.join(EXPORT_FORMATS)}."
+        )
+    if updated_since is not None and updated_since.tzinfo is None:
+        updated_since = updated_since.replace(tzinfo=timezone.utc)
+    encode, media_type = EXPORT_FORMATS[format]
+    next_updated_since = datetime.now(timezone.utc) - timedelta(
+        seconds=EXPORT_SYNC_OVERLAP
+    )
+
+    async def stream():
+        header = True
+        async with read_session() as session:
+            async with session.begin():
+                batches = BeatmapDBDAL(session).stream_beatmaps(
+                    updated_since, EXPORT_BATCH_SIZE
+                )
+                async for rows in batches:
+                    yield encode(rows, header)
+                    header = False
+
+    # No content length, the rows are sent with chunked transfer encoding
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename=beatmaps.{format}",
+            "X-Next-Updated-Since": next_updated_since.isoformat(),
+        },
+    )
+
+
 @app.get(
     "/beatmaps/{beatmapset_id}",
     tags=["beatmaps"],
-    response_model=DefaultResponse,
+    response_model=Response[BeatmapSetDetail],
 )
 async def get_beatmap_by_set(beatmapset_id: int):
     """
-    Get a specific beatmap.
+    Get the beatmaps of a set, with the class probabilities over the whole set.
 
-    - **beatmap_id**: Beatmap ID.
+    - **beatmapset_id**: Beatmap Set ID.
     """
-    async with async_session() as session:
-        async with session.begin():
-            beatmaps = await BeatmapDBDAL(session).get_beatmap_by_set(beatmapset_id)
-            return DefaultResponse(
-                code=APIStatusCode.SUCCESS,
-                message="Successfully retrieved beatmap!"
-                if len(beatmaps) > 0
-                else "Beatmap not found!",
-                data={"beatmaps": beatmaps},
-            )
+
+    async def read(session_factory):
+        async with session_factory() as session:
+            async with session.begin():
+                dal = BeatmapDBDAL(session)
+                return {
+                    "beatmaps": await dal.get_beatmap_by_set(beatmapset_id),
+                    "profile": await dal.get_beatmapset_profile(beatmapset_id),
+                }
+
+    async def fetch():
+        beatmapset = await read(read_session)
+        if not beatmapset["beatmaps"] and replica_set.replicas:
+            # Read your writes, a beatmap just predicted may not be replicated yet
+            beatmapset = await read(async_session)
+        return beatmapset
+
+    beatmapset = await app.state.single_flight.do(("set", beatmapset_id), fetch)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved beatmap!"
+        if len(beatmapset["beatmaps"]) > 0
+        else "Beatmap not found!",
+        data=beatmapset,
+    )
 
 
 @app.get(
     "/beatmaps/{beatmapset_id}/{beatmap_id}",
     tags=["beatmaps"],
-    response_model=DefaultResponse,
+    response_model=Response[BeatmapDetail],
 )
 async def get_beatmap_by_set_and_id(beatmapset_id: int, beatmap_id: int):
     """
@@ -297,88 +956,403 @@ async def get_beatmap_by_set_and_id(beatmapset_id: int, beatmap_id: int):
     - **beatmap_set_id**: Beatmap Set ID.
     - **beatmap_id**: Beatmap ID.
     """
-    async with async_session() as session:
+
+    async def fetch():
+        async with read_session() as session:
+            async with session.begin():
+                beatmap = await BeatmapDBDAL(session).get_beatmap_by_set_and_id(
+                    beatmapset_id, beatmap_id
+                )
+        if beatmap is None and replica_set.replicas:
+            # Read your writes, a beatmap just predicted may not be replicated yet
+            async with async_session() as session:
+                async with session.begin():
+                    beatmap = await BeatmapDBDAL(session).get_beatmap_by_set_and_id(
+                        beatmapset_id, beatmap_id
+                    )
+        return beatmap
+
+    # Concurrent requests for the same beatmap share one query
+    beatmap = await app.state.single_flight.do(
+        ("beatmap", beatmapset_id, beatmap_id), fetch
+    )
+    if beatmap:
+        app.state.view_counter.add(beatmap_id)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved beatmap!" if beatmap else "Beatmap not found!",
+        data={"beatmap": beatmap},
+    )
+
+
+@app.get(
+    "/beatmaps/{beatmapset_id}/{beatmap_id}/similar",
+    tags=["beatmaps"],
+    response_model=Response[BeatmapSimilarList],
+)
+async def get_similar_beatmaps(beatmapset_id: int, beatmap_id: int, limit: int = 10):
+    """
+    Get the beatmaps most similar to a specific beatmap, based on the model embeddings.
+
+    - **beatmap_set_id**: Beatmap Set ID.
+    - **beatmap_id**: Beatmap ID.
+    - **limit**: Number of beatmaps to return.
+    """
+    # Clamp the value to be between 1 and 25
+    limit = min(max(limit, 1), 25)
+
+    index = app.state.embedding_index
+    embedding = index.get(beatmap_id)
+    if embedding is None:
+        return respond(
+            code=APIStatusCode.BEATMAP_NOT_FOUND,
+            message="Beatmap not found!",
+            data={"beatmaps": []},
+        )
+    neighbours = index.search(embedding, limit, exclude=beatmap_id)
+    similarity = dict(neighbours)
+
+    async with read_session() as session:
         async with session.begin():
-            beatmap = await BeatmapDBDAL(session).get_beatmap_by_set_and_id(
-                beatmapset_id, beatmap_id
-            )
-            return DefaultResponse(
-                code=APIStatusCode.SUCCESS,
-                message="Successfully retrieved beatmap!"
-                if beatmap
-                else "Beatmap not found!",
-                data={"beatmap": beatmap},
+            beatmaps = await BeatmapDBDAL(session).get_beatmaps_by_ids(
+                [i for i, _ in neighbours]
             )
+    for beatmap in beatmaps:
+        beatmap["similarity"] = similarity[beatmap["beatmap_id"]]
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved similar beatmaps!",
+        data={"beatmaps": beatmaps},
+    )
+
+
+@app.get("/stats", tags=["stats"], response_model=Response[CatalogStats])
+async def get_stats(days: int = 30):
+    """
+    Get the class distribution of the catalog and the number of beatmaps predicted
+    each day. Read from aggregates kept up to date on every prediction.
+
+    - **days**: Number of days of daily counts to return.
+    """
+    # Clamp the value to be between 1 and STATS_MAX_DAYS
+    days = min(max(days, 1), STATS_MAX_DAYS)
+
+    async def fetch():
+        async with read_session() as session:
+            async with session.begin():
+                return await StatsDAL(session).get_stats(days)
+
+    stats = await app.state.single_flight.do(("stats", days), fetch)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved statistics!",
+        data=stats,
+    )
 
 
 @app.post(
     "/predict",
     tags=["predict"],
-    response_model=DefaultResponse,
+    response_model=Response[Prediction],
     responses={
         400: {"model": ExceptionResponse},
+        429: {"model": ExceptionResponse},
+        503: {"model": ExceptionResponse},
     },
 )
-async def predict_map(file: UploadFile = File(...)):
+async def predict_map(
+    request: FastAPIRequest,
+    file: UploadFile = File(...),
+    tier: str = PREDICT_TIER,
+):
     """
     Predict beatmap class.
 
     - **file**: .osu file to predict.
+    - **tier**: `full` model, `fast` distilled model, or `cascade` (the distilled
+      model, then the full one when it is uncertain).
+
+    When profiling is enabled on the server, sending `X-Profile: 1` may record a
+    trace of the prediction, its name is returned in the `X-Profile-Id` header.
     """
-    if Path(file.filename).suffix != ".osu":
-        print("Invalid file extension!")
-        raise InvalidFileTypeException()
-    async with tempfile.TemporaryFile(mode="w+") as f:
-        content = await file.read()
-        # Decode and remove carriage return for beatmap saved on windows
-        # Windows is annoying to handle :/
-        try:
-            content = content.decode("utf-8").replace("\r", "")
-        except UnicodeDecodeError:
-            print("Error while decoding uploaded file!")
-            raise InvalidFileException()
-        # Write and move the cursor to the beginning of the file
-        await f.write(content)
-        await f.seek(0)
+    if not app.state.model_ready:
+        raise ModelNotReadyException()
+    if tier not in PREDICT_TIERS:
+        raise InvalidQueryException(
+            "Tier must be one of: " + ", ".join(PREDICT_TIERS)
+        )
+    await app.state.rate_limiter.check(client_key(request))
+    content = await read_beatmap_upload(file)
+    features_hash = content_hash(content)
+    requested = request.headers.get(PROFILE_HEADER) == "1"
+    async with app.state.profiler.sample(requested) as profile:
+        if profile is not None:
+            # Profiled on its own, not joined to a running prediction
+            prediction = await predict_content(content, features_hash, tier)
+        else:
+            # Identical uploads running at the same time share one prediction
+            prediction = await app.state.single_flight.do(
+                ("predict", features_hash, tier),
+                lambda: predict_content(content, features_hash, tier),
+            )
+    response = respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully predicted beatmap type!",
+        data=prediction,
+    )
+    if profile is not None:
+        response.headers["X-Profile-Id"] = profile.name
+    return response
+
+
+def predict_tier(beatmap_id: int, features, tier: str):
+    """
+    Predict the features with the model of a tier.
+    :return: (model version, probability of each class, embedding or None)
+    """
+    from model.loader import get_active_model, get_student
+    from utils.predict import is_uncertain, predict_features
+
+    student = get_student() if tier != "full" else None
+    if student is not None:
+        student_version, student_model = student
+        map_type, _ = predict_features(student_model, *features)
+        # The distilled embeddings can't be compared with the indexed ones,
+        # the full model fills the embedding in when it re-scores the beatmap
+        if tier == "fast" or not is_uncertain(map_type, CASCADE_MARGIN):
+            return student_version, map_type, None
+
+    model_version, model = get_active_model()
+    if app.state.incremental is not None and not model.bidirectional:
+        # Edited versions of a beatmap only run the RNNs from the first change
+        map_type, embedding, resumed = app.state.incremental.predict(
+            model, model_version, beatmap_id, *features
+        )
+        if any(resumed):
+            print(f"Resumed the RNNs at rows {resumed}")
+    else:
+        map_type, embedding = predict_features(model, *features)
+    return model_version, map_type, embedding
+
+
+async def predict_content(content: str, features_hash: str, tier: str) -> dict:
+    """
+    Parse and predict a beatmap, then store the features and the predictions.
+    :param tier: One of PREDICT_TIERS, the full model is used if the distilled
+        one is not loaded
+    :return: Prediction, shaped like the /predict response
+    """
+    # Imported lazily, torch is already loaded at this point
+    from model.loader import get_active_model
+    from utils.predict import extract_features
+
+    loop = asyncio.get_running_loop()
+    async with app.state.admission.admit():
         # Start a timer
         start = datetime.now()
         # Parse and predict the beatmap
-        bm = await Beatmap.create(f)
+        memory = app.state.memory
+        with profile_span("parse"), profile_python(), memory.track("parse"):
+            bm = await parse_beatmap(content)
+
+        print(
+            f"Predicting beatmap (id={bm.sections['Metadata']['BeatmapID']}, set={bm.sections['Metadata']['BeatmapSetID']})..."
+        )
+        with profile_span("features"), profile_python(), memory.track("features"):
+            features = await extract_features(bm)
+        with profile_span("predict"), profile_torch(), memory.track("predict"):
+            # Off the event loop, which keeps serving the other requests
+            model_version, map_type, embedding = await loop.run_in_executor(
+                app.state.inference_executor,
+                predict_tier,
+                bm.metadata["beatmap_id"],
+                features,
+                tier,
+            )
+        end = humanize.precisedelta(datetime.now() - start)
+        print(f"Done in {end}!")
 
-    print(
-        f"Predicting beatmap (id={bm.sections['Metadata']['BeatmapID']}, set={bm.sections['Metadata']['BeatmapSetID']})..."
+    # Keep the model inputs, so the beatmap can be re-scored without parsing it again
+    await loop.run_in_executor(
+        None, app.state.feature_store.put, features_hash, features
     )
-    if len(bm.sections["HitObjects"]) >= 3000:
-        print("Beatmap too long!")
-        raise BeatmapTooLongException()
-    map_type = await predict_map_type(classification_model, bm)
-    end = humanize.precisedelta(datetime.now() - start)
-    print(f"Done in {end}!")
 
     # Create a new beatmap database entry
+    with profile_span("store"):
+        async with async_session() as session:
+            async with session.begin():
+                created = await BeatmapDBDAL(session).create_or_update_beatmap(
+                    **bm.metadata,
+                    **map_type,
+                    embedding=encode_embedding(embedding)
+                    if embedding is not None
+                    else None,
+                    features_hash=features_hash,
+                    model_version=model_version,
+                    # The distilled predictions don't replace the ones of the full model
+                    keep_version=get_active_model()[0] if embedding is None else None,
+                )
+    if created is not None:
+        await app.state.feed.publish(
+            "created" if created else "updated",
+            [feed_event(bm.metadata, map_type, model_version)],
+        )
+    if embedding is not None:
+        app.state.embedding_index.add(bm.metadata["beatmap_id"], embedding)
+
+    return {
+        "processing_time": end,
+        **bm.metadata,
+        "predicted_type": map_type,
+        "model_version": model_version,
+    }
+
+
+@app.post(
+    "/predict/jobs",
+    tags=["predict"],
+    response_model=Response[PredictionJob],
+    responses={
+        400: {"model": ExceptionResponse},
+        429: {"model": ExceptionResponse},
+    },
+)
+async def create_prediction_job(
+    request: FastAPIRequest, file: UploadFile = File(...)
+):
+    """
+    Queue a beatmap for prediction and return immediately with the job ID.
+    The result can be fetched from /predict/jobs/{job_id}.
+
+    - **file**: .osu file to predict.
+    """
+    await app.state.rate_limiter.check(client_key(request))
+    content = await read_beatmap_upload(file)
     async with async_session() as session:
         async with session.begin():
-            await BeatmapDBDAL(session).create_or_update_beatmap(
-                bm.sections["Metadata"]["BeatmapID"],
-                bm.sections["Metadata"]["BeatmapSetID"],
-                bm.sections["Metadata"]["Artist"],
-                bm.sections["Metadata"]["Title"],
-                bm.sections["Metadata"]["Creator"],
-                bm.sections["Metadata"]["Version"],
-                **map_type,
+            job_id = await PredictionJobDAL(session).enqueue(content)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully queued beatmap for prediction!",
+        data={"job_id": job_id, "status": JobStatus.QUEUED},
+    )
+
+
+@app.get(
+    "/predict/jobs/{job_id}",
+    tags=["predict"],
+    response_model=Response[PredictionJob],
+)
+async def get_prediction_job(job_id: int, wait: float = 0):
+    """
+    Get the status of a prediction job, and the beatmap once it is done.
+
+    - **job_id**: Job ID.
+    - **wait**: Seconds to wait for the job to finish before answering (long polling, up to 30).
+    """
+    deadline = asyncio.get_running_loop().time() + min(max(wait, 0), 30)
+    while True:
+        async with async_session() as session:
+            async with session.begin():
+                job = await PredictionJobDAL(session).get(job_id)
+                beatmap = None
+                if job is not None and job.status == JobStatus.DONE:
+                    beatmap = await BeatmapDBDAL(session).get_beatmaps_by_ids(
+                        [job.beatmap_id], full=True
+                    )
+        if job is None:
+            return respond(
+                code=APIStatusCode.JOB_NOT_FOUND,
+                message="Job not found!",
             )
+        finished = job.status in (JobStatus.DONE, JobStatus.FAILED)
+        if finished or asyncio.get_running_loop().time() >= deadline:
+            break
+        await asyncio.sleep(JOB_POLL_INTERVAL)
 
-    return DefaultResponse(
-        code=APIStatusCode.SUCCESS,
-        message="Successfully predicted beatmap type!",
+    failed = job.status == JobStatus.FAILED
+    return respond(
+        code=job.error_code if failed else APIStatusCode.SUCCESS,
+        message=f"Job is {job.status}!",
         data={
-            "processing_time": end,
-            "beatmap_id": bm.sections["Metadata"]["BeatmapID"],
-            "beatmapset_id": bm.sections["Metadata"]["BeatmapSetID"],
-            "artist": bm.sections["Metadata"]["Artist"],
-            "title": bm.sections["Metadata"]["Title"],
-            "creator": bm.sections["Metadata"]["Creator"],
-            "version": bm.sections["Metadata"]["Version"],
-            "predicted_type": map_type,
+            "job_id": job.id,
+            "status": job.status,
+            "beatmap": beatmap[0] if beatmap else None,
         },
     )
+
+
+@app.get(
+    "/admin/memory",
+    include_in_schema=False,
+    response_model=Response[MemoryReport],
+)
+async def get_memory_report(request: FastAPIRequest, snapshot: bool = False):
+    """
+    Memory usage of the worker that answers, the peaks of the /predict phases
+    and the top allocators of the last snapshot (with MEMORY_TRACING).
+
+    - **snapshot**: Take a new allocation snapshot first.
+    """
+    check_admin(request)
+    tracker = app.state.memory
+    if snapshot:
+        await asyncio.get_running_loop().run_in_executor(None, tracker.snapshot)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully retrieved memory usage!",
+        data=tracker.report(),
+    )
+
+
+@app.post(
+    "/admin/models",
+    include_in_schema=False,
+    response_model=Response[ModelInfo],
+)
+async def activate_model(request: FastAPIRequest, weights_path: str):
+    """
+    Load new model weights and make them the active version.
+    This worker switches once the model is warmed up, the other workers and
+    the prediction workers follow within MODEL_POLL_INTERVAL seconds. Beatmaps
+    predicted by the previous version are re-scored by the prediction workers.
+
+    - **weights_path**: Path of the weights file, readable by every worker.
+    """
+    check_admin(request)
+    if not app.state.model_ready:
+        raise ModelNotReadyException()
+    from model import loader
+
+    if not os.path.isfile(weights_path):
+        raise InvalidQueryException("Weights file not found.")
+    loop = asyncio.get_running_loop()
+    version = await loop.run_in_executor(None, loader.weights_version, weights_path)
+    await loop.run_in_executor(None, loader.switch_model, version, weights_path)
+    async with async_session() as session:
+        async with session.begin():
+            dal = ModelVersionDAL(session)
+            await dal.register(version, weights_path)
+            await dal.activate(version)
+    return respond(
+        code=APIStatusCode.SUCCESS,
+        message="Successfully activated model!",
+        data={"version": version, "weights_path": weights_path},
+    )
+
+
+async def read_beatmap_upload(file: UploadFile) -> str:
+    """
+    Check and decode an uploaded .osu file.
+    """
+    if Path(file.filename).suffix != ".osu":
+        print("Invalid file extension!")
+        raise InvalidFileTypeException()
+    content = await file.read()
+    # Decode and remove carriage return for beatmap saved on windows
+    # Windows is annoying to handle :/
+    try:
+        return content.decode("utf-8").replace("\r", "")
+    except UnicodeDecodeError:
+        print("Error while decoding uploaded file!")
+        raise InvalidFileException()
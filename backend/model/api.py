@@ -1,7 +1,8 @@
-from typing import Optional, List, Union
+from typing import Dict, Generic, Optional, List, TypeVar, Union
 
-from datetime import datetime
+from datetime import date, datetime
 from pydantic import BaseModel
+from pydantic.generics import GenericModel
 
 
 class BeatmapSimple(BaseModel):
@@ -17,6 +18,14 @@ class BeatmapSimple(BaseModel):
         orm_mode = True
 
 
+class BeatmapSimilar(BeatmapSimple):
+    similarity: float
+
+
+class BeatmapSearchResult(BeatmapSimple):
+    score: float
+
+
 class Beatmap(BaseModel):
     beatmap_id: int
     beatmapset_id: int
@@ -32,6 +41,7 @@ class Beatmap(BaseModel):
     stamina_p: float
     stream_p: float
     tech_p: float
+    model_version: Optional[str]
 
     # view_count: int
     created_at: datetime
@@ -46,13 +56,154 @@ class DefaultResponse(BaseModel):
     message: str
     data: Optional[
         Union[
-            dict[str, List[Union[Beatmap, BeatmapSimple]]],
+            dict[str, List[Union[Beatmap, BeatmapSimilar, BeatmapSimple]]],
             dict[str, Union[Beatmap, BeatmapSimple]],
             dict,
         ]
     ]
 
 
+# Typed responses for each route
+T = TypeVar("T")
+
+
+class Response(GenericModel, Generic[T]):
+    code: int
+    message: str
+    data: Optional[T]
+
+
+class BeatmapList(BaseModel):
+    beatmaps: List[BeatmapSimple]
+
+
+class BeatmapSetProfile(BaseModel):
+    beatmapset_id: int
+    artist: str
+    title: str
+    difficulty_count: int
+    view_count: int
+
+    alternate_mean: float
+    alternate_max: float
+    fingercontrol_mean: float
+    fingercontrol_max: float
+    jump_mean: float
+    jump_max: float
+    speed_mean: float
+    speed_max: float
+    stamina_mean: float
+    stamina_max: float
+    stream_mean: float
+    stream_max: float
+    tech_mean: float
+    tech_max: float
+
+    updated_at: datetime
+
+
+class BeatmapSetDetail(BaseModel):
+    beatmaps: List[BeatmapSimple]
+    profile: Optional[BeatmapSetProfile]
+
+
+class BeatmapPreview(BaseModel):
+    bPop: List[BeatmapSimple]
+    bRUpl: List[BeatmapSimple]
+    bRUpd: List[BeatmapSimple]
+
+
+class BeatmapDetail(BaseModel):
+    beatmap: Optional[Beatmap]
+
+
+class BeatmapBatch(BaseModel):
+    beatmaps: List[Beatmap]
+    # Requested beatmap IDs that were not found
+    missing: List[int]
+
+
+class BeatmapRanking(BaseModel):
+    beatmaps: List[Beatmap]
+    next_cursor: Optional[str]
+
+
+class BeatmapSearch(BaseModel):
+    beatmaps: List[BeatmapSearchResult]
+    next_cursor: Optional[str]
+
+
+class BeatmapSimilarList(BaseModel):
+    beatmaps: List[BeatmapSimilar]
+
+
+class Prediction(BaseModel):
+    processing_time: str
+    beatmap_id: int
+    beatmapset_id: int
+    artist: str
+    title: str
+    creator: str
+    version: str
+    predicted_type: Dict[str, float]
+    model_version: str
+
+
+class PredictionJob(BaseModel):
+    job_id: int
+    status: str
+    beatmap: Optional[Beatmap]
+
+
+class ModelInfo(BaseModel):
+    version: str
+    weights_path: str
+
+
+class DailyCount(BaseModel):
+    day: date
+    count: int
+
+
+class CatalogStats(BaseModel):
+    total: int
+    histogram_buckets: int
+    # Beatmaps per probability bucket of each class
+    histograms: Dict[str, List[int]]
+    # Beatmaps per most probable class
+    dominant_classes: Dict[str, int]
+    # Beatmaps first predicted each day, most recent first
+    daily: List[DailyCount]
+
+
+class Allocator(BaseModel):
+    location: str
+    size: int
+    count: int
+    size_diff: Optional[int]
+    count_diff: Optional[int]
+
+
+class MemorySnapshot(BaseModel):
+    taken_at: float
+    # Largest allocators, and the ones that grew the most since the previous snapshot
+    top: List[Allocator]
+    growth: List[Allocator]
+
+
+class MemoryReport(BaseModel):
+    pid: int
+    rss: int
+    max_rss: int
+    # Per request phase: count, last and highest peaks (traced, rss_growth,
+    # rss_change, rss_after)
+    peaks: Dict[str, Dict[str, int]]
+    tracing: bool
+    traced: Optional[int]
+    traced_peak: Optional[int]
+    snapshot: Optional[MemorySnapshot]
+
+
 class ExceptionResponse(BaseModel):
     code: int
     reason: str
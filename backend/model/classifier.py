@@ -1,22 +1,73 @@
+from typing import List, Optional, Tuple
+
 import torch
 from torch import nn
 from torch.nn import functional as F
 
 
+class Standardize(nn.Module):
+    """
+    Standardizes the last dimension of the input with the dataset statistics.
+    The statistics are stored as buffers, so they are saved with the model weights.
+    """
+
+    def __init__(
+        self, n_features: int, stats: Optional[Tuple[List, List]] = None
+    ) -> None:
+        super().__init__()
+        if stats is None:
+            stats = ([0.0] * n_features, [1.0] * n_features)
+        mean, std = stats
+        self.register_buffer("mean", torch.tensor(mean, dtype=torch.float32))
+        self.register_buffer("std", torch.tensor(std, dtype=torch.float32))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older weights were saved without the statistics, keep the ones given at init
+        for name, buf in self.named_buffers(recurse=False):
+            state_dict.setdefault(prefix + name, buf)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x):
+        # (x - mean) / std as a single multiply-add over the input
+        scale = self.std.reciprocal()
+        return torch.addcmul(-self.mean * scale, x, scale)
+
+
 class ScaledDotProductAttention(nn.Module):
-    """Scaled Dot-Product Attention"""
+    """
+    Scaled Dot-Product Attention
+
+    When `chunk_size` is set and the query is longer than it, the queries are
+    processed in blocks of `chunk_size` rows, so only a (chunk_size x L) slice
+    of the attention matrix is alive at any time instead of the full (L x L).
+    Softmax is computed per query row, so the output is identical to the
+    unchunked path. The attention weights are not returned in that case.
+    """
 
-    def __init__(self, temperature, attn_dropout=0.1):
+    def __init__(self, temperature, attn_dropout=0.1, chunk_size=None):
         super().__init__()
         self.temperature = temperature
+        self.chunk_size = chunk_size
         self.dropout = nn.Dropout(attn_dropout)
 
     def forward(self, q, k, v):
+        if self.chunk_size is not None and q.size(2) > self.chunk_size:
+            return self._chunked_forward(q, k, v), None
         attn = torch.matmul(q / self.temperature, k.transpose(2, 3))
         attn = self.dropout(F.softmax(attn, dim=-1))
         output = torch.matmul(attn, v)
         return output, attn
 
+    def _chunked_forward(self, q, k, v):
+        k_t = k.transpose(2, 3)
+        output = q.new_empty(q.size(0), q.size(1), q.size(2), v.size(3))
+        for start in range(0, q.size(2), self.chunk_size):
+            end = start + self.chunk_size
+            attn = torch.matmul(q[:, :, start:end] / self.temperature, k_t)
+            attn = self.dropout(F.softmax(attn, dim=-1))
+            output[:, :, start:end] = torch.matmul(attn, v)
+        return output
+
 
 class MultiHeadAttention(nn.Module):
     """
@@ -31,6 +82,7 @@ class MultiHeadAttention(nn.Module):
         key_size: int = 32,
         value_size: int = 32,
         dropout: float = 0.5,
+        chunk_size: int = None,
     ) -> None:
         super().__init__()
         assert hidden_size % n_heads == 0
@@ -45,7 +97,9 @@ class MultiHeadAttention(nn.Module):
         self.w_vs = nn.Linear(hidden_size, self.n_heads * self.value_size, bias=False)
         self.fc = nn.Linear(self.n_heads * self.value_size, hidden_size, bias=False)
 
-        self.attn = ScaledDotProductAttention(temperature=self.key_size ** 0.5)
+        self.attn = ScaledDotProductAttention(
+            temperature=self.key_size ** 0.5, chunk_size=chunk_size
+        )
 
         self.dropout = nn.Dropout(dropout)
         self.norm = nn.LayerNorm(hidden_size, eps=1e-6)
@@ -90,6 +144,10 @@ class OsuClassifier(nn.Module):
         n_heads: int = 2,
         bidirectional: bool = False,
         dropout: float = 0.5,
+        attn_chunk_size: int = None,
+        map_info_stats: Optional[Tuple[List, List]] = None,
+        hit_objects_stats: Optional[Tuple[List, List]] = None,
+        slider_points_stats: Optional[Tuple[List, List]] = None,
     ) -> None:
         super(OsuClassifier, self).__init__()
 
@@ -109,6 +167,16 @@ class OsuClassifier(nn.Module):
         self.n_heads = n_heads
         self.bidirectional = bidirectional
         self.dropout = dropout
+        self.attn_chunk_size = attn_chunk_size
+
+        # Input standardization, (mean, std) for each input
+        self.map_info_norm = Standardize(self.map_info_features, map_info_stats)
+        self.hit_objects_norm = Standardize(
+            self.hit_objects_features, hit_objects_stats
+        )
+        self.slider_points_norm = Standardize(
+            self.slider_points_features, slider_points_stats
+        )
 
         # Attention Mechanism
         self.ho_attn_stack = nn.ModuleList(
@@ -119,6 +187,7 @@ class OsuClassifier(nn.Module):
                     key_size=self.key_size,
                     value_size=self.value_size,
                     dropout=self.dropout,
+                    chunk_size=self.attn_chunk_size,
                 )
                 for _ in range(self.attn_n_layers)
             ]
@@ -131,6 +200,7 @@ class OsuClassifier(nn.Module):
                     key_size=self.key_size,
                     value_size=self.value_size,
                     dropout=self.dropout,
+                    chunk_size=self.attn_chunk_size,
                 )
                 for _ in range(self.attn_n_layers)
             ]
@@ -166,8 +236,20 @@ class OsuClassifier(nn.Module):
         self.norm3 = nn.LayerNorm(self.hidden_size)
 
     def forward(
-        self, map_info, hit_objects, slider_points, seq_ho, seq_sp, return_attn=False
+        self,
+        map_info,
+        hit_objects,
+        slider_points,
+        seq_ho,
+        seq_sp,
+        return_attn=False,
+        return_embedding=False,
     ):
+        # Standardize the inputs
+        map_info = self.map_info_norm(map_info)
+        hit_objects = self.hit_objects_norm(hit_objects)
+        slider_points = self.slider_points_norm(slider_points)
+
         # Hit Objects
         # Pack the padded hit objects
         hit_objects = nn.utils.rnn.pack_padded_sequence(
@@ -190,6 +272,35 @@ class OsuClassifier(nn.Module):
             slider_points, batch_first=True
         )
 
+        return self.head(map_info, hit_objects, slider_points, return_embedding)
+
+    def encode(self, rnn, x, h=None, checkpoint_every=None):
+        """
+        Run a recurrent layer over a single unpadded sequence (batch size 1),
+        `checkpoint_every` steps at a time.
+        The recurrence can be resumed from any returned hidden state, the
+        outputs are the same as running the whole sequence at once.
+        :param rnn: hit_objects_rnn or slider_points_rnn
+        :param x: Standardized input (1, L, features)
+        :param h: Hidden state to start from, zeros if None
+        :return: (outputs (1, L, hidden_size), hidden state after each chunk)
+        """
+        assert not self.bidirectional, "Can't resume a bidirectional RNN"
+        if x.size(1) == 0:
+            return x.new_empty(1, 0, self.hidden_size), []
+        step = checkpoint_every or x.size(1)
+        outputs, states = [], []
+        for start in range(0, x.size(1), step):
+            out, h = rnn(x[:, start : start + step], h)
+            outputs.append(out)
+            states.append(h)
+        return torch.cat(outputs, dim=1), states
+
+    def head(self, map_info, hit_objects, slider_points, return_embedding=False):
+        """
+        Attention, pooling and FC layers, over the RNN outputs.
+        :param map_info: Standardized map info
+        """
         # Attention mechanism
         for ho_layer in self.ho_attn_stack:
             hit_objects, _ = ho_layer(hit_objects, hit_objects, hit_objects)
@@ -202,7 +313,118 @@ class OsuClassifier(nn.Module):
 
         # Concatenate the map info and the RNN outputs
         out = torch.cat((map_info, hit_objects, slider_points), dim=1)
-        out = self.norm3(F.relu(self.intermediate_fc(out)))
+        embedding = self.norm3(F.relu(self.intermediate_fc(out)))
 
         # Final output
-        return torch.sigmoid(self.out(out))
+        out = torch.sigmoid(self.out(embedding))
+        if return_embedding:
+            return out, embedding
+        return out
+
+
+class StudentClassifier(nn.Module):
+    """
+    Small convolutional classifier distilled from OsuClassifier, see distill.py.
+
+    Each sequence goes through a few dilated 1-D convolutions and is pooled
+    with a masked mean and max, so padded batches give the same outputs as
+    single beatmaps. Takes the same inputs as OsuClassifier.
+    """
+
+    def __init__(
+        self,
+        map_info_features: int,
+        hit_objects_features: int,
+        slider_points_features: int,
+        num_classes: int,
+        channels: int = 64,
+        hidden_size: int = 64,
+        kernel_size: int = 5,
+        n_layers: int = 2,
+        map_info_stats: Optional[Tuple[List, List]] = None,
+        hit_objects_stats: Optional[Tuple[List, List]] = None,
+        slider_points_stats: Optional[Tuple[List, List]] = None,
+    ) -> None:
+        super().__init__()
+        self.map_info_features = map_info_features
+        self.hit_objects_features = hit_objects_features
+        self.slider_points_features = slider_points_features
+        self.num_classes = num_classes
+        self.channels = channels
+        self.hidden_size = hidden_size
+
+        self.map_info_norm = Standardize(self.map_info_features, map_info_stats)
+        self.hit_objects_norm = Standardize(
+            self.hit_objects_features, hit_objects_stats
+        )
+        self.slider_points_norm = Standardize(
+            self.slider_points_features, slider_points_stats
+        )
+
+        self.ho_convs = self._conv_stack(
+            hit_objects_features, channels, kernel_size, n_layers
+        )
+        self.sp_convs = self._conv_stack(
+            slider_points_features, channels, kernel_size, n_layers
+        )
+
+        self.intermediate_fc = nn.Linear(
+            self.map_info_features + self.channels * 4, self.hidden_size
+        )
+        self.out = nn.Linear(self.hidden_size, self.num_classes)
+        self.norm = nn.LayerNorm(self.hidden_size)
+
+    @staticmethod
+    def _conv_stack(in_features, channels, kernel_size, n_layers) -> nn.ModuleList:
+        # Dilation doubles with each layer to widen the receptive field cheaply
+        return nn.ModuleList(
+            [
+                nn.Conv1d(
+                    in_features if i == 0 else channels,
+                    channels,
+                    kernel_size,
+                    padding=(kernel_size // 2) * 2 ** i,
+                    dilation=2 ** i,
+                )
+                for i in range(n_layers)
+            ]
+        )
+
+    @staticmethod
+    def _encode(convs, x, lengths):
+        # (N, 1, L) mask of the positions inside each sequence
+        lengths = torch.as_tensor(lengths, dtype=x.dtype)
+        positions = torch.arange(x.size(1), dtype=x.dtype)
+        mask = (positions.unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1).to(x.dtype)
+
+        # Padding is zeroed after every layer, like the convolution padding
+        h = x.transpose(1, 2) * mask
+        for conv in convs:
+            h = F.relu(conv(h)) * mask
+        # After the relu the padding can't be the maximum of a non-empty sequence
+        mean = h.sum(dim=2) / lengths.clamp(min=1).unsqueeze(1)
+        return torch.cat((mean, h.max(dim=2).values), dim=1)
+
+    def forward(
+        self,
+        map_info,
+        hit_objects,
+        slider_points,
+        seq_ho,
+        seq_sp,
+        return_embedding=False,
+    ):
+        map_info = self.map_info_norm(map_info)
+        hit_objects = self._encode(
+            self.ho_convs, self.hit_objects_norm(hit_objects), seq_ho
+        )
+        slider_points = self._encode(
+            self.sp_convs, self.slider_points_norm(slider_points), seq_sp
+        )
+
+        out = torch.cat((map_info, hit_objects, slider_points), dim=1)
+        embedding = self.norm(F.relu(self.intermediate_fc(out)))
+        out = torch.sigmoid(self.out(embedding))
+        if return_embedding:
+            return out, embedding
+        return out
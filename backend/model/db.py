@@ -1,20 +1,41 @@
-from typing import List
+import operator
+from collections import Counter
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 
 from sqlalchemy import (
     desc,
     select,
     update,
+    tuple_,
+    bindparam,
+    inspect,
+    text,
     Column,
+    Index,
     Integer,
+    Boolean,
     String,
+    Date,
     DateTime,
     Float,
+    LargeBinary,
+    Computed,
+    Text,
+    case,
+    cast,
+    union_all,
+    or_,
+    and_,
 )
 from sqlalchemy.future import select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.sql import func
 
 from config.db import Base
+from const import LABELS, STATS_HISTOGRAM_BUCKETS, APIStatusCode
 
 
 class Beatmap(Base):
@@ -37,6 +58,13 @@ class Beatmap(Base):
     stream_p = Column(Float, nullable=False)
     tech_p = Column(Float, nullable=False)
 
+    # Model embedding, float16 bytes (see utils.knn.encode_embedding)
+    embedding = Column(LargeBinary, nullable=True)
+    # Content hash of the stored model inputs (see utils.features.FeatureStore)
+    features_hash = Column(String(64), nullable=True)
+    # Version of the model that made the predictions (see model.loader.weights_version)
+    model_version = Column(String(64), nullable=True)
+
     # Stats
     view_count = Column(Integer, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -44,6 +72,146 @@ class Beatmap(Base):
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
     )
 
+    # Lowercased text searched by /beatmaps/search, kept up to date by postgres
+    search_text = Column(
+        String,
+        Computed("lower(artist || ' ' || title || ' ' || creator || ' ' || version)"),
+    )
+
+
+class BeatmapSet(Base):
+    __tablename__ = "beatmapsets"
+
+    beatmapset_id = Column(Integer, primary_key=True)
+    artist = Column(String, nullable=False)
+    title = Column(String, nullable=False)
+
+    # Aggregates over the difficulties of the set, see BeatmapDAL.refresh_beatmapsets
+    difficulty_count = Column(Integer, nullable=False)
+    view_count = Column(Integer, nullable=False)
+
+    # Mean and max probability of each class
+    alternate_mean = Column(Float, nullable=False)
+    alternate_max = Column(Float, nullable=False)
+    fingercontrol_mean = Column(Float, nullable=False)
+    fingercontrol_max = Column(Float, nullable=False)
+    jump_mean = Column(Float, nullable=False)
+    jump_max = Column(Float, nullable=False)
+    speed_mean = Column(Float, nullable=False)
+    speed_max = Column(Float, nullable=False)
+    stamina_mean = Column(Float, nullable=False)
+    stamina_max = Column(Float, nullable=False)
+    stream_mean = Column(Float, nullable=False)
+    stream_max = Column(Float, nullable=False)
+    tech_mean = Column(Float, nullable=False)
+    tech_max = Column(Float, nullable=False)
+
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class ClassHistogram(Base):
+    __tablename__ = "class_histograms"
+
+    # Number of beatmaps with a class probability in
+    # [bucket / STATS_HISTOGRAM_BUCKETS, (bucket + 1) / STATS_HISTOGRAM_BUCKETS)
+    label = Column(String, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class DominantClassCount(Base):
+    __tablename__ = "dominant_class_counts"
+
+    # Number of beatmaps with this class as the most probable one
+    label = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class DailyBeatmapCount(Base):
+    __tablename__ = "daily_beatmap_counts"
+
+    # Number of beatmaps first predicted on this day (UTC)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class JobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class PredictionJob(Base):
+    __tablename__ = "prediction_jobs"
+
+    id = Column(Integer, primary_key=True)
+    status = Column(String, nullable=False, default=JobStatus.QUEUED)
+    # Decoded .osu file content
+    content = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+
+    # Result
+    beatmap_id = Column(Integer, nullable=True)
+    error_code = Column(Integer, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class ModelVersion(Base):
+    __tablename__ = "model_versions"
+
+    version = Column(String(64), primary_key=True)
+    weights_path = Column(String, nullable=False)
+    # Only one version is active, every worker switches to it
+    active = Column(Boolean, nullable=False, default=False)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    activated_at = Column(DateTime(timezone=True), nullable=True)
+
+
+# Workers only look at unfinished jobs, keep that part of the table indexed
+Index(
+    "ix_prediction_jobs_pending",
+    PredictionJob.id,
+    postgresql_where=PredictionJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]),
+)
+
+
+def init_db(conn) -> None:
+    """
+    Create the tables, and the columns and indexes missing from tables that already exist.
+    Meant to be used with `conn.run_sync`.
+    """
+    # Trigram matching for the search index
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    inspector = inspect(conn)
+    profiles_existed = inspector.has_table(BeatmapSet.__tablename__)
+    missing_stats = [name for name in STATS_BACKFILL if not inspector.has_table(name)]
+    Base.metadata.create_all(conn)
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                # Only nullable or computed columns can be added this way
+                column_ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    if not profiles_existed:
+        # Profiles of the beatmaps predicted before the table existed
+        conn.execute(refresh_beatmapsets_statement())
+    for name in missing_stats:
+        # Statistics of the beatmaps predicted before the table existed
+        conn.execute(STATS_BACKFILL[name]())
+
 
 SIMPLE_COLUMNS = [
     Beatmap.beatmap_id,
@@ -52,12 +220,188 @@ SIMPLE_COLUMNS = [
     Beatmap.title,
     Beatmap.creator,
     Beatmap.version,
-    Beatmap.view_count,
+]
+
+PREDICTION_COLUMNS = {label: getattr(Beatmap, f"{label}_p") for label in LABELS}
+
+# One index per class, ordered like the ranking queries so that
+# top-N and keyset pages are read straight from the index
+for label, column in PREDICTION_COLUMNS.items():
+    Index(f"ix_beatmaps_{label}_p", column.desc(), Beatmap.beatmap_id.desc())
+
+# Difficulties of a set, read by the set page and the set profile refresh
+Index("ix_beatmaps_beatmapset_id", Beatmap.beatmapset_id)
+
+# Beatmaps changed since a time, read by the incremental exports and the
+# embedding index refresh
+Index("ix_beatmaps_updated_at", Beatmap.updated_at)
+
+# Trigram index for the typo tolerant search
+Index(
+    "ix_beatmaps_search_text_trgm",
+    Beatmap.search_text,
+    postgresql_using="gin",
+    postgresql_ops={"search_text": "gin_trgm_ops"},
+)
+
+FILTER_OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+FULL_COLUMNS = [
+    Beatmap.beatmap_id,
+    Beatmap.beatmapset_id,
+    Beatmap.artist,
+    Beatmap.title,
+    Beatmap.creator,
+    Beatmap.version,
+    *PREDICTION_COLUMNS.values(),
+    Beatmap.model_version,
     Beatmap.created_at,
     Beatmap.updated_at,
 ]
 
 
+def refresh_beatmapsets_statement(where=None):
+    """
+    Statement computing the profiles of the beatmapsets matching `where` from
+    their difficulties, replacing the stored ones. All the sets without `where`.
+    """
+    columns = {
+        "beatmapset_id": Beatmap.beatmapset_id,
+        "artist": func.min(Beatmap.artist),
+        "title": func.min(Beatmap.title),
+        "difficulty_count": func.count(),
+        "view_count": func.sum(Beatmap.view_count),
+    }
+    for label, column in PREDICTION_COLUMNS.items():
+        columns[f"{label}_mean"] = func.avg(column)
+        columns[f"{label}_max"] = func.max(column)
+    query = select(*[c.label(name) for name, c in columns.items()]).group_by(
+        Beatmap.beatmapset_id
+    )
+    if where is not None:
+        query = query.where(where)
+    stmt = insert(BeatmapSet).from_select(list(columns), query)
+    return stmt.on_conflict_do_update(
+        index_elements=[BeatmapSet.beatmapset_id],
+        set_={
+            **{
+                name: stmt.excluded[name]
+                for name in columns
+                if name != "beatmapset_id"
+            },
+            "updated_at": func.now(),
+        },
+    )
+
+
+def histogram_bucket(p: float) -> int:
+    """
+    Bucket of a class probability in the class histograms
+    """
+    return min(int(p * STATS_HISTOGRAM_BUCKETS), STATS_HISTOGRAM_BUCKETS - 1)
+
+
+def dominant_class(probabilities: Dict[str, float]) -> str:
+    """
+    Most probable class, the first one in LABELS order on ties
+    """
+    return max(LABELS, key=lambda label: probabilities[label])
+
+
+def _unchanged(row, prediction: dict) -> bool:
+    """
+    Whether a beatmap still has the features and the model version a prediction
+    was made from, when the prediction records them
+    """
+    return (
+        "features_hash" not in prediction
+        or row["features_hash"] == prediction["features_hash"]
+    ) and (
+        "previous_version" not in prediction
+        or row["model_version"] == prediction["previous_version"]
+    )
+
+
+# Same as histogram_bucket and dominant_class, computed by postgres
+def _histogram_bucket_expr(column):
+    return func.least(
+        cast(func.floor(column * STATS_HISTOGRAM_BUCKETS), Integer),
+        STATS_HISTOGRAM_BUCKETS - 1,
+    )
+
+
+def _dominant_class_expr():
+    greatest = func.greatest(*PREDICTION_COLUMNS.values())
+    return case(
+        *[(column == greatest, label) for label, column in PREDICTION_COLUMNS.items()]
+    )
+
+
+def _utc_day(timestamp):
+    return cast(func.timezone("UTC", timestamp), Date)
+
+
+# The expressions are grouped through subqueries, postgres does not match
+# their bound parameters between the select list and the GROUP BY
+def _backfill_class_histograms():
+    queries = []
+    for label, column in PREDICTION_COLUMNS.items():
+        buckets = select(_histogram_bucket_expr(column).label("bucket")).subquery()
+        queries.append(
+            select(
+                cast(label, String).label("label"),
+                buckets.c.bucket,
+                func.count().label("count"),
+            ).group_by(buckets.c.bucket)
+        )
+    return insert(ClassHistogram).from_select(
+        ["label", "bucket", "count"], union_all(*queries)
+    )
+
+
+def _backfill_dominant_class_counts():
+    labels = select(_dominant_class_expr().label("label")).subquery()
+    query = select(labels.c.label, func.count().label("count")).group_by(
+        labels.c.label
+    )
+    return insert(DominantClassCount).from_select(["label", "count"], query)
+
+
+def _backfill_daily_beatmap_counts():
+    days = (
+        select(_utc_day(Beatmap.created_at).label("day"))
+        .where(Beatmap.created_at.isnot(None))
+        .subquery()
+    )
+    query = select(days.c.day, func.count().label("count")).group_by(days.c.day)
+    return insert(DailyBeatmapCount).from_select(["day", "count"], query)
+
+
+# Statement computing each statistics table from the beatmaps, by table name
+STATS_BACKFILL = {
+    ClassHistogram.__tablename__: _backfill_class_histograms,
+    DominantClassCount.__tablename__: _backfill_dominant_class_counts,
+    DailyBeatmapCount.__tablename__: _backfill_daily_beatmap_counts,
+}
+
+
+BEATMAPSET_COLUMNS = [
+    BeatmapSet.beatmapset_id,
+    BeatmapSet.artist,
+    BeatmapSet.title,
+    BeatmapSet.difficulty_count,
+    BeatmapSet.view_count,
+    *[getattr(BeatmapSet, f"{label}_mean") for label in LABELS],
+    *[getattr(BeatmapSet, f"{label}_max") for label in LABELS],
+    BeatmapSet.updated_at,
+]
+
+
 # Beatmap Data Access Layer
 class BeatmapDAL:
     def __init__(self, db_session: Session):
@@ -78,9 +422,13 @@ class BeatmapDAL:
         stamina: float,
         stream: float,
         tech: float,
-    ) -> None:
+        embedding: bytes = None,
+        features_hash: str = None,
+        model_version: str = None,
+        keep_version: str = None,
+    ) -> Optional[bool]:
         """
-        Create or update a beatmap
+        Create or update a beatmap, in the transaction of the session
         :param beatmap_id: Beatmap ID
         :param beatmapset_id: BeatmapSet ID
         :param artist: Beatmap artist
@@ -94,11 +442,31 @@ class BeatmapDAL:
         :param stamina: Stamina class probability
         :param stream: Stream class probability
         :param tech: Tech class probability
+        :param embedding: Encoded model embedding
+        :param features_hash: Content hash of the stored model inputs
+        :param model_version: Version of the model that made the predictions
+        :param keep_version: Model version whose predictions of the same features
+            are not replaced, e.g. the active full model when storing the distilled
+            predictions
+        :return: True if the beatmap was created, False if it was updated, None if
+            it was kept
         """
+        # Locked, so the statistics see the probabilities this update replaces
         q = await self.db_session.execute(
-            select(Beatmap).where(Beatmap.beatmap_id == beatmap_id)
+            select(Beatmap).where(Beatmap.beatmap_id == beatmap_id).with_for_update()
         )
-        if q.scalar() is None:
+        existing = q.scalar()
+        probabilities = {
+            "alternate": alternate,
+            "fingercontrol": fingercontrol,
+            "jump": jump,
+            "speed": speed,
+            "stamina": stamina,
+            "stream": stream,
+            "tech": tech,
+        }
+        stats = StatsDAL(self.db_session)
+        if existing is None:
             new_beatmap = Beatmap(
                 beatmap_id=beatmap_id,
                 beatmapset_id=beatmapset_id,
@@ -113,11 +481,29 @@ class BeatmapDAL:
                 stamina_p=stamina,
                 stream_p=stream,
                 tech_p=tech,
+                embedding=embedding,
+                features_hash=features_hash,
+                model_version=model_version,
                 view_count=0,
             )
             self.db_session.add(new_beatmap)
-            await self.db_session.commit()
+            # Written now so the set profile sees it, committed by the caller
+            # with the statistics and the profile
+            await self.db_session.flush()
+            await stats.record([], [probabilities], created=1)
         else:
+            # Same content already scored by that version. Edited content is
+            # stored, its version differs from the active one so it is re-scored
+            if (
+                keep_version is not None
+                and existing.model_version == keep_version
+                and existing.features_hash == features_hash
+            ):
+                return None
+            await stats.record(
+                [{label: getattr(existing, f"{label}_p") for label in LABELS}],
+                [probabilities],
+            )
             await self.db_session.execute(
                 update(Beatmap)
                 .where(Beatmap.beatmap_id == beatmap_id)
@@ -129,10 +515,19 @@ class BeatmapDAL:
                     stamina_p=stamina,
                     stream_p=stream,
                     tech_p=tech,
+                    # Predictions without an embedding keep the indexed one, until
+                    # the full model re-scores the beatmap
+                    embedding=embedding
+                    if embedding is not None
+                    else Beatmap.embedding,
+                    features_hash=features_hash,
+                    model_version=model_version,
                 )
             )
+        await self.refresh_beatmapsets([beatmapset_id])
+        return existing is None
 
-    async def get_beatmaps(self, limit, offset) -> List[Beatmap]:
+    async def get_beatmaps(self, limit, offset) -> List[dict]:
         """
         Get beatmaps sorted by most recently updated
         :return: List of all beatmaps
@@ -143,21 +538,10 @@ class BeatmapDAL:
             .limit(limit)
             .offset(offset)
         )
-        beatmaps = []
-        for beatmap_id, beatmapset_id, artist, title, creator, version, *_ in q:
-            beatmaps.append(
-                {
-                    "beatmap_id": beatmap_id,
-                    "beatmapset_id": beatmapset_id,
-                    "artist": artist,
-                    "title": title,
-                    "creator": creator,
-                    "version": version,
-                }
-            )
-        return beatmaps
+        # Rows are already shaped like the response, no need to copy them field by field
+        return [dict(row) for row in q.mappings()]
 
-    async def get_beatmaps_recent(self, limit, offset) -> List[Beatmap]:
+    async def get_beatmaps_recent(self, limit, offset) -> List[dict]:
         """
         Get beatmaps that are recently created
         :return: List of all beatmaps
@@ -168,21 +552,9 @@ class BeatmapDAL:
             .limit(limit)
             .offset(offset)
         )
-        beatmaps = []
-        for beatmap_id, beatmapset_id, artist, title, creator, version, *_ in q:
-            beatmaps.append(
-                {
-                    "beatmap_id": beatmap_id,
-                    "beatmapset_id": beatmapset_id,
-                    "artist": artist,
-                    "title": title,
-                    "creator": creator,
-                    "version": version,
-                }
-            )
-        return beatmaps
+        return [dict(row) for row in q.mappings()]
 
-    async def get_beatmaps_popular(self, limit, offset) -> List[Beatmap]:
+    async def get_beatmaps_popular(self, limit, offset) -> List[dict]:
         """
         Get popular beatmaps
         :return: List of all beatmaps
@@ -193,21 +565,9 @@ class BeatmapDAL:
             .limit(limit)
             .offset(offset)
         )
-        beatmaps = []
-        for beatmap_id, beatmapset_id, artist, title, creator, version, *_ in q:
-            beatmaps.append(
-                {
-                    "beatmap_id": beatmap_id,
-                    "beatmapset_id": beatmapset_id,
-                    "artist": artist,
-                    "title": title,
-                    "creator": creator,
-                    "version": version,
-                }
-            )
-        return beatmaps
+        return [dict(row) for row in q.mappings()]
 
-    async def get_beatmaps_preview(self) -> List[Beatmap]:
+    async def get_beatmaps_preview(self) -> Dict[str, List[dict]]:
         """
         Get six beatmaps for each category (popular, recently uploaded, recently updated).
         :return: List of beatmaps
@@ -221,7 +581,7 @@ class BeatmapDAL:
             "bRUpd": bRUpd,
         }
 
-    async def get_beatmap_by_set(self, beatmapset_id: int) -> List[Beatmap]:
+    async def get_beatmap_by_set(self, beatmapset_id: int) -> List[dict]:
         """
         Get a beatmap by ID
         :param beatmap_id: Beatmap ID
@@ -230,39 +590,600 @@ class BeatmapDAL:
         q = await self.db_session.execute(
             select(*SIMPLE_COLUMNS).where(Beatmap.beatmapset_id == beatmapset_id)
         )
-        beatmaps = []
-        for beatmap_id, beatmapset_id, artist, title, creator, version, *_ in q:
-            beatmaps.append(
-                {
-                    "beatmap_id": beatmap_id,
-                    "beatmapset_id": beatmapset_id,
-                    "artist": artist,
-                    "title": title,
-                    "creator": creator,
-                    "version": version,
-                }
-            )
-        return beatmaps
+        return [dict(row) for row in q.mappings()]
 
     async def get_beatmap_by_set_and_id(
         self, beatmapset_id: int, beatmap_id: int
-    ) -> Beatmap:
+    ) -> Optional[dict]:
         """
-        Get a beatmap by ID
+        Get a beatmap by ID, views are counted separately with add_views
         :param beatmap_id: Beatmap ID
-        :return: Beatmap
+        :return: Beatmap, None if not found
         """
         q = await self.db_session.execute(
-            select(Beatmap).where(
+            select(*FULL_COLUMNS).where(
                 Beatmap.beatmapset_id == beatmapset_id, Beatmap.beatmap_id == beatmap_id
             )
         )
-        beatmap = q.scalar()
+        beatmap = q.mappings().first()
+        return dict(beatmap) if beatmap is not None else None
+
+    async def add_views(self, counts: Dict[int, int]) -> None:
+        """
+        Add to the view count of many beatmaps in one statement
+        :param counts: Number of new views by beatmap ID
+        """
+        if not counts:
+            return
+        table = Beatmap.__table__
+        # Sorted, so concurrent flushes lock the rows in the same order
+        await self.db_session.execute(
+            update(table)
+            .where(table.c.beatmap_id == bindparam("_beatmap_id"))
+            .values(view_count=table.c.view_count + bindparam("_views")),
+            [
+                {"_beatmap_id": beatmap_id, "_views": n}
+                for beatmap_id, n in sorted(counts.items())
+            ],
+        )
+        await self.refresh_beatmapsets(await self._get_beatmapset_ids(list(counts)))
+
+    async def _get_beatmapset_ids(self, beatmap_ids: List[int]) -> List[int]:
+        q = await self.db_session.execute(
+            select(Beatmap.beatmapset_id)
+            .where(Beatmap.beatmap_id.in_(beatmap_ids))
+            .distinct()
+        )
+        return q.scalars().all()
+
+    async def refresh_beatmapsets(self, beatmapset_ids: List[int]) -> None:
+        """
+        Compute the profiles of beatmapsets again, after their difficulties changed
+        :param beatmapset_ids: BeatmapSet IDs
+        """
+        beatmapset_ids = sorted(set(beatmapset_ids))
+        if not beatmapset_ids:
+            return
+        # One refresh of a set at a time, so each one sees the difficulties
+        # committed by the others. Taken in order to avoid deadlocks.
+        await self.db_session.execute(
+            text(
+                "SELECT pg_advisory_xact_lock(id) "
+                "FROM unnest(CAST(:ids AS bigint[])) AS id ORDER BY id"
+            ),
+            {"ids": beatmapset_ids},
+        )
         await self.db_session.execute(
-            update(Beatmap)
+            refresh_beatmapsets_statement(Beatmap.beatmapset_id.in_(beatmapset_ids))
+        )
+
+    async def get_beatmapset_profile(self, beatmapset_id: int) -> Optional[dict]:
+        """
+        Get the profile of a beatmapset
+        :param beatmapset_id: BeatmapSet ID
+        :return: Class probabilities over the difficulties, difficulty count and
+            total views, None if not found
+        """
+        q = await self.db_session.execute(
+            select(*BEATMAPSET_COLUMNS).where(
+                BeatmapSet.beatmapset_id == beatmapset_id
+            )
+        )
+        profile = q.mappings().first()
+        return dict(profile) if profile is not None else None
+
+    async def get_beatmaps_by_class(
+        self,
+        sort: str,
+        filters: List[Tuple[str, str, float]],
+        limit: int,
+        cursor: Optional[Tuple[float, int]] = None,
+    ) -> List[dict]:
+        """
+        Get beatmaps filtered and ranked by their predicted class probabilities
+        :param sort: Class to sort by, in descending order
+        :param filters: List of (class, operator, value) predicates
+        :param limit: Number of beatmaps to return
+        :param cursor: (probability, beatmap_id) of the last beatmap of the previous page
+        :return: List of beatmaps
+        """
+        sort_column = PREDICTION_COLUMNS[sort]
+        query = select(*FULL_COLUMNS)
+        for label, op, value in filters:
+            query = query.where(FILTER_OPERATORS[op](PREDICTION_COLUMNS[label], value))
+        if cursor is not None:
+            # Keyset paging, continue right after the last row of the previous page
+            query = query.where(
+                tuple_(sort_column, Beatmap.beatmap_id) < tuple_(*cursor)
+            )
+        q = await self.db_session.execute(
+            query.order_by(desc(sort_column), desc(Beatmap.beatmap_id)).limit(limit)
+        )
+        return [dict(row) for row in q.mappings()]
+
+    async def get_embeddings(self, updated_since=None) -> List[Tuple[int, bytes]]:
+        """
+        Get the stored embeddings
+        :param updated_since: Only return beatmaps updated after this time
+        :return: List of (beatmap_id, embedding)
+        """
+        query = select(Beatmap.beatmap_id, Beatmap.embedding).where(
+            Beatmap.embedding.isnot(None)
+        )
+        if updated_since is not None:
+            query = query.where(Beatmap.updated_at > updated_since)
+        q = await self.db_session.execute(query)
+        return q.all()
+
+    async def get_feature_hashes(
+        self,
+        after_beatmap_id: int,
+        limit: int,
+        stale_version: Optional[str] = None,
+    ) -> List[Tuple[int, str, Optional[str]]]:
+        """
+        Get the beatmaps with stored features, in beatmap ID order
+        :param after_beatmap_id: Only return beatmaps with a greater ID (keyset paging)
+        :param limit: Number of beatmaps to return
+        :param stale_version: Only return beatmaps not predicted by this model version
+        :return: List of (beatmap_id, features_hash, model_version)
+        """
+        query = select(
+            Beatmap.beatmap_id, Beatmap.features_hash, Beatmap.model_version
+        ).where(
+            Beatmap.features_hash.isnot(None),
+            Beatmap.beatmap_id > after_beatmap_id,
+        )
+        if stale_version is not None:
+            query = query.where(Beatmap.model_version.is_distinct_from(stale_version))
+        q = await self.db_session.execute(
+            query.order_by(Beatmap.beatmap_id).limit(limit)
+        )
+        return q.all()
+
+    async def get_stored_predictions(
+        self, after_beatmap_id: int, limit: int
+    ) -> List[dict]:
+        """
+        Get the predictions of the beatmaps with stored features, in beatmap ID order
+        :param after_beatmap_id: Only return beatmaps with a greater ID (keyset paging)
+        :param limit: Number of beatmaps to return
+        :return: List of dicts with the beatmap_id, features_hash, model_version
+            and each class probability (alternate_p, fingercontrol_p, ...)
+        """
+        q = await self.db_session.execute(
+            select(
+                Beatmap.beatmap_id,
+                Beatmap.features_hash,
+                Beatmap.model_version,
+                *PREDICTION_COLUMNS.values(),
+            )
             .where(
-                Beatmap.beatmapset_id == beatmapset_id, Beatmap.beatmap_id == beatmap_id
+                Beatmap.features_hash.isnot(None),
+                Beatmap.beatmap_id > after_beatmap_id,
             )
-            .values(view_count=beatmap.view_count + 1)
+            .order_by(Beatmap.beatmap_id)
+            .limit(limit)
         )
-        return beatmap
+        return [dict(row) for row in q.mappings()]
+
+    async def update_predictions(self, predictions: List[dict]) -> int:
+        """
+        Update the predictions of many beatmaps in one statement
+        :param predictions: List of dicts with the beatmap_id, each class probability
+            (alternate, fingercontrol, ...), the encoded embedding and the model version.
+            With the features_hash and previous_version they were predicted from,
+            beatmaps changed since then are left as is
+        :return: Number of beatmaps updated
+        """
+        if not predictions:
+            return 0
+        # Locked, so the statistics see the probabilities this update replaces
+        q = await self.db_session.execute(
+            select(
+                Beatmap.beatmap_id,
+                Beatmap.features_hash,
+                Beatmap.model_version,
+                *PREDICTION_COLUMNS.values(),
+            )
+            .where(Beatmap.beatmap_id.in_([p["beatmap_id"] for p in predictions]))
+            .order_by(Beatmap.beatmap_id)
+            .with_for_update()
+        )
+        rows = {row["beatmap_id"]: row for row in q.mappings()}
+        # Predicted without a lock, skip the beatmaps uploaded or re-scored since
+        predictions = [
+            p
+            for p in predictions
+            if p["beatmap_id"] in rows and _unchanged(rows[p["beatmap_id"]], p)
+        ]
+        if not predictions:
+            return 0
+        old = [
+            {label: rows[p["beatmap_id"]][f"{label}_p"] for label in LABELS}
+            for p in predictions
+        ]
+        table = Beatmap.__table__
+        values = {f"{label}_p": bindparam(label) for label in LABELS}
+        # Core statement with a list of parameters, sent as a single executemany
+        await self.db_session.execute(
+            update(table)
+            .where(table.c.beatmap_id == bindparam("_beatmap_id"))
+            .values(
+                **values,
+                embedding=bindparam("_embedding"),
+                model_version=bindparam("_model_version"),
+            ),
+            [
+                {
+                    **{label: p[label] for label in LABELS},
+                    "_beatmap_id": p["beatmap_id"],
+                    "_embedding": p["embedding"],
+                    "_model_version": p["model_version"],
+                }
+                for p in predictions
+            ],
+        )
+        await StatsDAL(self.db_session).record(old, predictions)
+        await self.refresh_beatmapsets(
+            await self._get_beatmapset_ids([p["beatmap_id"] for p in predictions])
+        )
+        return len(predictions)
+
+    async def clear_feature_hashes(self, rows: List[Tuple[int, str]]) -> None:
+        """
+        Forget the stored features of beatmaps, when they are missing from the
+        feature store, so the re-scoring doesn't look for them again
+        :param rows: List of (beatmap_id, features_hash)
+        """
+        if not rows:
+            return
+        table = Beatmap.__table__
+        await self.db_session.execute(
+            update(table)
+            .where(
+                table.c.beatmap_id == bindparam("_beatmap_id"),
+                table.c.features_hash == bindparam("_features_hash"),
+            )
+            .values(features_hash=None),
+            [
+                {"_beatmap_id": beatmap_id, "_features_hash": features_hash}
+                for beatmap_id, features_hash in rows
+            ],
+        )
+
+    async def get_beatmaps_by_ids(
+        self, beatmap_ids: List[int], full: bool = False
+    ) -> List[dict]:
+        """
+        Get beatmaps by their IDs, in the order of the given IDs
+        :param beatmap_ids: Beatmap IDs
+        :param full: Include the predictions
+        :return: List of beatmaps, missing IDs are skipped
+        """
+        columns = FULL_COLUMNS if full else SIMPLE_COLUMNS
+        q = await self.db_session.execute(
+            select(*columns).where(Beatmap.beatmap_id.in_(beatmap_ids))
+        )
+        beatmaps = {row["beatmap_id"]: dict(row) for row in q.mappings()}
+        return [beatmaps[i] for i in beatmap_ids if i in beatmaps]
+
+    async def get_beatmaps_batch(
+        self, beatmap_ids: List[int], beatmapset_ids: List[int]
+    ) -> List[dict]:
+        """
+        Get beatmaps by their IDs and the beatmaps of sets, in one query
+        :param beatmap_ids: Beatmap IDs
+        :param beatmapset_ids: BeatmapSet IDs
+        :return: List of beatmaps with their predictions, the given beatmaps in
+            the order of their IDs, then the beatmaps of the sets in the order
+            of the set IDs
+        """
+        conditions = []
+        if beatmap_ids:
+            conditions.append(Beatmap.beatmap_id.in_(beatmap_ids))
+        if beatmapset_ids:
+            conditions.append(Beatmap.beatmapset_id.in_(beatmapset_ids))
+        if not conditions:
+            return []
+        q = await self.db_session.execute(
+            select(*FULL_COLUMNS).where(or_(*conditions)).order_by(Beatmap.beatmap_id)
+        )
+        rows = [dict(row) for row in q.mappings()]
+        by_id = {row["beatmap_id"]: row for row in rows}
+        beatmaps = [by_id.pop(i) for i in beatmap_ids if i in by_id]
+        set_order = {beatmapset_id: i for i, beatmapset_id in enumerate(beatmapset_ids)}
+        beatmaps.extend(
+            sorted(
+                (row for row in by_id.values() if row["beatmapset_id"] in set_order),
+                key=lambda row: set_order[row["beatmapset_id"]],
+            )
+        )
+        return beatmaps
+
+    async def stream_beatmaps(
+        self, updated_since: Optional[datetime] = None, batch_size: int = 1000
+    ) -> AsyncIterator[List[dict]]:
+        """
+        Stream every beatmap with its predictions in beatmap ID order, read with
+        a server-side cursor so only one batch is held in memory at a time
+        :param updated_since: Only return beatmaps updated after this time
+        :param batch_size: Number of rows fetched from the cursor at once
+        :return: Batches of beatmaps
+        """
+        query = select(*FULL_COLUMNS, Beatmap.view_count)
+        if updated_since is not None:
+            query = query.where(Beatmap.updated_at > updated_since)
+        result = await self.db_session.stream(
+            query.order_by(Beatmap.beatmap_id).execution_options(
+                max_row_buffer=batch_size
+            )
+        )
+        async for rows in result.mappings().partitions(batch_size):
+            yield [dict(row) for row in rows]
+
+    async def search_beatmaps(
+        self,
+        query: str,
+        limit: int,
+        cursor: Optional[Tuple[float, int]] = None,
+        threshold: float = 0.5,
+    ) -> List[dict]:
+        """
+        Search beatmaps by artist, title, creator and version.
+        Matches words starting like the query, with some typos allowed.
+        :param query: Search query
+        :param limit: Number of beatmaps to return
+        :param cursor: (score, beatmap_id) of the last beatmap of the previous page
+        :param threshold: Minimum word similarity for a beatmap to match
+        :return: List of beatmaps, best matches first
+        """
+        query = query.lower()
+        # Used by the <% operator, so the trigram index can filter the candidates
+        await self.db_session.execute(
+            select(
+                func.set_config(
+                    "pg_trgm.word_similarity_threshold", str(threshold), True
+                )
+            )
+        )
+        score = func.word_similarity(query, Beatmap.search_text)
+        q = select(*SIMPLE_COLUMNS, score.label("score")).where(
+            Beatmap.search_text.op("%>")(query)
+        )
+        if cursor is not None:
+            q = q.where(tuple_(score, Beatmap.beatmap_id) < tuple_(*cursor))
+        q = await self.db_session.execute(
+            q.order_by(desc(score), desc(Beatmap.beatmap_id)).limit(limit)
+        )
+        return [dict(row) for row in q.mappings()]
+
+
+# Prediction Job Data Access Layer
+class PredictionJobDAL:
+    def __init__(self, db_session: Session):
+        self.db_session = db_session
+
+    async def enqueue(self, content: str) -> int:
+        """
+        Queue a beatmap for prediction
+        :param content: Decoded .osu file content
+        :return: Job ID
+        """
+        job = PredictionJob(content=content, status=JobStatus.QUEUED, attempts=0)
+        self.db_session.add(job)
+        await self.db_session.flush()
+        return job.id
+
+    async def claim(
+        self, limit: int, timeout: float, max_attempts: int
+    ) -> List[PredictionJob]:
+        """
+        Claim queued jobs for this worker.
+        Jobs claimed by a worker that didn't finish them within `timeout` seconds
+        are claimed again, until they reach `max_attempts`.
+        Locked rows are skipped, so concurrent workers never claim the same job.
+        :param limit: Maximum number of jobs to claim
+        :param timeout: Seconds after which a running job is considered abandoned
+        :param max_attempts: Attempts before a job is marked as failed
+        :return: Claimed jobs
+        """
+        now = datetime.now(timezone.utc)
+        stale = and_(
+            PredictionJob.status == JobStatus.RUNNING,
+            PredictionJob.locked_at < now - timedelta(seconds=timeout),
+        )
+        # Give up on jobs that keep killing the workers
+        await self.db_session.execute(
+            update(PredictionJob)
+            .where(stale, PredictionJob.attempts >= max_attempts)
+            .values(
+                status=JobStatus.FAILED,
+                error_code=APIStatusCode.PREDICTION_FAILED,
+                content="",
+            )
+        )
+        q = await self.db_session.execute(
+            select(PredictionJob)
+            .where(or_(PredictionJob.status == JobStatus.QUEUED, stale))
+            .order_by(PredictionJob.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        jobs = q.scalars().all()
+        for job in jobs:
+            job.status = JobStatus.RUNNING
+            job.locked_at = now
+            job.attempts += 1
+        return jobs
+
+    async def complete(self, job_id: int, beatmap_id: int) -> None:
+        """
+        Mark a job as done, the content is dropped as it is no longer needed
+        :param job_id: Job ID
+        :param beatmap_id: ID of the predicted beatmap
+        """
+        await self.db_session.execute(
+            update(PredictionJob)
+            .where(PredictionJob.id == job_id)
+            .values(status=JobStatus.DONE, beatmap_id=beatmap_id, content="")
+        )
+
+    async def fail(self, job_id: int, error_code: int) -> None:
+        """
+        Mark a job as failed
+        :param job_id: Job ID
+        :param error_code: API status code describing the failure
+        """
+        await self.db_session.execute(
+            update(PredictionJob)
+            .where(PredictionJob.id == job_id)
+            .values(status=JobStatus.FAILED, error_code=error_code, content="")
+        )
+
+    async def get(self, job_id: int) -> Optional[PredictionJob]:
+        """
+        Get a job by ID
+        :param job_id: Job ID
+        :return: Job
+        """
+        q = await self.db_session.execute(
+            select(PredictionJob).where(PredictionJob.id == job_id)
+        )
+        return q.scalar()
+
+
+# Model Version Data Access Layer
+class ModelVersionDAL:
+    def __init__(self, db_session: Session):
+        self.db_session = db_session
+
+    async def register(self, version: str, weights_path: str) -> None:
+        """
+        Record a model version, it becomes active if no version is active yet
+        :param version: Model version
+        :param weights_path: Path of the weights file
+        """
+        await self.db_session.execute(
+            insert(ModelVersion)
+            .values(version=version, weights_path=weights_path, active=False)
+            .on_conflict_do_nothing(index_elements=[ModelVersion.version])
+        )
+        if await self.get_active() is None:
+            await self.activate(version)
+
+    async def activate(self, version: str) -> None:
+        """
+        Make a version the active one, the workers switch to it when they see the change
+        :param version: Model version
+        """
+        await self.db_session.execute(
+            update(ModelVersion)
+            .where(ModelVersion.active, ModelVersion.version != version)
+            .values(active=False)
+        )
+        await self.db_session.execute(
+            update(ModelVersion)
+            .where(ModelVersion.version == version)
+            .values(active=True, activated_at=func.now())
+        )
+
+    async def get_active(self) -> Optional[ModelVersion]:
+        """
+        Get the active model version
+        :return: Model version, None if no version was registered yet
+        """
+        q = await self.db_session.execute(
+            select(ModelVersion).where(ModelVersion.active)
+        )
+        return q.scalar()
+
+
+# Catalog Statistics Data Access Layer
+class StatsDAL:
+    def __init__(self, db_session: Session):
+        self.db_session = db_session
+
+    async def record(self, old: List[dict], new: List[dict], created: int = 0) -> None:
+        """
+        Update the statistics after predictions were replaced or added,
+        by the difference between the old and the new ones
+        :param old: Replaced probabilities, dicts with each class probability
+            (alternate, fingercontrol, ...)
+        :param new: New probabilities, in the same format
+        :param created: Number of new beatmaps
+        """
+        histogram, dominant = Counter(), Counter()
+        for probabilities, sign in [(p, -1) for p in old] + [(p, 1) for p in new]:
+            for label in LABELS:
+                histogram[label, histogram_bucket(probabilities[label])] += sign
+            dominant[dominant_class(probabilities)] += sign
+
+        # Every writer updates the rows in key order, to avoid deadlocks
+        histogram = sorted((key, n) for key, n in histogram.items() if n)
+        if histogram:
+            stmt = insert(ClassHistogram).values(
+                [
+                    {"label": label, "bucket": bucket, "count": n}
+                    for (label, bucket), n in histogram
+                ]
+            )
+            await self.db_session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[ClassHistogram.label, ClassHistogram.bucket],
+                    set_={"count": ClassHistogram.count + stmt.excluded.count},
+                )
+            )
+        dominant = sorted((label, n) for label, n in dominant.items() if n)
+        if dominant:
+            stmt = insert(DominantClassCount).values(
+                [{"label": label, "count": n} for label, n in dominant]
+            )
+            await self.db_session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[DominantClassCount.label],
+                    set_={"count": DominantClassCount.count + stmt.excluded.count},
+                )
+            )
+        if created:
+            stmt = insert(DailyBeatmapCount).values(
+                day=_utc_day(func.now()), count=created
+            )
+            await self.db_session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[DailyBeatmapCount.day],
+                    set_={"count": DailyBeatmapCount.count + stmt.excluded.count},
+                )
+            )
+
+    async def get_stats(self, days: int) -> dict:
+        """
+        Get the catalog statistics, read from the aggregate tables only
+        :param days: Number of days of daily counts to return
+        :return: Total beatmaps, class histograms, dominant class counts and
+            daily counts of the last days, most recent first
+        """
+        histograms = {label: [0] * STATS_HISTOGRAM_BUCKETS for label in LABELS}
+        q = await self.db_session.execute(select(ClassHistogram))
+        for row in q.scalars():
+            if row.label in histograms and row.bucket < STATS_HISTOGRAM_BUCKETS:
+                histograms[row.label][row.bucket] = row.count
+
+        dominant = {label: 0 for label in LABELS}
+        q = await self.db_session.execute(select(DominantClassCount))
+        for row in q.scalars():
+            dominant[row.label] = row.count
+
+        since = datetime.now(timezone.utc).date() - timedelta(days=days)
+        q = await self.db_session.execute(
+            select(DailyBeatmapCount.day, DailyBeatmapCount.count)
+            .where(DailyBeatmapCount.day > since)
+            .order_by(desc(DailyBeatmapCount.day))
+        )
+        return {
+            "total": sum(dominant.values()),
+            "histogram_buckets": STATS_HISTOGRAM_BUCKETS,
+            "histograms": histograms,
+            "dominant_classes": dominant,
+            "daily": [dict(row) for row in q.mappings()],
+        }
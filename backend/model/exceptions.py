@@ -12,3 +12,29 @@ class BeatmapTooLongException(Exception):
 
 class BeatmapUnsupportedException(Exception):
     pass
+
+
+class ModelNotReadyException(Exception):
+    pass
+
+
+class InvalidQueryException(Exception):
+    def __init__(self, reason: str = None) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RateLimitedException(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class OverloadedException(Exception):
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class ForbiddenException(Exception):
+    pass
@@ -0,0 +1,176 @@
+from typing import Dict, Optional, Tuple, Union
+
+import hashlib
+import torch
+
+from const import *
+from model.classifier import OsuClassifier, StudentClassifier
+
+
+# Models loaded in this process by version, shared with forked workers when preloaded
+_models: Dict[str, OsuClassifier] = {}
+# (version, model) serving the predictions, swapped as a whole
+_active: Optional[Tuple[str, OsuClassifier]] = None
+# (version, model) of the distilled fast tier
+_student: Optional[Tuple[str, StudentClassifier]] = None
+
+
+def build_model() -> OsuClassifier:
+    """
+    Build the classifier with the configuration from const.py
+    """
+    return OsuClassifier(
+        MAP_INFO_FEATURES,
+        HIT_OBJECTS_FEATURES,
+        SLIDER_POINTS_FEATURES,
+        NUM_CLASSES,
+        hidden_size=HIDDEN_SIZE,
+        key_size=KEY_SIZE,
+        value_size=VALUE_SIZE,
+        n_layers=N_LAYERS,
+        attn_n_layers=ATTN_N_LAYERS,
+        n_heads=N_HEADS,
+        bidirectional=BIDIRECTIONAL,
+        dropout=DROPOUT,
+        attn_chunk_size=ATTN_CHUNK_SIZE,
+        map_info_stats=(MAP_INFO_MEAN, MAP_INFO_STD),
+        hit_objects_stats=(HIT_OBJECTS_MEAN, HIT_OBJECTS_STD),
+        slider_points_stats=(SLIDER_POINTS_MEAN, SLIDER_POINTS_STD),
+    )
+
+
+def build_student() -> StudentClassifier:
+    """
+    Build the distilled classifier with the configuration from const.py
+    """
+    return StudentClassifier(
+        MAP_INFO_FEATURES,
+        HIT_OBJECTS_FEATURES,
+        SLIDER_POINTS_FEATURES,
+        NUM_CLASSES,
+        map_info_stats=(MAP_INFO_MEAN, MAP_INFO_STD),
+        hit_objects_stats=(HIT_OBJECTS_MEAN, HIT_OBJECTS_STD),
+        slider_points_stats=(SLIDER_POINTS_MEAN, SLIDER_POINTS_STD),
+    )
+
+
+def weights_version(path: str) -> str:
+    """
+    Version of a weights file, the start of the sha256 of its content.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def load_version(path: str) -> Tuple[str, OsuClassifier]:
+    """
+    Load the classifier weights, only once per process and version.
+    The tensors are moved to shared memory, so workers forked after this
+    call use the same weights instead of each holding a copy.
+    The first version loaded becomes the active one.
+    :return: (version, model)
+    """
+    version = weights_version(path)
+    model = _models.get(version)
+    if model is None:
+        model = build_model()
+        model.load_state_dict(torch.load(path, map_location=torch.device("cpu")))
+        model.eval()
+        model.share_memory()
+        _models[version] = model
+    if _active is None:
+        activate(version)
+    return version, model
+
+
+def load_model(path: str = MODEL_WEIGHTS_PATH) -> OsuClassifier:
+    """
+    Load the classifier weights, see load_version.
+    """
+    return load_version(path)[1]
+
+
+def activate(version: str) -> None:
+    """
+    Switch the predictions to a loaded version.
+    The other versions are dropped, requests still using them keep their reference.
+    """
+    global _active
+    _active = (version, _models[version])
+    for other in list(_models):
+        if other != version:
+            del _models[other]
+
+
+def switch_model(version: str, path: str) -> bool:
+    """
+    Load and warm up the weights of a version next to the active model,
+    then switch to it.
+    :return: False if the weights file doesn't match the version
+    """
+    loaded_version, model = load_version(path)
+    if loaded_version != version:
+        return False
+    warm_up(model)
+    activate(version)
+    return True
+
+
+def load_student(
+    path: str = STUDENT_WEIGHTS_PATH,
+) -> Tuple[str, StudentClassifier]:
+    """
+    Load the distilled classifier weights, only once per process.
+    Its version is prefixed with "student-", so its predictions are re-scored
+    by the full model in the background.
+    :return: (version, model)
+    """
+    global _student
+    if _student is None:
+        model = build_student()
+        model.load_state_dict(torch.load(path, map_location=torch.device("cpu")))
+        model.eval()
+        model.share_memory()
+        _student = (f"student-{weights_version(path)}", model)
+    return _student
+
+
+def get_student() -> Optional[Tuple[str, StudentClassifier]]:
+    """
+    Get the (version, distilled classifier), None if it is not loaded
+    """
+    return _student
+
+
+def get_model() -> OsuClassifier:
+    """
+    Get the active classifier, None if it has not been loaded yet
+    """
+    return _active[1] if _active is not None else None
+
+
+def get_active_model() -> Tuple[str, OsuClassifier]:
+    """
+    Get the active (version, classifier), read at once so they always match.
+    """
+    return _active
+
+
+@torch.no_grad()
+def warm_up(
+    model: Union[OsuClassifier, StudentClassifier], length: int = 64
+) -> None:
+    """
+    Run a forward pass on dummy data, so the first request doesn't pay
+    for the lazy initialization inside torch.
+    """
+    model(
+        torch.zeros(1, model.map_info_features),
+        torch.zeros(1, length, model.hit_objects_features),
+        torch.zeros(1, length, model.slider_points_features),
+        [length],
+        [length],
+    )
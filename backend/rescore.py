@@ -0,0 +1,137 @@
+"""
+Re-score beatmaps with stored features, without parsing the beatmaps again.
+
+usage: python rescore.py [--weights path/to/weights.pt] [--batch-size N] [--stale-only]
+"""
+import asyncio
+import argparse
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import humanize
+
+from const import *
+from config.db import async_session
+from config.runtime import configure_torch
+from model.db import BeatmapDAL
+from model.loader import load_version
+from utils.features import FeatureStore
+from utils.knn import encode_embedding
+from utils.predict import predict_features
+
+
+async def predict_stored(
+    model,
+    model_version: str,
+    feature_store: FeatureStore,
+    rows: List[Tuple[int, str, Optional[str]]],
+) -> Tuple[List[dict], List[Tuple[int, str]]]:
+    """
+    Predict beatmaps again from their stored features.
+    :param rows: List of (beatmap_id, features_hash, model_version)
+    :return: Predictions, as expected by BeatmapDAL.update_predictions, and the
+        (beatmap_id, features_hash) of the beatmaps whose features are missing
+    """
+    loop = asyncio.get_running_loop()
+    predictions = []
+    missing = []
+    for beatmap_id, features_hash, previous_version in rows:
+        try:
+            features = await loop.run_in_executor(
+                None, feature_store.get, features_hash
+            )
+        except KeyError:
+            missing.append((beatmap_id, features_hash))
+            continue
+        map_type, embedding = predict_features(model, *features)
+        predictions.append(
+            {
+                "beatmap_id": beatmap_id,
+                **map_type,
+                "embedding": encode_embedding(embedding),
+                "model_version": model_version,
+                "features_hash": features_hash,
+                "previous_version": previous_version,
+            }
+        )
+    if missing:
+        # Features written by another pod are missing when the store isn't shared
+        print(
+            f"WARNING: no features in {feature_store.root} for {len(missing)} of "
+            f"{len(rows)} beatmaps, they are not re-scored: "
+            f"{[beatmap_id for beatmap_id, _ in missing]}"
+        )
+    return predictions, missing
+
+
+async def rescore(
+    model,
+    model_version: str,
+    feature_store: FeatureStore,
+    batch_size: int,
+    stale_only: bool = False,
+) -> int:
+    """
+    Predict beatmaps again from their stored features, a batch at a time.
+    :param stale_only: Skip the beatmaps already predicted by this model version
+    :return: Number of beatmaps updated
+    """
+    last_beatmap_id = 0
+    updated = 0
+    missing = 0
+    while True:
+        async with async_session() as session:
+            async with session.begin():
+                rows = await BeatmapDAL(session).get_feature_hashes(
+                    last_beatmap_id,
+                    batch_size,
+                    stale_version=model_version if stale_only else None,
+                )
+        if not rows:
+            if missing:
+                print(
+                    f"WARNING: {missing} beatmaps were not re-scored, "
+                    "their features are missing"
+                )
+            return updated
+        last_beatmap_id = rows[-1][0]
+
+        predictions, missing_rows = await predict_stored(
+            model, model_version, feature_store, rows
+        )
+        async with async_session() as session:
+            async with session.begin():
+                dal = BeatmapDAL(session)
+                updated += await dal.update_predictions(predictions)
+                await dal.clear_feature_hashes(missing_rows)
+        missing += len(missing_rows)
+        print(f"Re-scored {updated} beatmaps (last id={last_beatmap_id})")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_PATH)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument(
+        "--stale-only",
+        action="store_true",
+        help="Only re-score beatmaps predicted by another model version",
+    )
+    args = parser.parse_args()
+
+    configure_torch()
+    model_version, model = load_version(args.weights)
+    feature_store = FeatureStore(FEATURE_STORE_PATH, FEATURE_STORE_COMPRESS)
+
+    start = datetime.now()
+    updated = await rescore(
+        model, model_version, feature_store, args.batch_size, args.stale_only
+    )
+    print(
+        f"Done! Re-scored {updated} beatmaps with model {model_version} in "
+        f"{humanize.precisedelta(datetime.now() - start)}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+"""
+Checks of the prediction worker against a real database, the one of the DB_*
+variables. It writes a job and a beatmap, use a scratch database.
+
+usage: DB_HOST=... DB_USER=... DB_PASS=... DB_NAME=... python -m pytest tests
+"""
+import os
+import random
+import asyncio
+
+import pytest
+
+if "DB_HOST" not in os.environ:
+    pytest.skip(
+        "needs a database (DB_HOST, DB_USER, DB_PASS, DB_NAME)",
+        allow_module_level=True,
+    )
+pytest.importorskip("torch")
+
+import numpy as np
+
+import worker
+from const import *
+from config.db import engine, async_session
+from model.db import BeatmapDAL, JobStatus, PredictionJobDAL, init_db
+
+
+class _Beatmap:
+    def __init__(self, beatmap_id: int) -> None:
+        self.metadata = {
+            "beatmap_id": beatmap_id,
+            "beatmapset_id": beatmap_id,
+            "artist": "artist",
+            "title": "title",
+            "creator": "creator",
+            "version": "version",
+        }
+
+
+class _FeatureStore:
+    def put(self, features_hash, features) -> None:
+        pass
+
+
+def test_batch_with_new_beatmap_is_done(monkeypatch):
+    # Not stored yet, so the beatmap is created
+    beatmap_id = random.randint(1 << 30, (1 << 31) - 1)
+
+    async def parse_beatmap(content):
+        return _Beatmap(beatmap_id)
+
+    async def extract_features(bm):
+        return None, None, None
+
+    def predict_features(model, *features):
+        return (
+            {label: 0.5 for label in LABELS},
+            np.zeros(HIDDEN_SIZE, dtype=np.float32),
+        )
+
+    monkeypatch.setattr(worker, "parse_beatmap", parse_beatmap)
+    monkeypatch.setattr(worker, "extract_features", extract_features)
+    monkeypatch.setattr(worker, "predict_features", predict_features)
+
+    async def run():
+        async with engine.begin() as conn:
+            await conn.run_sync(init_db)
+        async with async_session() as session:
+            async with session.begin():
+                dal = PredictionJobDAL(session)
+                job = await dal.get(await dal.enqueue("content"))
+
+        await worker.process_jobs(None, "test", _FeatureStore(), [job])
+
+        async with async_session() as session:
+            async with session.begin():
+                done = await PredictionJobDAL(session).get(job.id)
+                beatmap = await BeatmapDAL(session).get_beatmap_by_set_and_id(
+                    beatmap_id, beatmap_id
+                )
+        return done, beatmap
+
+    done, beatmap = asyncio.run(run())
+    assert done.status == JobStatus.DONE
+    assert done.beatmap_id == beatmap_id
+    assert beatmap is not None
+    assert beatmap["model_version"] == "test"
+
+
+def test_failed_write_only_fails_its_job(monkeypatch):
+    beatmap_ids = iter(random.sample(range(1 << 30, (1 << 31) - 1), 2))
+    good_id, bad_id = next(beatmap_ids), next(beatmap_ids)
+    contents = {"good": good_id, "bad": bad_id}
+
+    async def parse_beatmap(content):
+        return _Beatmap(contents[content])
+
+    async def extract_features(bm):
+        return None, None, None
+
+    def predict_features(model, *features):
+        return (
+            {label: 0.5 for label in LABELS},
+            np.zeros(HIDDEN_SIZE, dtype=np.float32),
+        )
+
+    create_or_update_beatmap = BeatmapDAL.create_or_update_beatmap
+
+    async def failing_create_or_update_beatmap(self, beatmap_id, **kwargs):
+        if beatmap_id == bad_id:
+            raise ValueError("broken row")
+        return await create_or_update_beatmap(self, beatmap_id=beatmap_id, **kwargs)
+
+    monkeypatch.setattr(worker, "parse_beatmap", parse_beatmap)
+    monkeypatch.setattr(worker, "extract_features", extract_features)
+    monkeypatch.setattr(worker, "predict_features", predict_features)
+    monkeypatch.setattr(
+        BeatmapDAL, "create_or_update_beatmap", failing_create_or_update_beatmap
+    )
+
+    async def run():
+        async with engine.begin() as conn:
+            await conn.run_sync(init_db)
+        async with async_session() as session:
+            async with session.begin():
+                dal = PredictionJobDAL(session)
+                jobs = [await dal.get(await dal.enqueue(c)) for c in ("bad", "good")]
+
+        await worker.process_jobs(None, "test", _FeatureStore(), jobs)
+
+        async with async_session() as session:
+            async with session.begin():
+                dal = PredictionJobDAL(session)
+                return [await dal.get(job.id) for job in jobs]
+
+    bad, good = asyncio.run(run())
+    assert bad.status == JobStatus.FAILED
+    assert bad.error_code == APIStatusCode.PREDICTION_FAILED
+    assert good.status == JobStatus.DONE
+    assert good.beatmap_id == good_id
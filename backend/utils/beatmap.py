@@ -1,12 +1,21 @@
-from typing import AsyncGenerator, Dict, List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Tuple, Union
 from aiofiles.threadpool.text import AsyncTextIOWrapper
 
+import re
 import enum
+import numpy as np
 
 from model.exceptions import (
     InvalidFileException,
+    BeatmapTooLongException,
     BeatmapUnsupportedException,
 )
+from const import (
+    HIT_OBJECTS_FEATURES,
+    MAP_INFO_FEATURES,
+    SLIDER_POINTS_FEATURES,
+    MAX_HIT_OBJECTS,
+)
 
 
 _SECTION_TYPES = {
@@ -20,6 +29,48 @@ _SECTION_TYPES = {
     "HitObjects": "b",
 }
 
+# Sections read by the classifier, the others are skipped and only parsed when accessed
+_USED_SECTIONS = {"Metadata", "Difficulty", "HitObjects"}
+
+_SECTION_HEADER = re.compile(r"^\[(\w+)\][ \t]*$", re.MULTILINE)
+
+
+class Sections(dict):
+    """
+    Parsed sections by name.
+    Skipped sections are stored as (start, end) offsets into the file content,
+    they are parsed the first time they are accessed.
+    """
+
+    def __init__(self, content: str, parse: Callable[[str, str], Union[Dict, List]]):
+        super().__init__()
+        self._content = content
+        self._parse = parse
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+
+    def skip(self, name: str, start: int, end: int) -> None:
+        self._offsets[name] = (start, end)
+
+    @property
+    def skipped(self) -> List[str]:
+        """
+        Names of the sections that were not parsed yet.
+        """
+        return list(self._offsets)
+
+    def __missing__(self, name: str):
+        if name not in self._offsets:
+            raise KeyError(name)
+        start, end = self._offsets.pop(name)
+        self[name] = value = self._parse(name, self._content[start:end])
+        return value
+
+    def __contains__(self, name) -> bool:
+        return super().__contains__(name) or name in self._offsets
+
+    def get(self, name: str, default=None):
+        return self[name] if name in self else default
+
 
 def map_to_class(_cls, data):
     """
@@ -147,27 +198,56 @@ class Beatmap:
     """
 
     @classmethod
-    async def create(cls, file_object: AsyncTextIOWrapper):
+    async def create(cls, file_object: AsyncTextIOWrapper, lazy: bool = True):
+        """
+        Creates a new beatmap object from a .osu file.
+        """
+        return cls.from_content(await file_object.read(), lazy=lazy)
+
+    @classmethod
+    def from_content(cls, content: str, lazy: bool = True):
         """
-        Creates a new beatmap object.
+        Creates a new beatmap object from the content of a .osu file.
+        With `lazy`, only the sections used by the classifier are parsed,
+        the others are parsed if they are accessed.
         """
         self = Beatmap()
-        self.file_object = file_object
-        self.sections = {}
-        self.format_version = (await self.file_object.readline()).rstrip()
+        self.format_version = content.split("\n", 1)[0].rstrip()
         if not self.format_version.startswith("osu file format"):
             print("Invalid file!")
             raise InvalidFileException()
         if int(self.format_version[-2:]) < 12:
             print("Invalid file version!")
             raise BeatmapUnsupportedException()
-        await self.parse_sections()
+        self.sections = Sections(content, self._parse_section)
+        for section, start, end in self._find_sections(content):
+            if lazy and section not in _USED_SECTIONS:
+                self.sections.skip(section, start, end)
+            else:
+                self.sections[section] = self._parse_section(
+                    section, content[start:end]
+                )
         map_to_class(HitObjects, self.sections["HitObjects"])
         return self
 
-    async def get_data(self) -> Tuple[List, List, List]:
+    @property
+    def metadata(self) -> Dict:
+        """
+        Beatmap identifiers and names, as stored in the database.
         """
-        Converts the beatmap to an array.
+        return {
+            "beatmap_id": self.sections["Metadata"]["BeatmapID"],
+            "beatmapset_id": self.sections["Metadata"]["BeatmapSetID"],
+            "artist": self.sections["Metadata"]["Artist"],
+            "title": self.sections["Metadata"]["Title"],
+            "creator": self.sections["Metadata"]["Creator"],
+            "version": self.sections["Metadata"]["Version"],
+        }
+
+    async def get_data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Converts the beatmap to float32 arrays.
+        Each array is allocated once and filled in place.
         structure:
         map_info = [
             hp, # HP Drain
@@ -182,6 +262,7 @@ class Beatmap:
             x, # Object position
             y, # Object position
             time, # Object time
+            time, # Placeholder for the time delta, see data.add_diff_dim
             type, # Object type
             new_combo, # Is new combo
         ]
@@ -194,7 +275,8 @@ class Beatmap:
             length, # Slider length
         ]
         """
-        map_info = [
+        map_info = np.empty(MAP_INFO_FEATURES, dtype=np.float32)
+        map_info[:] = (
             self.sections["Difficulty"]["HPDrainRate"],
             self.sections["Difficulty"]["CircleSize"],
             self.sections["Difficulty"]["OverallDifficulty"],
@@ -202,52 +284,70 @@ class Beatmap:
             self.sections["Difficulty"]["SliderMultiplier"],
             self.sections["Difficulty"]["SliderTickRate"],
             self.sections["HitObjects"][-1].time,
-        ]
-        hit_objects = []
-        slider_points = []
-        for hit_object in self.sections["HitObjects"]:
-            data = [
+        )
+
+        objects = self.sections["HitObjects"]
+        # Every slider contributes one row per control point, other objects one empty row
+        n_slider_points = sum(
+            len(hit_object.object_params.points)
+            if hit_object.type == HitObjects._Type.SLIDER
+            else 1
+            for hit_object in objects
+        )
+        hit_objects = np.empty((len(objects), HIT_OBJECTS_FEATURES), dtype=np.float32)
+        slider_points = np.zeros(
+            (n_slider_points, SLIDER_POINTS_FEATURES), dtype=np.float32
+        )
+
+        i = 0
+        for j, hit_object in enumerate(objects):
+            hit_objects[j] = (
                 hit_object.x,
                 hit_object.y,
                 hit_object.time,
+                hit_object.time,
                 hit_object.type.value,
                 int(hit_object.new_combo),
-            ]
+            )
 
             if hit_object.type == HitObjects._Type.SLIDER:
-                for x, y in hit_object.object_params.points:
-                    slider_points.append(
-                        [
-                            x,
-                            y,
-                            hit_object.time,
-                            hit_object.object_params.type.value,
-                            hit_object.object_params.slides,
-                            hit_object.object_params.length,
-                        ]
+                params = hit_object.object_params
+                for x, y in params.points:
+                    slider_points[i] = (
+                        x,
+                        y,
+                        hit_object.time,
+                        params.type.value,
+                        params.slides,
+                        params.length,
                     )
+                    i += 1
             else:
-                slider_points.append([0, 0, 0, 0, 0, 0])
-            hit_objects.append(data)
+                # Row is already zeroed
+                i += 1
 
         return map_info, hit_objects, slider_points
 
-    async def parse_sections(self):
+    @staticmethod
+    def _find_sections(content: str) -> Iterator[Tuple[str, int, int]]:
         """
-        Parses the beatmap file and stores the sections in a dictionary.
+        Find the known sections, without reading their content.
+        :return: (name, start, end) of each section body in the content
         """
-        async for section in self._parse_section_header():
-            func = f"_read_type_{_SECTION_TYPES[section]}_section"
-            self.sections[section] = await getattr(self, func)()
-
-    async def _parse_section_header(self) -> AsyncGenerator[str, None]:
+        headers = list(_SECTION_HEADER.finditer(content))
+        for i, header in enumerate(headers):
+            if header.group(1) not in _SECTION_TYPES:
+                continue
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(content)
+            yield header.group(1), header.end() + 1, end
+
+    def _parse_section(self, name: str, body: str) -> Union[Dict, List]:
         """
-        Parses the section header.
+        Parse the body of a section, up to the first empty line.
         """
-        async for line in self.file_object:
-            line = line.rstrip()
-            if line.startswith("["):
-                yield line[1:-1]
+        lines = body.split("\n")
+        func = f"_read_type_{_SECTION_TYPES[name]}_section"
+        return getattr(self, func)(lines)
 
     def _parse_value(self, val: str) -> Union[int, str, float]:
         """
@@ -260,34 +360,45 @@ class Beatmap:
         else:
             return val
 
-    async def _read_type_a_section(self) -> Dict:
+    def _read_type_a_section(self, lines: List[str]) -> Dict:
         """
         Read the A section, where each line is a key-value pair.
         """
         d = {}
 
-        line = await self.file_object.readline()
-        line = line.rstrip()
-        while line != "":
+        for line in lines:
+            line = line.rstrip()
+            if line == "":
+                break
             k, v = line.split(":", 1)
             d[k] = self._parse_value(v.strip())
-            line = await self.file_object.readline()
-            line = line.rstrip()
 
         return d
 
-    async def _read_type_b_section(self) -> List:
+    def _read_type_b_section(self, lines: List[str]) -> List:
         """
         Read the B section, where each line is a list of values.
         """
         l = []
 
-        line = await self.file_object.readline()
-        line = line.rstrip()
-        while line != "":
+        for line in lines:
+            line = line.rstrip()
+            if line == "":
+                break
             if not line.lstrip().startswith("//"):
                 l.append(list(map(self._parse_value, line.split(","))))
-            line = await self.file_object.readline()
-            line = line.rstrip()
 
         return l
+
+
+async def parse_beatmap(content: str) -> Beatmap:
+    """
+    Parse the content of a .osu file.
+    Raises BeatmapTooLongException if the beatmap has too many hit objects to predict.
+    """
+    bm = Beatmap.from_content(content)
+
+    if len(bm.sections["HitObjects"]) >= MAX_HIT_OBJECTS:
+        print("Beatmap too long!")
+        raise BeatmapTooLongException()
+    return bm
@@ -1,27 +1,17 @@
-from typing import Tuple
-from numpy.typing import ArrayLike
-
 import numpy as np
 
-from const import *
+from const import HIT_OBJECTS_FEATURES
 
 
 def add_diff_dim(arr):
-    """Add a dimension to the array"""
-    # Duplicate the time column (index 2)
-    new_arr = np.insert(arr, 3, arr[:, 2], axis=1)
-    diff = new_arr[1:, 3] - new_arr[:-1, 3]
-    new_arr[1:, 3] = diff
-    new_arr[0, 3] = 0
-    return new_arr
-
-
-def standardize(
-    map_info: ArrayLike, hit_objects: ArrayLike, slider_points: ArrayLike
-) -> Tuple[ArrayLike, ArrayLike, ArrayLike]:
-    """Standardize the map info, hit objects and slider points"""
-    return (
-        (map_info - MAP_INFO_MEAN) / MAP_INFO_STD,
-        (hit_objects - HIT_OBJECTS_MEAN) / HIT_OBJECTS_STD,
-        (slider_points - SLIDER_POINTS_MEAN) / SLIDER_POINTS_STD,
-    )
+    """
+    Add the time delta dimension to the array.
+    Arrays coming from Beatmap.get_data already have the time column (index 2)
+    duplicated at index 3, in which case the delta is computed in place.
+    """
+    if arr.shape[1] != HIT_OBJECTS_FEATURES:
+        # Duplicate the time column (index 2)
+        arr = np.insert(arr, 3, arr[:, 2], axis=1)
+    np.subtract(arr[1:, 2], arr[:-1, 2], out=arr[1:, 3])
+    arr[0, 3] = 0
+    return arr
@@ -0,0 +1,40 @@
+from typing import List
+
+import io
+import csv
+from datetime import datetime
+
+import orjson
+
+
+def to_ndjson(rows: List[dict], header: bool = False) -> bytes:
+    """
+    One JSON object per line, there is no header since every line names its fields.
+    """
+    return b"".join(orjson.dumps(row) + b"\n" for row in rows)
+
+
+def to_csv(rows: List[dict], header: bool = False) -> bytes:
+    """
+    CSV lines of the rows, preceded by the column names if `header` is set.
+    Dates are written in ISO 8601 and missing values as empty fields.
+    """
+    if not rows:
+        return b""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(rows[0].keys())
+    for row in rows:
+        writer.writerow(
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in row.values()
+        )
+    return buffer.getvalue().encode()
+
+
+# Encoder and content type of each export format
+EXPORT_FORMATS = {
+    "ndjson": (to_ndjson, "application/x-ndjson"),
+    "csv": (to_csv, "text/csv"),
+}
@@ -0,0 +1,91 @@
+from typing import Tuple
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+FEATURE_NAMES = ("map_info", "hit_objects", "slider_points")
+
+
+def content_hash(content: str) -> str:
+    """
+    Content address of a beatmap, the sha256 of the decoded .osu file.
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class FeatureStore:
+    """
+    Stores the float32 model inputs of each beatmap, keyed by content hash.
+
+    Compressed entries are a single .npz file (zlib), smaller on disk but
+    decompressed on every read. Uncompressed entries are a
+    directory of .npy files, which are memory-mapped on read. Both layouts can
+    be read whatever the store is configured to write.
+    """
+
+    def __init__(self, root: str, compress: bool = True) -> None:
+        self.root = root
+        self.compress = compress
+
+    def _path(self, key: str) -> str:
+        # Two levels of fan-out, so a directory never holds too many entries
+        return os.path.join(self.root, key[:2], key)
+
+    def __contains__(self, key: str) -> bool:
+        path = self._path(key)
+        return os.path.exists(f"{path}.npz") or os.path.isdir(path)
+
+    def put(self, key: str, features: Tuple[np.ndarray, ...]) -> None:
+        """
+        Store the features of a beatmap, existing entries are left untouched
+        since the same content always gives the same features.
+        """
+        if key in self:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = dict(zip(FEATURE_NAMES, features))
+        # Written to a temporary entry of its own next to the final path and
+        # renamed, readers never see partial entries
+        directory = os.path.dirname(path)
+        if self.compress:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, **arrays)
+                os.replace(tmp, f"{path}.npz")
+            except BaseException:
+                os.remove(tmp)
+                raise
+        else:
+            tmp = tempfile.mkdtemp(suffix=".tmp", dir=directory)
+            try:
+                for name, arr in arrays.items():
+                    np.save(os.path.join(tmp, f"{name}.npy"), arr)
+                os.rename(tmp, path)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                # Written by someone else in the meantime
+                if not os.path.isdir(path):
+                    raise
+
+    def get(self, key: str) -> Tuple[np.ndarray, ...]:
+        """
+        Load the features of a beatmap.
+        Raises KeyError if they are not stored.
+        """
+        path = self._path(key)
+        if os.path.isdir(path):
+            return tuple(
+                np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                for name in FEATURE_NAMES
+            )
+        try:
+            with np.load(f"{path}.npz") as f:
+                return tuple(f[name] for name in FEATURE_NAMES)
+        except FileNotFoundError:
+            raise KeyError(key)
@@ -0,0 +1,187 @@
+from typing import Callable, Dict, List, Set
+
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+
+import asyncpg
+import orjson
+from sqlalchemy import text
+
+from const import LABELS
+from model.exceptions import OverloadedException
+
+
+def feed_event(metadata: dict, map_type: Dict[str, float], model_version: str) -> dict:
+    """
+    Feed event of a stored prediction, shaped like the beatmaps of /beatmaps/recent
+    with the predictions.
+    """
+    return {
+        **metadata,
+        **{f"{label}_p": map_type[label] for label in LABELS},
+        "model_version": model_version,
+    }
+
+
+class FeedBackend(ABC):
+    """
+    Transport of the feed messages.
+    Backends shared between replicas implement the same interface, so the
+    in-memory one can stand in for them locally and in tests.
+    """
+
+    @abstractmethod
+    async def publish(self, messages: List[str]) -> None:
+        """
+        Send messages to every listener, including the ones of this process.
+        """
+
+    @abstractmethod
+    async def listen(self, callback: Callable[[str], None]) -> None:
+        """
+        Call `callback` with every published message, until cancelled.
+        """
+
+
+class InMemoryFeedBackend(FeedBackend):
+    """
+    Messages delivered within the process, each worker has its own feed.
+    """
+
+    def __init__(self) -> None:
+        self._callbacks: List[Callable[[str], None]] = []
+
+    async def publish(self, messages: List[str]) -> None:
+        for message in messages:
+            for callback in self._callbacks:
+                callback(message)
+
+    async def listen(self, callback: Callable[[str], None]) -> None:
+        self._callbacks.append(callback)
+        try:
+            await asyncio.Future()
+        finally:
+            self._callbacks.remove(callback)
+
+
+class PostgresFeedBackend(FeedBackend):
+    """
+    Messages sent with postgres NOTIFY, every replica and the prediction
+    workers share the feed. The listener keeps a connection of its own,
+    and reconnects when it is lost. Messages sent while it is disconnected
+    are missed, the feed is best effort.
+    """
+
+    _NOTIFY = text("SELECT pg_notify(:channel, :message)")
+
+    def __init__(
+        self,
+        session_factory,
+        dsn: str,
+        channel: str = "beatmap_feed",
+        ping_interval: float = 10,
+    ) -> None:
+        self.session_factory = session_factory
+        self.dsn = dsn
+        self.channel = channel
+        self.ping_interval = ping_interval
+
+    async def publish(self, messages: List[str]) -> None:
+        if not messages:
+            return
+        async with self.session_factory() as session:
+            async with session.begin():
+                for message in messages:
+                    await session.execute(
+                        self._NOTIFY, {"channel": self.channel, "message": message}
+                    )
+
+    async def listen(self, callback: Callable[[str], None]) -> None:
+        while True:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                try:
+                    await conn.add_listener(
+                        self.channel, lambda *args: callback(args[-1])
+                    )
+                    # A dropped connection is only noticed when it is used
+                    while True:
+                        await asyncio.sleep(self.ping_interval)
+                        await conn.execute("SELECT 1")
+                finally:
+                    await conn.close(timeout=5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Feed listener disconnected, reconnecting: {e!r}")
+            await asyncio.sleep(self.ping_interval)
+
+
+class Broadcaster:
+    """
+    Fans the feed out to the subscribers of this process.
+
+    Each event is formatted once as a Server-Sent Events frame, and the
+    same frame is queued for every subscriber. A subscriber that falls
+    `queue_size` events behind loses the oldest ones, so a slow client
+    never holds up the others.
+    """
+
+    def __init__(
+        self, backend: FeedBackend, queue_size: int = 64, max_subscribers: int = 10000
+    ) -> None:
+        self.backend = backend
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def full(self) -> bool:
+        return len(self._subscribers) >= self.max_subscribers
+
+    async def publish(self, event: str, events: List[dict]) -> None:
+        """
+        Send events to the subscribers of every replica. Failures are only logged,
+        the feed never fails the write it reports.
+        :param event: SSE event name, e.g. "created"
+        :param events: Event data, serialized as JSON
+        """
+        messages = [
+            f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+            for data in events
+        ]
+        try:
+            await self.backend.publish(messages)
+        except Exception as e:
+            print(f"Failed to publish to the feed: {e!r}")
+
+    def _deliver(self, message: str) -> None:
+        frame = message.encode()
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(frame)
+
+    async def run(self) -> None:
+        """
+        Deliver the published events to the subscribers, until cancelled.
+        """
+        await self.backend.listen(self._deliver)
+
+    @asynccontextmanager
+    async def subscribe(self):
+        """
+        Queue of the SSE frames published while the context is open.
+        """
+        if self.full:
+            raise OverloadedException(5)
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(queue)
@@ -0,0 +1,146 @@
+from typing import Dict, List, Tuple
+
+from collections import OrderedDict
+
+import torch
+import numpy as np
+
+from model.classifier import OsuClassifier
+
+from const import LABELS
+
+
+def first_change(old: np.ndarray, new: np.ndarray) -> int:
+    """
+    Index of the first row that differs between two feature arrays,
+    the length of the shorter one if it is a prefix of the other.
+    """
+    n = min(len(old), len(new))
+    changed = np.flatnonzero((old[:n] != new[:n]).any(axis=1))
+    return int(changed[0]) if len(changed) else n
+
+
+class _SequenceState:
+    """
+    Recurrent state of one input sequence of a beatmap.
+    `checkpoints[i]` is the hidden state after the first (i + 1) * interval rows.
+    """
+
+    def __init__(
+        self, inputs: np.ndarray, outputs: torch.Tensor, checkpoints: List[torch.Tensor]
+    ) -> None:
+        self.inputs = inputs
+        self.outputs = outputs
+        self.checkpoints = checkpoints
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.inputs.nbytes
+            + self.outputs.numel() * self.outputs.element_size()
+            + sum(h.numel() * h.element_size() for h in self.checkpoints)
+        )
+
+
+class IncrementalPredictor:
+    """
+    Predicts beatmaps that were predicted before with small edits, the usual
+    editor workflow, without running the RNNs over the unchanged start again.
+
+    The RNN outputs and hidden states every `interval` rows are kept for the
+    last predicted version of each beatmap. A new version is compared with it,
+    and the recurrence resumes from the last checkpoint before the first
+    changed row. The attention and FC layers always run over the whole map.
+    Since the inputs are compared, a wrong cache entry (e.g. unsubmitted maps
+    sharing beatmap ID 0) only costs speed, never correctness.
+    """
+
+    def __init__(self, max_bytes: int, interval: int = 256) -> None:
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._nbytes = 0
+        # beatmap_id -> (model_version, hit objects state, slider points state)
+        self._cache: Dict[int, Tuple[str, _SequenceState, _SequenceState]] = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _encode(
+        self, model: OsuClassifier, rnn, x: torch.Tensor, inputs: np.ndarray, cached
+    ) -> Tuple[_SequenceState, int]:
+        """
+        Run the RNN over the rows changed since the cached state.
+        :return: (new state, first row that was recomputed)
+        """
+        k = 0
+        if cached is not None:
+            # The last checkpoint may be after a partial chunk, only resume
+            # from the ones after full chunks
+            k = min(
+                first_change(cached.inputs, inputs), len(cached.inputs)
+            ) // self.interval
+        start = k * self.interval
+        h = cached.checkpoints[k - 1] if k else None
+        outputs, checkpoints = model.encode(rnn, x[:, start:], h, self.interval)
+        if k:
+            outputs = torch.cat((cached.outputs[:, :start], outputs), dim=1)
+            checkpoints = cached.checkpoints[:k] + checkpoints
+        return _SequenceState(inputs.copy(), outputs, checkpoints), start
+
+    @torch.no_grad()
+    def predict(
+        self,
+        model: OsuClassifier,
+        model_version: str,
+        beatmap_id: int,
+        map_info: np.ndarray,
+        hit_objects: np.ndarray,
+        slider_points: np.ndarray,
+    ) -> Tuple[Dict[str, float], np.ndarray, Tuple[int, int]]:
+        """
+        Predict the map type from the features returned by extract_features,
+        reusing the RNN states of the previous version of the beatmap.
+        :return: (probability of each class, embedding,
+            first recomputed (hit object, slider point) row)
+        """
+        cached = self._cache.pop(beatmap_id, None)
+        if cached is not None:
+            self._nbytes -= cached[1].nbytes + cached[2].nbytes
+            if cached[0] != model_version:
+                cached = None
+        ho_cached, sp_cached = cached[1:] if cached is not None else (None, None)
+
+        map_info_t = model.map_info_norm(torch.from_numpy(map_info).unsqueeze(0))
+        ho, ho_start = self._encode(
+            model,
+            model.hit_objects_rnn,
+            model.hit_objects_norm(torch.from_numpy(hit_objects).unsqueeze(0)),
+            hit_objects,
+            ho_cached,
+        )
+        sp, sp_start = self._encode(
+            model,
+            model.slider_points_rnn,
+            model.slider_points_norm(torch.from_numpy(slider_points).unsqueeze(0)),
+            slider_points,
+            sp_cached,
+        )
+        map_type, embedding = model.head(
+            map_info_t, ho.outputs, sp.outputs, return_embedding=True
+        )
+
+        self._cache[beatmap_id] = (model_version, ho, sp)
+        self._nbytes += ho.nbytes + sp.nbytes
+        # Least recently predicted beatmaps go first
+        while self._nbytes > self.max_bytes and self._cache:
+            _, old_ho, old_sp = self._cache.pop(next(iter(self._cache)))
+            self._nbytes -= old_ho.nbytes + old_sp.nbytes
+
+        map_type = map_type.numpy().tolist()[0]
+        return (
+            {label: prob for label, prob in zip(LABELS, map_type)},
+            embedding.numpy()[0],
+            (ho_start, sp_start),
+        )
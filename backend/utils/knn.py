@@ -0,0 +1,263 @@
+from typing import Iterable, List, Optional, Tuple
+
+import os
+import struct
+import zipfile
+import tempfile
+import numpy as np
+
+
+def encode_embedding(embedding: np.ndarray) -> bytes:
+    """
+    Encode an embedding as float16 bytes for storage.
+    """
+    return np.asarray(embedding, dtype=np.float16).tobytes()
+
+
+def decode_embedding(data: bytes) -> np.ndarray:
+    """
+    Decode an embedding stored by encode_embedding.
+    """
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+
+def snapshot_path(path: str) -> str:
+    """
+    File of the index snapshot saved at `path`.
+    """
+    return f"{path}.npz"
+
+
+def _memmap_npz(path: str, name: str) -> np.ndarray:
+    """
+    Memory-map an array of an uncompressed .npz file, np.load reads them in memory.
+    """
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"{name} is compressed in {path}")
+    with open(path, "rb") as f:
+        # Local file header: 30 bytes, then the file name and the extra field
+        f.seek(info.header_offset)
+        header = f.read(30)
+        if header[:4] != b"PK\x03\x04":
+            raise ValueError(f"Invalid local header for {name} in {path}")
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            raise ValueError(f"Unsupported .npy version {version} in {path}")
+        offset = f.tell()
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        shape=shape,
+        order="F" if fortran_order else "C",
+        offset=offset,
+    )
+
+
+def partition(
+    vectors: np.ndarray, n_lists: int, n_iter: int = 10, seed: int = 0
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Spherical k-means of normalized vectors, only reads `vectors`.
+    :return: (centroids, partition of each vector), None if there are fewer
+        vectors than partitions
+    """
+    if len(vectors) < n_lists:
+        return None
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = vectors[assign == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids = centroids / np.maximum(norms, 1e-12)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+
+class EmbeddingIndex:
+    """
+    In-process nearest neighbour index over beatmap embeddings.
+
+    Vectors are L2 normalized, so the inner product is the cosine similarity.
+    Search is a brute-force matrix product until the index is partitioned with
+    `set_partitions`, after which only the `n_probe` closest partitions are
+    scanned (IVF). The index is not thread safe, only `partition` runs outside
+    the event loop.
+    """
+
+    def __init__(self, dim: int, n_probe: int = 8) -> None:
+        self.dim = dim
+        self.n_probe = n_probe
+        self._size = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._positions = {}
+        # IVF partitioning, centroids and the partition of each row
+        self._centroids = None
+        self._assign = np.empty(0, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, beatmap_id: int) -> bool:
+        return beatmap_id in self._positions
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _reserve(self, size: int) -> None:
+        """
+        Grow the arrays, doubling the capacity so appends are amortized O(1).
+        Also turns a memory-mapped snapshot into writable arrays.
+        """
+        capacity = self._vectors.shape[0]
+        if size <= capacity and self._vectors.flags.writeable:
+            return
+        capacity = max(size, capacity * 2, 1024)
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[: self._size] = self._vectors[: self._size]
+        ids = np.empty(capacity, dtype=np.int64)
+        ids[: self._size] = self._ids[: self._size]
+        assign = np.zeros(capacity, dtype=np.int32)
+        assign[: self._size] = self._assign[: self._size]
+        self._vectors, self._ids, self._assign = vectors, ids, assign
+
+    def add(self, beatmap_id: int, embedding: np.ndarray) -> None:
+        """
+        Add or replace the embedding of a beatmap.
+        """
+        self.add_many([beatmap_id], embedding)
+
+    def add_many(self, beatmap_ids: Iterable[int], embeddings: np.ndarray) -> None:
+        """
+        Add or replace the embeddings of several beatmaps.
+        """
+        embeddings = self._normalize(embeddings)
+        beatmap_ids = list(beatmap_ids)
+        new = sum(1 for i in beatmap_ids if i not in self._positions)
+        self._reserve(self._size + new)
+        for beatmap_id, vector in zip(beatmap_ids, embeddings):
+            pos = self._positions.get(beatmap_id)
+            if pos is None:
+                pos = self._size
+                self._positions[beatmap_id] = pos
+                self._ids[pos] = beatmap_id
+                self._size += 1
+            self._vectors[pos] = vector
+            if self.trained:
+                self._assign[pos] = np.argmax(self._centroids @ vector)
+
+    def get(self, beatmap_id: int) -> Optional[np.ndarray]:
+        """
+        Get the normalized embedding of a beatmap, None if it is not indexed.
+        """
+        pos = self._positions.get(beatmap_id)
+        return None if pos is None else self._vectors[pos]
+
+    def search(
+        self, embedding: np.ndarray, k: int, exclude: Optional[int] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Find the k most similar beatmaps.
+        :return: List of (beatmap_id, cosine similarity), most similar first
+        """
+        query = self._normalize(embedding)[0]
+        rows = np.arange(self._size)
+        if self.trained:
+            # Only scan the partitions closest to the query
+            probe = np.argsort(self._centroids @ query)[-self.n_probe :]
+            rows = rows[np.isin(self._assign[: self._size], probe)]
+        if exclude is not None and exclude in self._positions:
+            rows = rows[rows != self._positions[exclude]]
+        if len(rows) == 0:
+            return []
+
+        scores = self._vectors[rows] @ query
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self._ids[rows[i]]), float(scores[i])) for i in top]
+
+    def copy_vectors(self) -> np.ndarray:
+        """
+        Copy of the indexed vectors, to partition them in another thread while
+        embeddings keep being added.
+        """
+        return self._vectors[: self._size].copy()
+
+    def set_partitions(
+        self, centroids: np.ndarray, assign: np.ndarray, vectors: np.ndarray
+    ) -> None:
+        """
+        Partition the index with the result of `partition` on `vectors`, a copy
+        of the first rows. The rows added or replaced since are assigned here.
+        New embeddings are assigned to their closest partition as they are added.
+        """
+        size = len(vectors)
+        self._reserve(self._size)
+        self._centroids = centroids
+        self._assign[:size] = assign
+        changed = np.flatnonzero(np.any(self._vectors[:size] != vectors, axis=1))
+        rows = np.concatenate([changed, np.arange(size, self._size)])
+        if len(rows):
+            self._assign[rows] = np.argmax(self._vectors[rows] @ centroids.T, axis=1)
+
+    def save(self, path: str) -> None:
+        """
+        Save a snapshot in a single .npz file next to `path`, replacing the old
+        one atomically. Each writer uses its own temporary file.
+        """
+        fd, tmp = tempfile.mkstemp(
+            suffix=".tmp",
+            prefix=f"{os.path.basename(path)}.",
+            dir=os.path.dirname(path) or ".",
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                # Uncompressed, so the vectors can be memory-mapped by `load`
+                np.savez(
+                    f, ids=self._ids[: self._size], vectors=self._vectors[: self._size]
+                )
+            os.replace(tmp, snapshot_path(path))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path: str, dim: int, n_probe: int = 8) -> "EmbeddingIndex":
+        """
+        Load a snapshot saved by `save`, the vectors are memory-mapped.
+        """
+        index = cls(dim, n_probe=n_probe)
+        file = snapshot_path(path)
+        try:
+            with np.load(file) as snapshot:
+                ids = snapshot["ids"]
+            vectors = _memmap_npz(file, "vectors")
+        except (zipfile.BadZipFile, KeyError):
+            raise ValueError("Embedding snapshot is inconsistent")
+        if len(ids) != len(vectors) or vectors.shape[1] != dim:
+            raise ValueError("Embedding snapshot is inconsistent")
+        index._ids = ids
+        index._vectors = vectors
+        index._assign = np.zeros(len(ids), dtype=np.int32)
+        index._size = len(ids)
+        index._positions = {int(i): pos for pos, i in enumerate(ids)}
+        return index
@@ -0,0 +1,179 @@
+from typing import Dict, Optional, Tuple
+
+import time
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+
+from model.exceptions import OverloadedException, RateLimitedException
+
+
+class RateLimitBackend(ABC):
+    """
+    Storage for the token buckets.
+    Backends shared between replicas implement the same interface, so the
+    in-memory one can stand in for them locally and in tests.
+    """
+
+    @abstractmethod
+    async def take(self, key: str, rate: float, burst: int) -> Optional[float]:
+        """
+        Take one token from the bucket of `key`.
+        :param key: Client key
+        :param rate: Tokens added per second
+        :param burst: Bucket size
+        :return: None if a token was taken, otherwise seconds until one is available
+        """
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """
+    Token buckets kept in the process, each worker limits on its own.
+    """
+
+    def __init__(self, max_keys: int = 100000) -> None:
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def take(self, key: str, rate: float, burst: int) -> Optional[float]:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            # Full buckets carry no state, forget them first
+            self._buckets = {
+                k: (t, u)
+                for k, (t, u) in self._buckets.items()
+                if t + (now - u) * rate < burst
+            }
+        self._buckets[key] = (tokens - 1, now)
+        return None
+
+
+class PostgresRateLimitBackend(RateLimitBackend):
+    """
+    Token buckets stored in postgres, shared by every replica.
+    The bucket row is locked while it is refilled and taken from.
+    """
+
+    _CREATE = text(
+        """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL
+        )
+        """
+    )
+    _INIT = text(
+        """
+        INSERT INTO rate_limits (key, tokens, updated_at)
+        VALUES (:key, :burst, clock_timestamp())
+        ON CONFLICT (key) DO NOTHING
+        """
+    )
+    _SELECT = text(
+        """
+        SELECT tokens, EXTRACT(EPOCH FROM clock_timestamp() - updated_at)
+        FROM rate_limits WHERE key = :key FOR UPDATE
+        """
+    )
+    _UPDATE = text(
+        """
+        UPDATE rate_limits SET tokens = :tokens, updated_at = clock_timestamp()
+        WHERE key = :key
+        """
+    )
+
+    def __init__(self, session_factory) -> None:
+        self.session_factory = session_factory
+        self._created = False
+
+    async def take(self, key: str, rate: float, burst: int) -> Optional[float]:
+        async with self.session_factory() as session:
+            async with session.begin():
+                if not self._created:
+                    await session.execute(self._CREATE)
+                    self._created = True
+                await session.execute(self._INIT, {"key": key, "burst": burst})
+                q = await session.execute(self._SELECT, {"key": key})
+                tokens, elapsed = q.one()
+                tokens = min(burst, tokens + float(elapsed) * rate)
+                retry_after = None
+                if tokens < 1:
+                    retry_after = (1 - tokens) / rate
+                else:
+                    tokens -= 1
+                await session.execute(self._UPDATE, {"key": key, "tokens": tokens})
+        return retry_after
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiting per client.
+    """
+
+    def __init__(self, backend: RateLimitBackend, rate: float, burst: int) -> None:
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+
+    async def check(self, key: str) -> None:
+        """
+        Take a token for the client, raises RateLimitedException if there is none left.
+        """
+        try:
+            retry_after = await self.backend.take(key, self.rate, self.burst)
+        except Exception as e:
+            # Don't turn a limiter outage into an API outage
+            print(f"Rate limiter unavailable: {e}")
+            return
+        if retry_after is not None:
+            raise RateLimitedException(retry_after)
+
+
+class AdmissionController:
+    """
+    Limits the number of predictions running at once.
+
+    Requests wait for a slot at most `deadline` seconds. When the expected wait,
+    estimated from the queue length and the recent service times, is already
+    longer than the deadline, the request is rejected right away instead.
+    """
+
+    def __init__(self, max_inflight: int, deadline: float) -> None:
+        self.max_inflight = max_inflight
+        self.deadline = deadline
+        self._semaphore = asyncio.Semaphore(max_inflight)
+        self._waiting = 0
+        # Moving average of the time spent holding a slot
+        self._service_time = 0.0
+
+    def expected_wait(self) -> float:
+        return self._waiting / self.max_inflight * self._service_time
+
+    @asynccontextmanager
+    async def admit(self):
+        retry_after = max(1.0, self.expected_wait())
+        if self.expected_wait() > self.deadline:
+            raise OverloadedException(retry_after)
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.deadline)
+        except asyncio.TimeoutError:
+            raise OverloadedException(retry_after)
+        finally:
+            self._waiting -= 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+            elapsed = time.monotonic() - start
+            self._service_time = 0.8 * self._service_time + 0.2 * elapsed
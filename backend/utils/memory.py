@@ -0,0 +1,155 @@
+from typing import Dict, Optional
+
+import os
+import time
+import ctypes
+import resource
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    _libc = ctypes.CDLL("libc.so.6")
+except OSError:
+    _libc = None
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size of the process, 0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def max_rss_bytes() -> int:
+    """
+    Highest resident set size of the process so far.
+    """
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def trim_heap() -> bool:
+    """
+    Give the free memory at the top of the heap and in the arenas back to the
+    system, fragmented arenas otherwise keep the RSS up after a large request.
+    :return: True if glibc released memory
+    """
+    if _libc is None:
+        return False
+    return bool(_libc.malloc_trim(0))
+
+
+class MemoryTracker:
+    """
+    Memory instrumentation of a worker.
+
+    `track` measures the peak allocations of a request phase: the Python and
+    numpy allocations seen by tracemalloc when tracing is enabled, and the
+    growth of the highest RSS, which also covers torch and other native
+    allocations. The highest RSS only grows past its previous high, so the
+    current RSS is sampled too, before and after the phase, to show what a
+    phase keeps and the RSS the worker is at. tracemalloc has a single peak
+    per process, the phases are synchronous so other requests rarely overlap
+    with them.
+
+    `snapshot` keeps the top allocators, and their growth since the previous
+    snapshot, to find what keeps the memory of a long running worker growing.
+    """
+
+    def __init__(self, tracing: bool, frames: int = 1, top: int = 20) -> None:
+        self.tracing = tracing
+        self.top = top
+        # Phase -> highest and last peaks, in bytes
+        self.peaks: Dict[str, Dict[str, int]] = {}
+        self.last_snapshot: Optional[dict] = None
+        self._previous: Optional[tracemalloc.Snapshot] = None
+        if tracing and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    @contextmanager
+    def track(self, phase: str):
+        max_rss = max_rss_bytes()
+        rss = rss_bytes()
+        if self.tracing:
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            rss_after = rss_bytes()
+            peak = {
+                "rss_growth": max_rss_bytes() - max_rss,
+                # Negative when the phase gave memory back
+                "rss_change": rss_after - rss,
+                "rss_after": rss_after,
+            }
+            if self.tracing:
+                peak["traced"] = tracemalloc.get_traced_memory()[1] - traced
+            stats = self.peaks.setdefault(phase, {"count": 0})
+            stats["count"] += 1
+            for name, value in peak.items():
+                stats[f"last_{name}"] = value
+                stats[f"max_{name}"] = max(stats.get(f"max_{name}", 0), value)
+
+    def snapshot(self) -> Optional[dict]:
+        """
+        Take an allocation snapshot, blocks while the traces are copied.
+        :return: Top allocators by size and by growth since the previous
+            snapshot, None when tracing is disabled
+        """
+        if not self.tracing:
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        top = snapshot.statistics("lineno")[: self.top]
+        growth = []
+        if self._previous is not None:
+            growth = [
+                stat
+                for stat in snapshot.compare_to(self._previous, "lineno")
+                if stat.size_diff > 0
+            ][: self.top]
+        self._previous = snapshot
+        self.last_snapshot = {
+            "taken_at": time.time(),
+            "top": [self._stat(stat) for stat in top],
+            "growth": [self._stat(stat) for stat in growth],
+        }
+        return self.last_snapshot
+
+    @staticmethod
+    def _stat(stat) -> dict:
+        frame = stat.traceback[0]
+        info = {
+            "location": f"{frame.filename}:{frame.lineno}",
+            "size": stat.size,
+            "count": stat.count,
+        }
+        if hasattr(stat, "size_diff"):
+            info["size_diff"] = stat.size_diff
+            info["count_diff"] = stat.count_diff
+        return info
+
+    def report(self) -> dict:
+        """
+        Memory usage of the worker and the per-phase peaks.
+        """
+        report = {
+            "pid": os.getpid(),
+            "rss": rss_bytes(),
+            "max_rss": max_rss_bytes(),
+            "peaks": self.peaks,
+            "tracing": self.tracing,
+            "snapshot": self.last_snapshot,
+        }
+        if self.tracing:
+            report["traced"], report["traced_peak"] = tracemalloc.get_traced_memory()
+        return report
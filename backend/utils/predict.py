@@ -1,48 +1,74 @@
-from typing import List, Tuple
+from typing import Dict, Tuple, Union
 
 import torch
 import numpy as np
 
 from utils import data
 from utils.beatmap import Beatmap
-from model.classifier import OsuClassifier
+from model.classifier import OsuClassifier, StudentClassifier
 
-from const import HIT_OBJECTS_FEATURES, SLIDER_POINTS_FEATURES, LABELS
+from const import LABELS
 
 
-async def predict_map_type(
-    model: OsuClassifier, beatmap: Beatmap
-) -> List[Tuple[str, float]]:
+async def extract_features(
+    beatmap: Beatmap,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Predict the map type of a beatmap.
+    Extract the model inputs of a beatmap, before standardization.
     """
     map_info, hit_objects, slider_points = await beatmap.get_data()
     assert len(hit_objects), "No hit objects found in beatmap"
 
-    # Preprocess the data
-    map_info = np.asarray([map_info], dtype=np.float32)
-    hit_objects = data.add_diff_dim(np.asarray(hit_objects, dtype=np.float32))
+    # Preprocess the data, works in place on the float32 arrays
+    hit_objects = data.add_diff_dim(hit_objects)
+    return map_info, hit_objects, slider_points
+
+
+@torch.no_grad()
+def predict_features(
+    model: Union[OsuClassifier, StudentClassifier],
+    map_info: np.ndarray,
+    hit_objects: np.ndarray,
+    slider_points: np.ndarray,
+) -> Tuple[Dict[str, float], np.ndarray]:
+    """
+    Predict the map type from the features returned by extract_features.
+    Returns the probability for each class and the beatmap embedding.
+    """
     seq_ho = [hit_objects.shape[0]]
-    slider_points = np.asarray(slider_points, dtype=np.float32)
     seq_sp = [slider_points.shape[0]]
 
-    ## Standardize the data
-    map_info, hit_objects, slider_points = data.standardize(
-        map_info, hit_objects, slider_points
-    )
-
-    ## Reshape the data to (N, L, features), where N is the batch and L is sequence length
-    hit_objects = hit_objects.reshape(1, -1, HIT_OBJECTS_FEATURES)
-    slider_points = slider_points.reshape(1, -1, SLIDER_POINTS_FEATURES)
+    # Standardization is done inside the model
 
-    # Convert to tensor
-    map_info = torch.from_numpy(map_info).float()
-    hit_objects = torch.from_numpy(hit_objects).float()
-    slider_points = torch.from_numpy(slider_points).float()
+    ## Add the batch dimension, (N, L, features) where N is the batch and L is sequence length
+    # torch.from_numpy shares memory with the arrays, so no copy is made
+    map_info = torch.from_numpy(map_info).unsqueeze(0)
+    hit_objects = torch.from_numpy(hit_objects).unsqueeze(0)
+    slider_points = torch.from_numpy(slider_points).unsqueeze(0)
 
     # Predict the map type
-    map_type = model(map_info, hit_objects, slider_points, seq_ho, seq_sp)
-    map_type = map_type.detach().numpy().tolist()[0]
+    map_type, embedding = model(
+        map_info, hit_objects, slider_points, seq_ho, seq_sp, return_embedding=True
+    )
+    map_type = map_type.numpy().tolist()[0]
+    embedding = embedding.numpy()[0]
 
     # Return the map type
-    return {label: prob for label, prob in zip(LABELS, map_type)}
+    return {label: prob for label, prob in zip(LABELS, map_type)}, embedding
+
+
+def is_uncertain(map_type: Dict[str, float], margin: float) -> bool:
+    """
+    Whether any class probability is within `margin` of the 0.5 decision threshold.
+    """
+    return any(abs(prob - 0.5) < margin for prob in map_type.values())
+
+
+async def predict_map_type(
+    model: OsuClassifier, beatmap: Beatmap
+) -> Tuple[Dict[str, float], np.ndarray]:
+    """
+    Predict the map type of a beatmap.
+    Returns the probability for each class and the beatmap embedding.
+    """
+    return predict_features(model, *await extract_features(beatmap))
@@ -0,0 +1,228 @@
+from typing import List, Optional
+
+import os
+import time
+import json
+import shutil
+import asyncio
+import cProfile
+from datetime import datetime, timezone
+from contextvars import ContextVar
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import event
+
+
+# Trace thread of each event category, so the phases and the SQL get a row each
+_THREADS = {"phase": 1, "sql": 2}
+
+
+class RequestProfile:
+    """
+    Trace of one request, saved in its own directory:
+    - python.prof: cProfile stats (pstats, e.g. `snakeviz python.prof`)
+    - torch.json: torch.profiler operator timings (Chrome trace)
+    - timeline.json: the request phases and the SQL statements (Chrome trace)
+    Both traces open in chrome://tracing or https://ui.perfetto.dev.
+
+    cProfile sees everything running on the event loop while it is enabled,
+    other requests served at the same time may show up in python.prof.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.name = os.path.basename(directory)
+        self._python = cProfile.Profile()
+        self._torch_traces = 0
+        self._origin = time.perf_counter()
+        # Complete events of the Chrome Trace Event Format
+        self._events: List[dict] = []
+
+    def add_event(
+        self, name: str, category: str, start: float, end: float, args: dict = None
+    ) -> None:
+        """
+        Record a span, `start` and `end` are time.perf_counter() values.
+        """
+        self._events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self._origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": _THREADS[category],
+                "args": args or {},
+            }
+        )
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_event(name, "phase", start, time.perf_counter())
+
+    @contextmanager
+    def python(self):
+        self._python.enable()
+        try:
+            yield
+        finally:
+            self._python.disable()
+
+    @contextmanager
+    def torch(self):
+        # Imported lazily, like torch in the API
+        from torch.profiler import ProfilerActivity, profile
+
+        with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+            yield
+        suffix = f".{self._torch_traces}" if self._torch_traces else ""
+        self._torch_traces += 1
+        os.makedirs(self.directory, exist_ok=True)
+        prof.export_chrome_trace(os.path.join(self.directory, f"torch{suffix}.json"))
+
+    def save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._python.dump_stats(os.path.join(self.directory, "python.prof"))
+        names = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": category},
+            }
+            for category, tid in _THREADS.items()
+        ]
+        with open(os.path.join(self.directory, "timeline.json"), "w") as f:
+            json.dump({"traceEvents": names + self._events}, f)
+
+
+_current: ContextVar[Optional[RequestProfile]] = ContextVar(
+    "request_profile", default=None
+)
+
+
+# Hooks placed in the code paths, they do nothing unless the request is profiled
+@contextmanager
+def profile_span(name: str):
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    with profile.span(name):
+        yield
+
+
+@contextmanager
+def profile_python():
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    with profile.python():
+        yield
+
+
+@contextmanager
+def profile_torch():
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    with profile.torch():
+        yield
+
+
+def install_sql_timing(sync_engine, max_statement_length: int = 500) -> None:
+    """
+    Record the statements run by an engine in the profile of the request.
+    The parameters are not recorded.
+    """
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if _current.get() is not None:
+            conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        profile = _current.get()
+        starts = conn.info.get("profile_start")
+        if profile is None or not starts:
+            return
+        start = starts.pop()
+        profile.add_event(
+            statement.split(None, 1)[0].upper() if statement.strip() else "SQL",
+            "sql",
+            start,
+            time.perf_counter(),
+            {"statement": statement[:max_statement_length], "executemany": many},
+        )
+
+
+class RequestProfiler:
+    """
+    Samples the requests asking to be profiled.
+
+    Profiling is only done when enabled, one request at a time per worker
+    and at most once every `min_interval` seconds, and only the last
+    `max_profiles` traces are kept, so it can stay available in production.
+    """
+
+    def __init__(
+        self, directory: str, enabled: bool, min_interval: float, max_profiles: int
+    ) -> None:
+        self.directory = directory
+        self.enabled = enabled
+        self.min_interval = min_interval
+        self.max_profiles = max_profiles
+        self._running = False
+        self._last_start = float("-inf")
+
+    def _prune(self) -> None:
+        profiles = sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+        )
+        for path in profiles[: -self.max_profiles]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    @asynccontextmanager
+    async def sample(self, requested: bool):
+        """
+        Profile the code run in the context if the request asked for it and the
+        limits allow it.
+        :return: Profile of the request, None if it is not profiled
+        """
+        now = time.monotonic()
+        if (
+            not requested
+            or not self.enabled
+            or self._running
+            or now - self._last_start < self.min_interval
+        ):
+            yield None
+            return
+
+        self._running = True
+        self._last_start = now
+        # Named by start time, so the oldest sort first
+        name = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S.%f}-{os.getpid()}"
+        profile = RequestProfile(os.path.join(self.directory, name))
+        token = _current.set(profile)
+        try:
+            yield profile
+        finally:
+            _current.reset(token)
+            self._running = False
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, profile.save)
+                await loop.run_in_executor(None, self._prune)
+                print(f"Saved profile {profile.directory}")
+            except OSError as e:
+                print(f"Failed to save profile {profile.directory}: {e!r}")
@@ -0,0 +1,60 @@
+from typing import List, Optional, Tuple
+
+import re
+
+from const import LABELS
+from model.exceptions import InvalidQueryException
+
+
+_FILTER_PATTERN = re.compile(r"^\s*([a-z]+)\s*(>=|<=|>|<)\s*([0-9]*\.?[0-9]+)\s*$")
+
+
+def parse_class_filters(filters: Optional[str]) -> List[Tuple[str, str, float]]:
+    """
+    Parse class filters such as "stream>0.8,tech<0.2" into (class, operator, value) tuples.
+    """
+    if not filters:
+        return []
+    parsed = []
+    for f in filters.split(","):
+        match = _FILTER_PATTERN.match(f)
+        if match is None or match.group(1) not in LABELS:
+            raise InvalidQueryException()
+        label, op, value = match.groups()
+        parsed.append((label, op, float(value)))
+    return parsed
+
+
+def parse_ids(ids: Optional[str], max_ids: int) -> List[int]:
+    """
+    Parse comma separated IDs such as "123,456", duplicates are dropped.
+    """
+    if not ids:
+        return []
+    try:
+        parsed = list(dict.fromkeys(int(i) for i in ids.split(",")))
+    except ValueError:
+        raise InvalidQueryException("IDs must be comma separated integers.")
+    if len(parsed) > max_ids:
+        raise InvalidQueryException(f"At most {max_ids} IDs can be requested at once.")
+    return parsed
+
+
+def encode_cursor(value: float, beatmap_id: int) -> str:
+    """
+    Encode the keyset cursor pointing right after the given row.
+    """
+    return f"{value!r}_{beatmap_id}"
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    """
+    Decode a cursor created by encode_cursor.
+    """
+    if not cursor:
+        return None
+    try:
+        value, beatmap_id = cursor.split("_")
+        return float(value), int(beatmap_id)
+    except ValueError:
+        raise InvalidQueryException()
@@ -0,0 +1,69 @@
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+import asyncio
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls.
+
+    While a call for a key is running, other callers with the same key wait
+    for it and receive its result, or its exception, instead of running their
+    own. The result is shared, callers must not modify it.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `func` unless a call with the same key is already running,
+        in both cases return the result of the running call.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # A caller that goes away doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Retrieve the exception, the callers waiting for it may all be gone
+        if not task.cancelled():
+            task.exception()
+
+
+class ViewCounter:
+    """
+    Buffers beatmap view counts, written to the database in bulk by `flush`.
+    Keeps the hot rows of popular beatmaps from being locked by every view.
+    """
+
+    def __init__(self) -> None:
+        self._counts: Dict[int, int] = {}
+
+    def add(self, beatmap_id: int, n: int = 1) -> None:
+        self._counts[beatmap_id] = self._counts.get(beatmap_id, 0) + n
+
+    async def flush(self, write: Callable[[Dict[int, int]], Awaitable[None]]) -> None:
+        """
+        Write the buffered counts with `write`, they are kept if it fails.
+        """
+        if not self._counts:
+            return
+        counts, self._counts = self._counts, {}
+        try:
+            await write(counts)
+        except Exception:
+            for beatmap_id, n in counts.items():
+                self.add(beatmap_id, n)
+            raise
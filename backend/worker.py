@@ -0,0 +1,216 @@
+import asyncio
+import humanize
+from typing import Optional
+from datetime import datetime
+
+from const import *
+from config.db import engine, async_session
+from config.runtime import configure_torch
+from model.db import BeatmapDAL, ModelVersionDAL, PredictionJobDAL, init_db
+from model.exceptions import (
+    InvalidFileException,
+    BeatmapTooLongException,
+    BeatmapUnsupportedException,
+)
+from model.loader import get_active_model, load_version, switch_model, warm_up
+from rescore import predict_stored
+from utils.beatmap import parse_beatmap
+from utils.knn import encode_embedding
+from utils.features import FeatureStore, content_hash
+from utils.feed import Broadcaster, PostgresFeedBackend, feed_event
+from utils.predict import extract_features, predict_features
+
+
+# Status code stored on a failed job for each exception
+ERROR_CODES = {
+    InvalidFileException: APIStatusCode.INVALID_FILE,
+    BeatmapTooLongException: APIStatusCode.BEATMAP_TOO_LONG,
+    BeatmapUnsupportedException: APIStatusCode.BEATMAP_UNSUPPORTED,
+}
+
+
+async def process_jobs(
+    model,
+    model_version: str,
+    feature_store: FeatureStore,
+    jobs,
+    feed: Optional[Broadcaster] = None,
+) -> None:
+    """
+    Parse and predict a batch of claimed jobs, then write the results in one
+    transaction, each job in a savepoint so a failing write only fails its job.
+    The stored predictions are sent to the feed once they are committed.
+    """
+    results = []
+    for job in jobs:
+        start = datetime.now()
+        try:
+            bm = await parse_beatmap(job.content)
+            features = await extract_features(bm)
+            map_type, embedding = predict_features(model, *features)
+            features_hash = content_hash(job.content)
+            feature_store.put(features_hash, features)
+        except Exception as e:
+            print(f"Job {job.id} failed: {e!r}")
+            error_code = ERROR_CODES.get(type(e), APIStatusCode.PREDICTION_FAILED)
+            results.append((job.id, None, error_code))
+            continue
+        print(
+            f"Job {job.id} predicted beatmap (id={bm.metadata['beatmap_id']}) "
+            f"in {humanize.precisedelta(datetime.now() - start)}"
+        )
+        results.append((job.id, (bm, map_type, embedding, features_hash), None))
+
+    events = {"created": [], "updated": []}
+    async with async_session() as session:
+        async with session.begin():
+            jobs_dal = PredictionJobDAL(session)
+            beatmaps_dal = BeatmapDAL(session)
+            for job_id, prediction, error_code in results:
+                if prediction is None:
+                    await jobs_dal.fail(job_id, error_code)
+                    continue
+                bm, map_type, embedding, features_hash = prediction
+                try:
+                    async with session.begin_nested():
+                        created = await beatmaps_dal.create_or_update_beatmap(
+                            **bm.metadata,
+                            **map_type,
+                            embedding=encode_embedding(embedding),
+                            features_hash=features_hash,
+                            model_version=model_version,
+                        )
+                        await jobs_dal.complete(job_id, bm.metadata["beatmap_id"])
+                except Exception as e:
+                    print(f"Failed to store the result of job {job_id}: {e!r}")
+                    await jobs_dal.fail(job_id, APIStatusCode.PREDICTION_FAILED)
+                    continue
+                events["created" if created else "updated"].append(
+                    feed_event(bm.metadata, map_type, model_version)
+                )
+    if feed is not None:
+        for event, data in events.items():
+            await feed.publish(event, data)
+
+
+async def sync_model(model_version: str) -> str:
+    """
+    Switch to the active model version if another one was activated.
+    :return: Model version in use
+    """
+    async with async_session() as session:
+        async with session.begin():
+            active = await ModelVersionDAL(session).get_active()
+    if active is None or active.version == model_version:
+        return model_version
+    try:
+        switched = switch_model(active.version, active.weights_path)
+    except Exception as e:
+        print(f"Failed to load model {active.version}: {e!r}")
+        return model_version
+    if not switched:
+        print(f"Weights {active.weights_path} don't match model {active.version}")
+        return model_version
+    print(f"Switched to model {active.version}")
+    return active.version
+
+
+async def rescore_stale(
+    model, model_version: str, feature_store: FeatureStore, after_beatmap_id: int
+) -> Optional[int]:
+    """
+    Re-score a batch of beatmaps predicted by another model version.
+    The rows are not locked while they are predicted, the update skips the
+    beatmaps changed in the meantime, e.g. re-scored by another worker.
+    :return: ID of the last beatmap of the batch, None when there are none left
+    """
+    async with async_session() as session:
+        async with session.begin():
+            rows = await BeatmapDAL(session).get_feature_hashes(
+                after_beatmap_id, RESCORE_BATCH_SIZE, stale_version=model_version
+            )
+    if not rows:
+        return None
+    predictions, missing = await predict_stored(
+        model, model_version, feature_store, rows
+    )
+    async with async_session() as session:
+        async with session.begin():
+            dal = BeatmapDAL(session)
+            updated = await dal.update_predictions(predictions)
+            # Not looked for again, so the re-scoring gets past them
+            await dal.clear_feature_hashes(missing)
+    print(f"Re-scored {updated} beatmaps with model {model_version}")
+    return rows[-1][0]
+
+
+async def main():
+    configure_torch()
+    model_version, model = load_version(MODEL_WEIGHTS_PATH)
+    warm_up(model)
+    async with engine.begin() as conn:
+        await conn.run_sync(init_db)
+    async with async_session() as session:
+        async with session.begin():
+            await ModelVersionDAL(session).register(model_version, MODEL_WEIGHTS_PATH)
+    feature_store = FeatureStore(FEATURE_STORE_PATH, FEATURE_STORE_COMPRESS)
+    # Only a shared feed reaches the API workers
+    feed = None
+    if FEED_BACKEND == "postgres":
+        feed = Broadcaster(PostgresFeedBackend(async_session, DATABASE_DSN))
+    print("Prediction worker started!")
+
+    loop = asyncio.get_running_loop()
+    next_model_check = 0
+    # Keyset position of the background re-scoring, and when to run the next batch
+    rescore_after = 0
+    next_rescore = 0
+    # Consecutive failed iterations, the worker backs off while e.g. the
+    # database is unreachable
+    errors = 0
+    while True:
+        try:
+            if loop.time() >= next_model_check:
+                next_model_check = loop.time() + MODEL_POLL_INTERVAL
+                if await sync_model(model_version) != model_version:
+                    model_version, model = get_active_model()
+                    rescore_after = 0
+
+            async with async_session() as session:
+                async with session.begin():
+                    jobs = await PredictionJobDAL(session).claim(
+                        JOB_BATCH_SIZE, JOB_TIMEOUT, JOB_MAX_ATTEMPTS
+                    )
+            if jobs:
+                await process_jobs(model, model_version, feature_store, jobs, feed)
+                errors = 0
+                continue
+
+            # Spend the idle time on beatmaps predicted by an older model,
+            # throttled so new jobs are picked up quickly
+            if loop.time() >= next_rescore:
+                last = await rescore_stale(
+                    model, model_version, feature_store, rescore_after
+                )
+                if last is None:
+                    # Nothing left, look again later for rows written by old workers
+                    rescore_after = 0
+                    next_rescore = loop.time() + MODEL_POLL_INTERVAL
+                else:
+                    rescore_after = last
+                    next_rescore = loop.time() + RESCORE_INTERVAL
+            errors = 0
+        except Exception as e:
+            # Claimed jobs whose results weren't written are claimed again
+            # after JOB_TIMEOUT
+            errors += 1
+            print(f"Worker iteration failed ({errors} in a row): {e!r}")
+            await asyncio.sleep(
+                min(JOB_POLL_INTERVAL * 2 ** min(errors, 16), JOB_ERROR_BACKOFF)
+            )
+            continue
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
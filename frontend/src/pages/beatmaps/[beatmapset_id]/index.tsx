@@ -10,15 +10,21 @@ import {
   VStack,
   Link,
   Flex,
+  Text,
+  Wrap,
+  WrapItem,
+  Badge,
 } from "@chakra-ui/react";
 import axios from "axios";
 
 import { Container } from "../../../components/Container";
 import BeatmapInfo from "../../../components/BeatmapInfo";
-import { BeatmapResponse } from "../../../types";
+import { BeatmapResponse, BeatmapSetProfile } from "../../../types";
+import { MAP_TYPENAME } from "../../../const";
 
 interface Props {
   beatmaps: BeatmapResponse[];
+  profile: BeatmapSetProfile | null;
   beatmapset_id: number;
 }
 
@@ -31,6 +37,7 @@ export const getServerSideProps: GetServerSideProps = async (context) => {
     return {
       props: {
         beatmaps: res.data.data.beatmaps,
+        profile: res.data.data.profile ?? null,
         beatmapset_id: context.query.beatmapset_id,
       },
     };
@@ -70,6 +77,31 @@ const Index = (props: Props) => {
                   BeatmapSet:{props.beatmapset_id}
                 </Heading>
               </Flex>
+              {props.profile && (
+                <VStack w={"100%"} align={"start"} px={5}>
+                  <Text>
+                    {props.profile.difficulty_count} difficulties,{" "}
+                    {props.profile.view_count} views
+                  </Text>
+                  <Wrap>
+                    {Object.entries(MAP_TYPENAME).map(([key, name]) => (
+                      <WrapItem key={key}>
+                        <Badge>
+                          {name}:{" "}
+                          {(
+                            (props.profile as any)[`${key}_mean`] * 100
+                          ).toFixed(1)}
+                          % (max{" "}
+                          {((props.profile as any)[`${key}_max`] * 100).toFixed(
+                            1
+                          )}
+                          %)
+                        </Badge>
+                      </WrapItem>
+                    ))}
+                  </Wrap>
+                </VStack>
+              )}
               <Box
                 borderWidth="1"
                 bgColor={bg}
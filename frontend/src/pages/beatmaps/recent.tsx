@@ -1,4 +1,4 @@
-import { useState } from "react";
+import { useEffect, useState } from "react";
 import { GetServerSideProps } from "next";
 import Head from "next/head";
 import NextLink from "next/link";
@@ -58,7 +58,14 @@ const BMPopular = (props: Props) => {
       const res = await axios.get(
         `https://api-osuclassy.fauzanardh.me/beatmaps/recent?page=${currentPage}&limit=6`
       );
-      setBeatmaps([...beatmaps, ...res.data.data.beatmaps]);
+      // Beatmaps pushed by the feed shift the pages, skip the ones already shown
+      const shown = new Set(beatmaps.map((b) => b.beatmap_id));
+      setBeatmaps([
+        ...beatmaps,
+        ...res.data.data.beatmaps.filter(
+          (b: BeatmapResponse) => !shown.has(b.beatmap_id)
+        ),
+      ]);
       setHasMoreItems(res.data.data.beatmaps.length > 0);
       setCurrentPage(currentPage + 1);
     } catch (err) {
@@ -66,6 +73,22 @@ const BMPopular = (props: Props) => {
     }
   };
 
+  // Newly predicted beatmaps are pushed by the server instead of polled
+  useEffect(() => {
+    const feed = new EventSource(
+      `https://api-osuclassy.fauzanardh.me/beatmaps/feed`
+    );
+    feed.addEventListener("created", (e) => {
+      const beatmap: BeatmapResponse = JSON.parse((e as MessageEvent).data);
+      setBeatmaps((prev) =>
+        prev.some((b) => b.beatmap_id === beatmap.beatmap_id)
+          ? prev
+          : [beatmap, ...prev]
+      );
+    });
+    return () => feed.close();
+  }, []);
+
   return (
     <>
       <Head>
@@ -23,6 +23,28 @@ export interface BeatmapResponse {
   creator: string;
   version: string;
 }
+export interface BeatmapSetProfile {
+  beatmapset_id: number;
+  artist: string;
+  title: string;
+  difficulty_count: number;
+  view_count: number;
+  alternate_mean: number;
+  alternate_max: number;
+  fingercontrol_mean: number;
+  fingercontrol_max: number;
+  jump_mean: number;
+  jump_max: number;
+  speed_mean: number;
+  speed_max: number;
+  stamina_mean: number;
+  stamina_max: number;
+  stream_mean: number;
+  stream_max: number;
+  tech_mean: number;
+  tech_max: number;
+  updated_at: string;
+}
 export interface PredictionResponse {
   processing_time: string;
   beatmap_id: number;
@@ -14,6 +14,9 @@ kubectl apply -f k8s_configurations/db-deployment.yaml
 echo "Deploying the backend..."
 kubectl apply -f k8s_configurations/backend-deployment.yaml
 
+echo "Deploying the prediction workers..."
+kubectl apply -f k8s_configurations/worker-deployment.yaml
+
 echo "Deploying the frontend..."
 kubectl apply -f k8s_configurations/frontend-deployment.yaml
 